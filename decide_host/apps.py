@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class DecideHostConfig(AppConfig):
     name = "decide_host"
+
+    def ready(self):
+        from decide_host import signals  # noqa: F401
@@ -0,0 +1,13 @@
+# -*- mode: python -*-
+"""URLs for ASGI deployments, with the async event and trial list views"""
+
+from django.urls import re_path
+
+from decide_host import async_views, urls
+
+app_name = urls.app_name
+urlpatterns = [
+    re_path(r"^api/events/$", async_views.AsyncEventList.as_view(), name="event-list"),
+    re_path(r"^api/trials/$", async_views.AsyncTrialList.as_view(), name="trial-list"),
+    *urls.urlpatterns,
+]
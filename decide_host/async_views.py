@@ -0,0 +1,230 @@
+# -*- mode: python -*-
+"""Async versions of the event and trial list endpoints, for ASGI deployments.
+
+These handle the common requests from controllers and clients (uploads,
+keyset-paginated JSON lists, and NDJSON exports) without tying up a worker
+thread while waiting for the database. Anything else (page-number pagination,
+the change feed, CSV, the browsable API, the write-behind spool, or strict
+duplicate checking) is passed on to the corresponding sync view. Use them by including
+`decide_host.async_urls` instead of `decide_host.urls`.
+
+"""
+
+import logging
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from decide_host import ingest, pagination, renderers, spool, views
+from decide_host.lookups import is_foreign_key_violation, slug_cache
+from decide_host.middleware import serializing
+
+logger = logging.getLogger(__name__)
+
+
+def json_response(data, status_code=status.HTTP_200_OK, headers=None):
+    return JsonResponse(
+        data, status=status_code, headers=headers, encoder=JSONEncoder, safe=False
+    )
+
+
+class AsyncRecordList(View):
+    """Async counterpart of a sync list view with BulkCreateMixin.
+
+    The sync view class supplies the queryset, filters, serializer, and
+    ingest logic, none of which touch the database until the queryset is
+    evaluated.
+    """
+
+    view_class = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # like the sync views, uploads don't use CSRF tokens
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    def get_sync_view(self, request):
+        view = self.view_class(args=self.args, kwargs=self.kwargs, format_kwarg=None)
+        view.request = Request(request, parsers=view.get_parsers())
+        return view
+
+    async def filter_queryset(self, view):
+        if any(param.startswith("data__") for param in view.request.query_params):
+            # data filters look up the schemas of compacted payloads
+            await sync_to_async(getattr)(view, "schema_positions")
+        return view.filter_queryset(view.get_queryset())
+
+    async def fallback(self, request, *args, **kwargs):
+        """Handles the request with the sync view"""
+        handler = sync_to_async(self.view_class.as_view())
+        return await handler(request, *args, **kwargs)
+
+    async def get(self, request, *args, **kwargs):
+        view = self.get_sync_view(request)
+        params = view.request.query_params
+        fmt = params.get("format")
+        accept = request.headers.get("Accept", "*/*")
+        ndjson = renderers.NDJSONRenderer
+        feed = pagination.ChangeFeedPagination
+        if feed.since_query_param in params:
+            return await self.fallback(request, *args, **kwargs)
+        if fmt == ndjson.format or (
+            fmt is None and accept.startswith(ndjson.media_type)
+        ):
+            return await self.export(view)
+        paginator = pagination.TimestampPagination().get_paginator(view.request)
+        if (
+            fmt not in (None, "json")
+            or "text/html" in accept
+            or not isinstance(paginator, pagination.KeysetPaginationByTimestamp)
+        ):
+            return await self.fallback(request, *args, **kwargs)
+        try:
+            queryset = await self.filter_queryset(view)
+        except ValidationError as err:
+            return json_response(err.detail, status_code=status.HTTP_400_BAD_REQUEST)
+        serializer = view.get_serializer()
+        values = serializer.get_values(queryset)
+        page = paginator.get_page_queryset(values, view.request)
+        headers = None
+        if page is None:
+            rows = [row async for row in values]
+        else:
+            rows = paginator.set_page([row async for row in page])
+            headers = pagination.link_header(paginator.get_links())
+        with serializing(request):
+            data = [serializer.flatten_values(row) for row in rows]
+        return json_response(data, headers=headers)
+
+    async def export(self, view):
+        try:
+            queryset = await self.filter_queryset(view)
+        except ValidationError as err:
+            return json_response(err.detail, status_code=status.HTTP_400_BAD_REQUEST)
+        serializer = view.get_serializer()
+        renderer = renderers.NDJSONRenderer()
+        chunk_size = view.export_chunk_size
+
+        async def stream():
+            chunk = []
+            rows = serializer.get_values(queryset).aiterator(chunk_size=chunk_size)
+            async for row in rows:
+                chunk.append(serializer.flatten_values(row))
+                if len(chunk) >= chunk_size:
+                    yield b"".join(renderer.stream(chunk))
+                    chunk = []
+            if chunk:
+                yield b"".join(renderer.stream(chunk))
+
+        return StreamingHttpResponse(stream(), content_type=renderer.media_type)
+
+    async def post(self, request, *args, **kwargs):
+        permission = views.IsAuthorizedSubnetOrReadOnly()
+        if not permission.has_permission(request, self):
+            return json_response(
+                {"detail": permission.message}, status_code=status.HTTP_403_FORBIDDEN
+            )
+        view = self.get_sync_view(request)
+        if not view.deduplicate or (view.spooled and spool.get_spool() is not None):
+            return await self.fallback(request, *args, **kwargs)
+        try:
+            data = view.request.data
+        except ParseError as err:
+            return json_response(
+                {"detail": err.detail}, status_code=status.HTTP_400_BAD_REQUEST
+            )
+        convert = ingest.RecordConverter(view.get_serializer_class())
+        model = convert.model
+        if not isinstance(data, list):
+            return await self.create_one(view, convert, data)
+
+        async def insert():
+            await convert.aresolve(data)
+            results, instances = view.validate_many(model, data, convert)
+            inserted = await sync_to_async(self.insert)(view, model, instances)
+            return results, instances, inserted
+
+        try:
+            results, instances, inserted = await self.retry_stale(convert, insert)
+        except IntegrityError as err:
+            logger.warning("batch insert failed, inserting one at a time: %s", err)
+            await convert.aresolve(data)
+            results, instances = view.validate_many(model, data, convert)
+            instances, inserted = await sync_to_async(view.insert_each)(
+                model, results, instances
+            )
+        response = view.batch_response(results, instances, inserted)
+        return json_response(response.data, status_code=response.status_code)
+
+    async def create_one(self, view, convert, record):
+        if not isinstance(record, dict):
+            return json_response(
+                ["not an object"], status_code=status.HTTP_400_BAD_REQUEST
+            )
+        model = convert.model
+
+        async def insert():
+            await convert.aresolve([record])
+            instance = convert(record)
+            return instance, await sync_to_async(self.insert)(view, model, [instance])
+
+        try:
+            instance, inserted = await self.retry_stale(convert, insert)
+        except ValidationError as err:
+            return json_response(err.detail, status_code=status.HTTP_400_BAD_REQUEST)
+        except IntegrityError as err:
+            logger.warning("insert failed: %s", err)
+            return json_response(
+                {"detail": views.conflict_detail(err)},
+                status_code=status.HTTP_409_CONFLICT,
+            )
+        serializer = view.get_serializer()
+        if inserted:
+            return json_response(
+                serializer.to_representation(instance),
+                status_code=status.HTTP_201_CREATED,
+            )
+        unique_fields = [
+            model._meta.get_field(f) for f in model._meta.unique_together[0]
+        ]
+        instance.pk = await (
+            model.objects.filter(
+                **{f.attname: getattr(instance, f.attname) for f in unique_fields}
+            )
+            .values_list("pk", flat=True)
+            .afirst()
+        )
+        return json_response(
+            {**serializer.to_representation(instance), "already_present": True}
+        )
+
+    async def retry_stale(self, convert, func):
+        """Async counterpart of SlugCache.retry_stale()"""
+        try:
+            return await func()
+        except IntegrityError as err:
+            if not is_foreign_key_violation(err):
+                raise
+        slug_cache.clear()
+        convert.related.clear()
+        return await func()
+
+    @staticmethod
+    def insert(view, model, instances):
+        with transaction.atomic():
+            return view.insert_many(model, instances)
+
+
+class AsyncEventList(AsyncRecordList):
+    view_class = views.EventList
+
+
+class AsyncTrialList(AsyncRecordList):
+    view_class = views.TrialList
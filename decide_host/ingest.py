@@ -0,0 +1,275 @@
+# -*- mode: python -*-
+"""Bulk loading of events and trials from line-delimited JSON"""
+
+import gzip
+import itertools
+import json
+import logging
+
+from django.db import IntegrityError, connections, router, transaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import SkipField, empty
+from rest_framework.relations import RelatedField
+
+from decide_host import serializers, signals
+from decide_host.lookups import slug_cache
+
+logger = logging.getLogger(__name__)
+
+# the serializers used to convert spooled records, by kind
+SPOOL_SERIALIZERS = {
+    "event": serializers.EventSerializer,
+    "trial": serializers.TrialSerializer,
+}
+
+
+def open_records(path):
+    """Opens a jsonl file for reading, decompressing it if the name ends in .gz"""
+    if str(path).endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path)
+
+
+def insert_ignore_conflicts(model, objs):
+    """Inserts objs, skipping any that conflict with an existing record.
+
+    Unlike bulk_create(ignore_conflicts=True), this returns the list of objects
+    that were actually inserted, with their primary keys set, so that the
+    running totals aren't updated for duplicates. The recorded signal is sent
+    for the inserted objects. Should be called in a transaction.
+    """
+    if not objs:
+        return []
+    opts = model._meta
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    fields = [f for f in opts.concrete_fields if not f.primary_key]
+    unique = [opts.get_field(name) for name in opts.unique_together[0]]
+    row = "({})".format(", ".join(["%s"] * len(fields)))
+    params = [
+        f.get_db_prep_save(getattr(obj, f.attname), connection)
+        for obj in objs
+        for f in fields
+    ]
+    sql = "INSERT INTO {} ({}) VALUES {} ON CONFLICT DO NOTHING RETURNING {}".format(
+        qn(opts.db_table),
+        ", ".join(qn(f.column) for f in fields),
+        ", ".join([row] * len(objs)),
+        ", ".join(qn(f.column) for f in [opts.pk, *unique]),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        returned = {tuple(pk_and_key[1:]): pk_and_key[0] for pk_and_key in cursor}
+    inserted = []
+    for obj in objs:
+        # a key that appears more than once in objs was only inserted once
+        pk = returned.pop(tuple(getattr(obj, f.attname) for f in unique), None)
+        if pk is not None:
+            obj.pk = pk
+            obj._state.adding = False
+            obj._state.db = connection.alias
+            inserted.append(obj)
+    signals.send_recorded(model, inserted)
+    return inserted
+
+
+def slug_value(value):
+    """Returns the slug a value in a record stands for, or None if it isn't one.
+
+    Numbers are converted to strings, as the database field would do.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int | float):
+        return str(value)
+    return None
+
+
+class RecordConverter:
+    """Converts records to unsaved model instances using a serializer's fields.
+
+    The result is the same as serializer.to_internal_value(), but related
+    objects are only looked up once per distinct slug, which is most of the
+    cost of validating a record.
+    """
+
+    def __init__(self, serializer_class):
+        serializer = serializer_class()
+        self.model = serializer.Meta.model
+        self.flatten = serializer.Meta.flatten
+        self.fields = {
+            name: field
+            for name, field in serializer.fields.items()
+            if not field.read_only
+        }
+        self.ignored = set(serializer.Meta.fields) - set(self.fields)
+        self.related = {}
+
+    def __call__(self, record):
+        values = {}
+        nested = {}
+        errors = {}
+        for key, value in record.items():
+            field = self.fields.get(key)
+            if field is None:
+                if key not in self.ignored:
+                    nested[key] = value
+                continue
+            try:
+                if isinstance(field, RelatedField) and value is not None:
+                    slug = slug_value(value)
+                    if slug is None:
+                        field.fail("invalid")
+                    values[field.source] = self.lookup(field, slug)
+                else:
+                    values[field.source] = field.run_validation(value)
+            except ValidationError as err:
+                errors[key] = err.detail
+        for name, field in self.fields.items():
+            if name in record:
+                continue
+            try:
+                values[field.source] = field.run_validation(empty)
+            except ValidationError as err:
+                errors[name] = err.detail
+            except SkipField:
+                pass
+        if errors:
+            raise ValidationError(errors)
+        values.setdefault(self.flatten, {}).update(nested)
+        return self.model(**values)
+
+    async def aresolve(self, records):
+        """Looks up (or creates) the related objects named in records.
+
+        This uses the async ORM, so that an async view can then call the
+        converter without blocking on the database.
+        """
+        for name, field in self.fields.items():
+            if not isinstance(field, RelatedField):
+                continue
+            queryset = field.get_queryset()
+            for record in records:
+                slug = (
+                    slug_value(record.get(name)) if isinstance(record, dict) else None
+                )
+                if slug is None or (name, slug) in self.related:
+                    continue
+                instance = slug_cache.get(queryset.model, slug)
+                if instance is None:
+                    instance, _ = await queryset.aget_or_create(
+                        **{field.slug_field: slug}
+                    )
+                    # async views run in autocommit mode, so this is committed
+                    slug_cache.set(queryset.model, slug, instance)
+                self.related[(name, slug)] = instance
+
+    def retry_stale(self, func, *args):
+        """Like SlugCache.retry_stale(), also forgetting the objects looked up here"""
+
+        def call():
+            try:
+                return func(*args)
+            except IntegrityError:
+                self.related.clear()
+                raise
+
+        return slug_cache.retry_stale(call)
+
+    def lookup(self, field, slug):
+        key = (field.field_name, slug)
+        try:
+            return self.related[key]
+        except KeyError:
+            instance = self.related[key] = field.run_validation(slug)
+            return instance
+
+
+def load_records(serializer_class, records, batch_size, defaults=None):
+    """Validates records and inserts them in batches, skipping duplicates.
+
+    `records` is an iterable of dicts in the same format that is POSTed to the
+    API, and `defaults` are added to each one (e.g. to set the controller). The
+    unique-together check that the serializer would normally do is left to the
+    database. Yields (n_inserted, n_duplicates, errors) for each batch, where
+    errors is a list of (record number, validation errors).
+    """
+    model = serializer_class.Meta.model
+    convert = RecordConverter(serializer_class)
+    records = enumerate(records)
+
+    def insert(batch):
+        objs = []
+        errors = []
+        for i, record in batch:
+            if not isinstance(record, dict):
+                errors.append((i, "not a JSON object"))
+                continue
+            if defaults:
+                record.update(defaults)
+            try:
+                objs.append(convert(record))
+            except ValidationError as err:
+                errors.append((i, err.detail))
+        with transaction.atomic(using=router.db_for_write(model)):
+            inserted = insert_ignore_conflicts(model, objs)
+        return len(inserted), len(objs) - len(inserted), errors
+
+    while batch := list(itertools.islice(records, batch_size)):
+        yield convert.retry_stale(insert, batch)
+
+
+def read_jsonl(path):
+    """Yields the records in a (possibly gzipped) jsonl file.
+
+    Blank lines are skipped, and None is yielded for lines that aren't valid JSON.
+    """
+    with open_records(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def flush_spool(spool, batch_size):
+    """Moves up to batch_size of the oldest records in spool into the database.
+
+    Records are removed from the spool after the transaction that inserts them
+    commits. If the process dies in between, they will be inserted again the
+    next time, which is harmless because duplicates are skipped. Records that
+    fail validation are logged and dropped. Returns (n_inserted, n_duplicates,
+    n_invalid).
+    """
+    rows = spool.peek(batch_size)
+    if not rows:
+        return 0, 0, 0
+    by_kind = {}
+    for pk, kind, record in rows:
+        by_kind.setdefault(kind, []).append((pk, record))
+
+    def insert():
+        n_inserted = n_duplicates = n_invalid = 0
+        with transaction.atomic():
+            for kind, records in by_kind.items():
+                convert = RecordConverter(SPOOL_SERIALIZERS[kind])
+                objs = []
+                for pk, record in records:
+                    try:
+                        objs.append(convert(record))
+                    except ValidationError as err:
+                        logger.warning(
+                            "dropped spooled %s %d: %s", kind, pk, err.detail
+                        )
+                        n_invalid += 1
+                inserted = insert_ignore_conflicts(convert.model, objs)
+                n_inserted += len(inserted)
+                n_duplicates += len(objs) - len(inserted)
+        return n_inserted, n_duplicates, n_invalid
+
+    counts = slug_cache.retry_stale(insert)
+    spool.remove(rows[-1][0])
+    return counts
@@ -0,0 +1,118 @@
+# -*- mode: python -*-
+"""In-process cache of Controller, Component, and Subject objects by slug"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+# SQLSTATE for a foreign key violation
+FOREIGN_KEY_VIOLATION = "23503"
+
+
+def is_foreign_key_violation(err):
+    cause = err.__cause__
+    code = getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+    return code == FOREIGN_KEY_VIOLATION
+
+
+class SlugCache:
+    """A bounded, least-recently-used map from (model, slug) to model instance.
+
+    There are only a few dozen controllers, components and subjects, and they
+    almost never change, so looking them up on every ingested record is a
+    waste. Entries are shared by all the threads in a worker process. They are
+    dropped when the underlying row is saved or deleted in this process (see
+    `decide_host.signals`) and expire after a timeout. Rows deleted by other
+    processes (e.g. by merge_subjects or the admin) can still be cached until
+    then, so inserts that use cached objects should go through `retry_stale()`.
+
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        return getattr(settings, "DECIDE_HOST", {}).get("SLUG_CACHE_SIZE", 1024)
+
+    @property
+    def timeout(self):
+        return getattr(settings, "DECIDE_HOST", {}).get("SLUG_CACHE_TIMEOUT", 300)
+
+    def get(self, model, slug):
+        key = (model._meta.label, slug)
+        with self._lock:
+            try:
+                instance, expires = self._entries[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return instance
+
+    def set(self, model, slug, instance):
+        if self.maxsize <= 0:
+            return
+        key = (model._meta.label, slug)
+        with self._lock:
+            self._entries[key] = (instance, time.monotonic() + self.timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, model, pk):
+        """Remove all entries for the object of type `model` with primary key `pk`"""
+        label = model._meta.label
+        with self._lock:
+            stale = [
+                key
+                for key, (instance, _) in self._entries.items()
+                if key[0] == label and instance.pk == pk
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def retry_stale(self, func, *args):
+        """Calls func(*args), which should look up slugs and insert records.
+
+        If that fails because a cached object no longer exists, the cache is
+        cleared and func is called again, so the slugs are looked up afresh.
+        func must run its own transaction, so the first attempt is rolled back.
+        """
+        try:
+            return func(*args)
+        except IntegrityError as err:
+            if not is_foreign_key_violation(err):
+                raise
+            self.clear()
+        return func(*args)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_create(self, queryset, slug_field, slug):
+        """Look up an object by slug, creating it if needed.
+
+        Objects are only added to the cache once the current transaction has
+        committed, so that a rollback can't leave a dangling primary key.
+
+        """
+        model = queryset.model
+        instance = self.get(model, slug)
+        if instance is None:
+            instance = queryset.get_or_create(**{slug_field: slug})[0]
+            transaction.on_commit(lambda: self.set(model, slug, instance))
+        return instance
+
+
+slug_cache = SlugCache()
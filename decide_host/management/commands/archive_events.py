@@ -0,0 +1,151 @@
+# -*- mode: python -*-
+"""Move old events out of the database into compressed archive files"""
+
+import datetime
+import gzip
+import json
+import os
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from decide_host.models import Component, Controller, Event, EventDailySummary
+
+AGE_RE = re.compile(r"^(\d+)([dw]?)$")
+
+
+def parse_age(value):
+    """Parses an age like 30, 30d or 6w (days or weeks) into a timedelta"""
+    match = AGE_RE.match(str(value).strip())
+    if match is None:
+        raise CommandError(f"invalid age {value!r} (use e.g. 30d or 6w)")
+    n, unit = match.groups()
+    return datetime.timedelta(days=int(n) * (7 if unit == "w" else 1))
+
+
+class Command(BaseCommand):
+    help = (
+        "archive events older than a cutoff to gzipped jsonl files (one per "
+        "controller) and delete them, keeping daily totals for each component"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            help="archive events older than this many days (e.g. 30d or 6w). "
+            'Defaults to DECIDE_HOST["EVENT_RETENTION"]',
+        )
+        parser.add_argument(
+            "--archive", metavar="DIR", help="directory for the archive files"
+        )
+        parser.add_argument(
+            "--no-archive",
+            action="store_true",
+            help="delete the events without writing them anywhere",
+        )
+        parser.add_argument(
+            "-c",
+            "--controller",
+            action="append",
+            help="only archive events from this controller (may be repeated)",
+        )
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="number of events to delete per transaction (default %(default)s)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="count the events that would be archived",
+        )
+
+    def handle(self, *args, **options):
+        age = options["older_than"] or getattr(settings, "DECIDE_HOST", {}).get(
+            "EVENT_RETENTION"
+        )
+        if age is None:
+            raise CommandError('use --older-than or set DECIDE_HOST["EVENT_RETENTION"]')
+        if not (options["archive"] or options["no_archive"] or options["dry_run"]):
+            raise CommandError("use --archive DIR, or --no-archive to discard events")
+        cutoff = timezone.now() - parse_age(age)
+        self.stdout.write(f"- archiving events before {cutoff.isoformat()}")
+        controllers = Controller.objects.all()
+        if options["controller"]:
+            controllers = controllers.filter(name__in=options["controller"])
+        self.components = dict(Component.objects.values_list("id", "name"))
+        for controller in controllers:
+            events = controller.event_set.filter(time__lt=cutoff)
+            if options["dry_run"]:
+                self.stdout.write(f"- {controller.name}: {events.count()} event(s)")
+                continue
+            path = None
+            if options["archive"]:
+                path = (
+                    Path(options["archive"])
+                    / f"{controller.name}_before_{cutoff:%Y%m%d}.jsonl.gz"
+                )
+            n = self.archive_controller(controller, events, path, options)
+            if n:
+                where = f" to {path}" if path else ""
+                self.stdout.write(f"- {controller.name}: archived {n} event(s){where}")
+
+    def archive_controller(self, controller, events, path, options):
+        """Archives and deletes events in batches, oldest first"""
+        fp = None
+        total = 0
+        try:
+            while True:
+                batch = list(
+                    events.order_by("time").values(
+                        "id", "addr", "name", "time", "data", "schema__keys"
+                    )[: options["batch_size"]]
+                )
+                if not batch:
+                    return total
+                if path is not None:
+                    if fp is None:
+                        fp = open(path, "ab")
+                    self.write_batch(fp, controller, batch)
+                with transaction.atomic():
+                    EventDailySummary.objects.record(batch)
+                    # the time filter lets PostgreSQL skip irrelevant partitions
+                    Event.objects.filter(
+                        id__in=[event["id"] for event in batch],
+                        time__lte=batch[-1]["time"],
+                    ).delete()
+                total += len(batch)
+                if options["verbosity"] > 1:
+                    self.stdout.write(f"  - {controller.name}: {total} event(s)")
+        finally:
+            if fp is not None:
+                fp.close()
+
+    def write_batch(self, fp, controller, batch):
+        """Appends a batch to the archive as a gzip member and syncs it to disk.
+
+        Events are only deleted once they're safely in the file. If the
+        command is interrupted in between, the next run writes them again, but
+        import_events skips the duplicates.
+        """
+        with gzip.GzipFile(fileobj=fp, mode="wb") as gz:
+            for event in batch:
+                data = event["data"]
+                if event["schema__keys"] is not None:
+                    data = dict(zip(event["schema__keys"], data, strict=True))
+                record = {
+                    "addr": controller.name,
+                    "name": self.components[event["name"]],
+                    # DjangoJSONEncoder would cut the time to milliseconds
+                    "time": event["time"].isoformat(),
+                    **data,
+                }
+                gz.write(json.dumps(record).encode() + b"\n")
+        fp.flush()
+        os.fsync(fp.fileno())
@@ -0,0 +1,153 @@
+# -*- mode: python -*-
+"""Compare the throughput of the sync and async event list views"""
+
+import asyncio
+import itertools
+import os
+import statistics
+import threading
+import time
+
+from asgiref.sync import ThreadSensitiveContext, async_to_sync
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncRequestFactory, RequestFactory
+from django.utils import timezone
+
+from decide_host import async_views, views
+from decide_host.models import Component, Controller, Event
+
+
+class Command(BaseCommand):
+    help = (
+        "benchmark event uploads and keyset-paginated lists with the sync and async "
+        "views. Writes to the configured database, and removes the records afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-n",
+            "--requests",
+            type=int,
+            default=500,
+            help="number of requests of each kind (default %(default)s)",
+        )
+        parser.add_argument(
+            "-c",
+            "--concurrency",
+            type=int,
+            default=10,
+            help="number of concurrent clients (default %(default)s)",
+        )
+        parser.add_argument(
+            "-b",
+            "--batch",
+            type=int,
+            default=1,
+            help="number of events per upload (default %(default)s)",
+        )
+        parser.add_argument(
+            "--keep", action="store_true", help="don't delete the uploaded events"
+        )
+
+    def handle(self, *args, **options):
+        self.addr = f"bench-{os.getpid()}"
+        self.batch = options["batch"]
+        self.start_time = timezone.now()
+        # each upload gets a distinct set of timestamps
+        self.uploads = itertools.count()
+        n = options["requests"]
+        concurrency = options["concurrency"]
+        self.stdout.write(
+            f"{n} requests of each kind, {concurrency} concurrent clients, "
+            f"{self.batch} event(s) per upload"
+        )
+        self.stdout.write("view\trequest\treq/s\tp50 ms\tp95 ms\terrors")
+        try:
+            for label, run in (("sync", self.run_sync), ("async", self.run_async)):
+                for kind in ("post", "get"):
+                    elapsed, results = run(kind, n, concurrency)
+                    self.report(label, kind, elapsed, results)
+        finally:
+            if not options["keep"]:
+                self.cleanup()
+
+    def make_request(self, factory, kind):
+        if kind == "get":
+            return factory.get("/", {"addr": self.addr, "cursor": ""})
+        i = next(self.uploads)
+        records = [
+            {
+                "addr": self.addr,
+                "name": self.addr,
+                "time": (self.start_time.timestamp() + (i * self.batch + j) * 1e-3),
+                "state": "bench",
+            }
+            for j in range(self.batch)
+        ]
+        data = records if self.batch > 1 else records[0]
+        return factory.post("/", data, content_type="application/json")
+
+    def run_sync(self, kind, n, concurrency):
+        """Calls the sync view from a pool of threads, like a threaded WSGI server"""
+        view = views.EventList.as_view()
+        factory = RequestFactory()
+        counter = itertools.count()
+        results = []
+
+        def client():
+            try:
+                while next(counter) < n:
+                    request = self.make_request(factory, kind)
+                    start = time.perf_counter()
+                    response = view(request)
+                    response.render()
+                    results.append((time.perf_counter() - start, response.status_code))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, results
+
+    def run_async(self, kind, n, concurrency):
+        """Calls the async view from concurrent tasks in one event loop"""
+        view = async_views.AsyncEventList.as_view()
+        factory = AsyncRequestFactory()
+        counter = itertools.count()
+        results = []
+
+        async def client():
+            # like a connection to an ASGI server, each client gets its own
+            # thread for database access
+            async with ThreadSensitiveContext():
+                while next(counter) < n:
+                    request = self.make_request(factory, kind)
+                    start = time.perf_counter()
+                    response = await view(request)
+                    results.append((time.perf_counter() - start, response.status_code))
+
+        async def main():
+            start = time.perf_counter()
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+            return time.perf_counter() - start
+
+        return async_to_sync(main)(), results
+
+    def report(self, label, kind, elapsed, results):
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        errors = sum(code >= 400 for _, code in results)
+        p50 = statistics.median(latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        self.stdout.write(
+            f"{label}\t{kind}\t{len(results) / elapsed:.0f}\t{p50:.1f}\t{p95:.1f}\t{errors}"
+        )
+
+    def cleanup(self):
+        Event.objects.filter(addr__name=self.addr).delete()
+        Controller.objects.filter(name=self.addr).delete()
+        Component.objects.filter(name=self.addr).delete()
@@ -0,0 +1,399 @@
+# -*- mode: python -*-
+"""Measure ingest and query performance on a synthetic workload"""
+
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.utils import timezone
+
+from decide_host import pagination, views
+from decide_host.models import Controller, Subject
+
+COMPONENTS = {
+    "house_light": lambda rng: {"brightness": rng.choice((0, 100, 255))},
+    "hopper": lambda rng: {"up": rng.random() < 0.5},
+    "peck_keys": lambda rng: {
+        key: rng.random() < 0.1 for key in ("peck_left", "peck_center", "peck_right")
+    },
+    "cue_left": lambda rng: {"state": rng.choice(("off", "red", "green", "blue"))},
+    "cue_right": lambda rng: {"state": rng.choice(("off", "red", "green", "blue"))},
+    "sound": lambda rng: {
+        "state": rng.choice(("stopped", "playing")),
+        "stimulus": f"st{rng.randrange(200)}",
+    },
+}
+PROCEDURES = ("gng", "2ac", "lights", "shape")
+RESPONSES = ("peck_left", "peck_right", "timeout")
+
+
+class Command(BaseCommand):
+    help = (
+        "generate a synthetic workload of events and trials from many controllers and "
+        "subjects, and time imports, uploads, paging, aggregates and data__ filters. "
+        "Runs in a throwaway test database, which is destroyed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--controllers",
+            type=int,
+            default=8,
+            help="number of controllers (default %(default)s)",
+        )
+        parser.add_argument(
+            "--subjects",
+            type=int,
+            default=40,
+            help="number of subjects (default %(default)s)",
+        )
+        parser.add_argument(
+            "--events",
+            type=int,
+            default=1_000_000,
+            help="number of events to import (default %(default)s)",
+        )
+        parser.add_argument(
+            "--trials",
+            type=int,
+            default=500_000,
+            help="number of trials to import (default %(default)s)",
+        )
+        parser.add_argument(
+            "--uploads",
+            type=int,
+            default=200,
+            help="number of event uploads to POST (default %(default)s)",
+        )
+        parser.add_argument(
+            "-b",
+            "--batch",
+            type=int,
+            default=50,
+            help="number of events per upload (default %(default)s)",
+        )
+        parser.add_argument(
+            "--page-size",
+            type=int,
+            default=100,
+            help="records per page in list requests (default %(default)s)",
+        )
+        parser.add_argument(
+            "--pages",
+            type=int,
+            default=50,
+            help="number of keyset pages to follow (default %(default)s)",
+        )
+        parser.add_argument(
+            "-r",
+            "--repeat",
+            type=int,
+            default=10,
+            help="number of times to run each query (default %(default)s)",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=1, help="random seed (default %(default)s)"
+        )
+        parser.add_argument("--json", help="also write the results to this file")
+        parser.add_argument(
+            "--baseline",
+            help="compare the median times with results saved by --json on the same "
+            "machine, and fail if any benchmark is more than --max-regression times "
+            "slower",
+        )
+        parser.add_argument(
+            "--max-regression",
+            type=float,
+            default=2.0,
+            help="largest allowed ratio of median time to baseline (default %(default)s)",
+        )
+        parser.add_argument(
+            "--keepdb",
+            action="store_true",
+            help="keep the test database (and reuse it if it exists)",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as fp:
+                baseline = json.load(fp)
+            if baseline["options"] != self.settings():
+                # e.g. the defaults changed since the baseline was run
+                self.stderr.write(
+                    f"not comparing with {options['baseline']}, which was run with "
+                    f"different options: {baseline['options']}"
+                )
+                baseline = None
+        self.rng = random.Random(options["seed"])
+        self.results = {}
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, keepdb=options["keepdb"]
+        )
+        try:
+            page_size = options["page_size"]
+            with contextlib.ExitStack() as stack:
+                for paginator in (
+                    pagination.LinkHeaderPaginationByTimestamp,
+                    pagination.KeysetPaginationByTimestamp,
+                    pagination.ChangeFeedPagination,
+                ):
+                    stack.enter_context(
+                        mock.patch.object(paginator, "page_size", page_size)
+                    )
+                self.run()
+        finally:
+            connection.creation.destroy_test_db(
+                old_name, verbosity=0, keepdb=options["keepdb"]
+            )
+        if options["json"]:
+            with open(options["json"], "w") as fp:
+                json.dump(
+                    {"options": self.settings(), "results": self.results}, fp, indent=2
+                )
+        if baseline is not None:
+            self.compare(baseline["results"])
+
+    def settings(self):
+        keys = ("controllers", "subjects", "events", "trials", "uploads", "batch")
+        return {key: self.options[key] for key in (*keys, "page_size", "seed")}
+
+    def run(self):
+        opts = self.options
+        self.controllers = [f"rig-{i}" for i in range(opts["controllers"])]
+        self.subjects = [f"bird_{i:03}" for i in range(opts["subjects"])]
+        self.start = timezone.now() - datetime.timedelta(days=90)
+        self.trial_subjects = set()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.stdout.write("generating workload")
+            event_file = Path(tmpdir) / "events.jsonl.gz"
+            self.write_jsonl(event_file, self.generate_events(opts["events"]))
+            trial_files = []
+            for i, addr in enumerate(self.controllers):
+                path = Path(tmpdir) / f"trials-{addr}.jsonl.gz"
+                n = opts["trials"] // len(self.controllers)
+                if i < opts["trials"] % len(self.controllers):
+                    n += 1
+                self.write_jsonl(path, self.generate_trials(addr, n))
+                trial_files.append((addr, PROCEDURES[i % len(PROCEDURES)], path))
+            self.stdout.write("benchmark\tn\tmedian ms\tp95 ms\trate")
+            self.bench_imports(event_file, trial_files)
+        self.bench_uploads()
+        self.bench_queries()
+
+    def write_jsonl(self, path, records):
+        with gzip.open(path, "wt") as fp:
+            for record in records:
+                fp.write(json.dumps(record) + "\n")
+
+    def timestamps(self, n):
+        """Increasing timestamps spread over the last 90 days"""
+        spacing = 90 * 86400 / max(n, 1)
+        t = self.start.timestamp()
+        for _ in range(n):
+            t += self.rng.expovariate(1 / spacing)
+            yield datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc)
+
+    def generate_events(self, n):
+        rng = self.rng
+        components = list(COMPONENTS)
+        for time_ in self.timestamps(n):
+            name = rng.choice(components)
+            yield {
+                "addr": rng.choice(self.controllers),
+                "name": name,
+                "time": time_.isoformat(),
+                **COMPONENTS[name](rng),
+            }
+
+    def generate_trials(self, addr, n):
+        rng = self.rng
+        # each controller runs a few subjects
+        subjects = rng.sample(self.subjects, min(3, len(self.subjects)))
+        self.trial_subjects.update(subjects)
+        for i, time_ in enumerate(self.timestamps(n)):
+            response = rng.choice(RESPONSES)
+            yield {
+                "subject": rng.choice(subjects),
+                "time": time_.isoformat(),
+                "trial": i,
+                "experiment": "bench",
+                "stimulus": f"st{rng.randrange(200)}",
+                "category": rng.choice(("S+", "S-")),
+                "response": response,
+                "correct": None if response == "timeout" else rng.random() < 0.7,
+                "rtime": None if response == "timeout" else rng.randrange(200_000, 6e6),
+                "result": rng.choice(("feed", "punish", "none")),
+                "correction": 0,
+            }
+
+    def report(self, label, seconds, rate=None):
+        """Records a list of timings (in seconds) and an optional rate"""
+        latencies = sorted(s * 1000 for s in seconds)
+        result = {
+            "n": len(latencies),
+            "median_ms": statistics.median(latencies),
+            "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+        }
+        rate_text = ""
+        if rate is not None:
+            result["rate"] = rate
+            rate_text = f"{rate:.0f}/s"
+        self.results[label] = result
+        self.stdout.write(
+            f"{label}\t{result['n']}\t{result['median_ms']:.1f}\t"
+            f"{result['p95_ms']:.1f}\t{rate_text}"
+        )
+
+    def compare(self, baseline):
+        """Fails if any median time is too far above the baseline"""
+        limit = self.options["max_regression"]
+        self.stdout.write("benchmark\tbaseline ms\tmedian ms\tratio")
+        slower = []
+        for label, result in self.results.items():
+            if label not in baseline:
+                continue
+            before = baseline[label]["median_ms"]
+            ratio = result["median_ms"] / before
+            self.stdout.write(
+                f"{label}\t{before:.1f}\t{result['median_ms']:.1f}\t{ratio:.2f}"
+            )
+            if ratio > limit:
+                slower.append(f"{label} ({ratio:.2f}x)")
+        if slower:
+            raise CommandError(
+                f"slower than {limit}x the baseline: {', '.join(slower)}"
+            )
+
+    def bench_imports(self, event_file, trial_files):
+        start = time.perf_counter()
+        call_command("import_events", str(event_file), stdout=io.StringIO())
+        elapsed = time.perf_counter() - start
+        self.report("import_events", [elapsed], self.options["events"] / elapsed)
+        start = time.perf_counter()
+        for addr, procedure, path in trial_files:
+            call_command(
+                "import_trials",
+                "-a",
+                addr,
+                "-n",
+                procedure,
+                str(path),
+                stdout=io.StringIO(),
+            )
+        elapsed = time.perf_counter() - start
+        self.report("import_trials", [elapsed], self.options["trials"] / elapsed)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def bench_uploads(self):
+        view = views.EventList.as_view()
+        factory = RequestFactory(SERVER_NAME="localhost")
+        batch = self.options["batch"]
+        latencies = []
+        events = self.generate_events(self.options["uploads"] * batch)
+        for _ in range(self.options["uploads"]):
+            records = [next(events) for _ in range(batch)]
+            request = factory.post("/", records, content_type="application/json")
+            start = time.perf_counter()
+            response = view(request)
+            response.render()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise CommandError(f"upload failed: {response.status_code}")
+        rate = len(latencies) * batch / sum(latencies) if latencies else 0
+        self.report("POST events", latencies, rate)
+
+    def time_view(self, label, view, params, **kwargs):
+        factory = RequestFactory(SERVER_NAME="localhost")
+        latencies = []
+        for _ in range(self.options["repeat"]):
+            request = factory.get("/", params)
+            start = time.perf_counter()
+            response = view(request, **kwargs)
+            response.render()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise CommandError(f"{label}: status {response.status_code}")
+        self.report(label, latencies)
+
+    def time_query(self, label, queryset):
+        latencies = []
+        for _ in range(self.options["repeat"]):
+            start = time.perf_counter()
+            list(queryset.all())
+            latencies.append(time.perf_counter() - start)
+        self.report(label, latencies)
+
+    def bench_queries(self):
+        trial_list = views.TrialList.as_view()
+        event_list = views.EventList.as_view()
+        subject = min(self.trial_subjects)
+        self.time_view("trials, first page", trial_list, {})
+        self.time_view("trials, keyset first page", trial_list, {"cursor": ""})
+        self.bench_keyset_pages(trial_list)
+        middle = max(1, self.options["trials"] // self.options["page_size"] // 2)
+        self.time_view("trials, middle page", trial_list, {"page": middle})
+        self.time_view(
+            "subject trials",
+            views.SubjectTrialList.as_view(),
+            {"cursor": ""},
+            subject=subject,
+        )
+        self.time_view(
+            "trials, data__ filters",
+            trial_list,
+            {
+                "subject": subject,
+                "data__correct": "true",
+                "data__rtime__gt": "1000000",
+            },
+        )
+        self.time_view(
+            "events, data__ filters",
+            event_list,
+            {"addr": self.controllers[0], "data__state": "green"},
+        )
+        self.time_query("controllers with_counts", Controller.objects.with_counts())
+        self.time_query("subjects with_counts", Subject.objects.with_counts())
+        self.time_view("controller list", views.ControllerList.as_view(), {})
+        self.time_view("subject list", views.SubjectList.as_view(), {})
+
+    def bench_keyset_pages(self, view):
+        """Follows next links from the most recent trials back through the history"""
+        factory = RequestFactory(SERVER_NAME="localhost")
+        latencies = []
+        request = factory.get("/", {"cursor": ""})
+        for _ in range(self.options["pages"]):
+            start = time.perf_counter()
+            response = view(request)
+            response.render()
+            latencies.append(time.perf_counter() - start)
+            links = pagination_links(response)
+            if "next" not in links:
+                break
+            request = factory.get(links["next"])
+        self.report("trials, keyset pages", latencies)
+
+
+def pagination_links(response):
+    links = {}
+    for link in response.get("Link", "").split(", "):
+        if link:
+            uri, rel = link.split("; ")
+            links[rel[5:-1]] = uri[1:-1]
+    return links
@@ -0,0 +1,139 @@
+# -*- mode: python -*-
+"""Store the data of old events as arrays of values instead of documents"""
+
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from decide_host.management.commands.archive_events import parse_age
+from decide_host.models import Event, EventSchema
+
+
+class Command(BaseCommand):
+    help = (
+        "compact the data of events older than a cutoff, storing the values in the "
+        "order of a per-component list of keys instead of repeating the keys in "
+        "every row. The API output is unchanged."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            help="compact events older than this many days (e.g. 7d or 2w). "
+            'Defaults to DECIDE_HOST["EVENT_COMPACT_AFTER"]',
+        )
+        parser.add_argument(
+            "-c",
+            "--controller",
+            action="append",
+            help="only compact events from this controller (may be repeated)",
+        )
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="number of events to update per transaction (default %(default)s)",
+        )
+        parser.add_argument(
+            "--expand",
+            action="store_true",
+            help="store compacted events as documents again",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="count the events that would be changed",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        events = Event.objects.all()
+        if options["controller"]:
+            events = events.filter(addr__name__in=options["controller"])
+        if options["expand"]:
+            events = events.filter(schema__isnull=False)
+            self.stdout.write("- expanding compacted events")
+        else:
+            age = options["older_than"] or getattr(settings, "DECIDE_HOST", {}).get(
+                "EVENT_COMPACT_AFTER"
+            )
+            if age is None:
+                raise CommandError(
+                    'use --older-than or set DECIDE_HOST["EVENT_COMPACT_AFTER"]'
+                )
+            cutoff = timezone.now() - parse_age(age)
+            events = events.filter(schema__isnull=True, time__lt=cutoff)
+            self.stdout.write(f"- compacting events before {cutoff.isoformat()}")
+        if options["dry_run"]:
+            self.stdout.write(f"- {events.count()} event(s)")
+            return
+        self.schemas = {}
+        after = 0
+        total = size_before = size_after = 0
+        while True:
+            batch = list(
+                events.filter(id__gt=after)
+                .order_by("id")
+                .values_list("id", "name", "data", "schema__keys")[
+                    : options["batch_size"]
+                ]
+            )
+            if not batch:
+                break
+            after = batch[-1][0]
+            rows = [self.convert(*event) for event in batch]
+            rows = [row for row in rows if row is not None]
+            with transaction.atomic():
+                n = self.update(rows)
+            total += n
+            for _, _, data, _ in batch:
+                size_before += len(json.dumps(data))
+            size_after += sum(len(data) for _, _, data in rows)
+            if options["verbosity"] > 1:
+                self.stdout.write(f"  - {total} event(s)")
+        saved = f"; data {size_before} -> {size_after} bytes" if total else ""
+        self.stdout.write(f"- updated {total} event(s){saved}")
+
+    def get_schema_id(self, component_id, keys):
+        try:
+            return self.schemas[(component_id, keys)]
+        except KeyError:
+            schema, _ = EventSchema.objects.get_or_create(
+                component_id=component_id, keys=list(keys)
+            )
+            self.schemas[(component_id, keys)] = schema.id
+            return schema.id
+
+    def convert(self, event_id, component_id, data, keys):
+        """Returns (id, schema id, data as JSON) for the new form of an event"""
+        if self.options["expand"]:
+            return event_id, None, json.dumps(dict(zip(keys, data, strict=True)))
+        if not isinstance(data, dict) or not data:
+            # nothing to gain
+            return None
+        keys = tuple(data)
+        values = [data[key] for key in keys]
+        return event_id, self.get_schema_id(component_id, keys), json.dumps(values)
+
+    def update(self, rows):
+        """Rewrites the data of events in a single statement"""
+        if not rows:
+            return 0
+        ids, schema_ids, data = zip(*rows, strict=True)
+        table = connection.ops.quote_name(Event._meta.db_table)
+        # only rows that are still in their old form, in case another process
+        # got to them first
+        compacted = "IS NOT NULL" if self.options["expand"] else "IS NULL"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET schema_id = v.schema_id, data = v.data::jsonb "
+                "FROM unnest(%s::integer[], %s::integer[], %s::text[]) "
+                "AS v(id, schema_id, data) "
+                f"WHERE {table}.id = v.id AND {table}.schema_id {compacted}",
+                [list(ids), list(schema_ids), list(data)],
+            )
+            return cursor.rowcount
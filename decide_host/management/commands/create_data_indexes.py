@@ -0,0 +1,78 @@
+# -*- mode: python -*-
+"""Create expression indexes on frequently filtered keys of the data field"""
+
+import re
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from decide_host.models import Event, Trial
+
+MODELS = {"event": Event, "trial": Trial}
+
+
+class Command(BaseCommand):
+    help = (
+        "create indexes on the keys of the event and trial data fields listed in "
+        'settings.DECIDE_HOST["DATA_INDEXES"], e.g. {"trial": ["correct", "result"]}'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--drop-unlisted",
+            action="store_true",
+            help="drop indexes created by this command for keys no longer listed",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="print the SQL statements without running them",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("data indexes are only supported on PostgreSQL")
+        configured = getattr(settings, "DECIDE_HOST", {}).get("DATA_INDEXES", {})
+        for model_name, model in MODELS.items():
+            table = model._meta.db_table
+            prefix = f"{table}_data_"
+            keys = configured.get(model_name, ())
+            for key in keys:
+                if not re.match(r"^\w+$", key):
+                    raise CommandError(f"invalid key for data index: {key!r}")
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT indexname FROM pg_indexes WHERE tablename = %s", [table]
+                )
+                existing = {row[0] for row in cursor.fetchall()}
+                cursor.execute(
+                    "SELECT relkind FROM pg_class WHERE oid = %s::regclass", [table]
+                )
+                # indexes can't be built concurrently on partitioned tables
+                partitioned = cursor.fetchone()[0] == "p"
+            concurrently = "" if partitioned else " CONCURRENTLY"
+            statements = []
+            for key in keys:
+                index = f"{prefix}{key}_idx"
+                if index not in existing:
+                    statements.append(
+                        f"CREATE INDEX{concurrently} {connection.ops.quote_name(index)} "
+                        f"ON {connection.ops.quote_name(table)} ((data -> '{key}'))"
+                    )
+            if options["drop_unlisted"]:
+                wanted = {f"{prefix}{key}_idx" for key in keys}
+                for index in sorted(existing):
+                    if (
+                        index.startswith(prefix)
+                        and index.endswith("_idx")
+                        and index not in wanted
+                    ):
+                        statements.append(
+                            f"DROP INDEX{concurrently} {connection.ops.quote_name(index)}"
+                        )
+            for sql in statements:
+                self.stdout.write(f"- {sql}")
+                if not options["dry_run"]:
+                    with connection.cursor() as cursor:
+                        cursor.execute(sql)
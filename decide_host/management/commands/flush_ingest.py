@@ -0,0 +1,65 @@
+# -*- mode: python -*-
+"""Move spooled records into the database"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from decide_host.ingest import flush_spool
+from decide_host.spool import get_spool
+
+
+class Command(BaseCommand):
+    help = 'insert records from the ingest spool (DECIDE_HOST["INGEST_SPOOL"])'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="number of records to insert per transaction (default %(default)s)",
+        )
+        parser.add_argument(
+            "-f",
+            "--follow",
+            action="store_true",
+            help="keep running, waiting for new records when the spool is empty",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="seconds to wait when the spool is empty (default %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        queue = get_spool()
+        if queue is None:
+            raise CommandError('DECIDE_HOST["INGEST_SPOOL"] is not set')
+        total = 0
+        start = time.monotonic()
+        try:
+            while True:
+                n_inserted, n_duplicates, n_invalid = flush_spool(
+                    queue, options["batch_size"]
+                )
+                n = n_inserted + n_duplicates + n_invalid
+                total += n_inserted
+                if n and options["verbosity"] > 1:
+                    self.stdout.write(
+                        f"- inserted {n_inserted}, skipped {n_duplicates} "
+                        f"duplicate(s) and {n_invalid} invalid record(s); "
+                        f"{queue.pending()} pending"
+                    )
+                if n < options["batch_size"]:
+                    if not options["follow"]:
+                        break
+                    time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f"inserted {total} record(s) in {elapsed:.1f} s "
+            f"({total / elapsed if elapsed else 0:.0f} rows/s)"
+        )
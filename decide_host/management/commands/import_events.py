@@ -0,0 +1,66 @@
+# -*- mode: python -*-
+"""Import line-delimited records into event objects"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from decide_host.ingest import load_records, read_jsonl
+from decide_host.serializers import EventSerializer
+
+
+def with_addr(records, addr):
+    """Sets the controller name in records that don't have one"""
+    for record in records:
+        if isinstance(record, dict):
+            record.setdefault("addr", addr)
+        yield record
+
+
+class Command(BaseCommand):
+    help = "import events from line-delimited JSON (jsonl) files, which may be gzipped"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-a", "--addr", help="controller name for records that don't specify one"
+        )
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="number of events to insert per query (default %(default)s)",
+        )
+        parser.add_argument("files", nargs="+", help="files to import")
+
+    def handle(self, *args, **options):
+        total = 0
+        start = time.monotonic()
+        for path in options["files"]:
+            records = read_jsonl(path)
+            if options["addr"]:
+                records = with_addr(records, options["addr"])
+            n_inserted = n_duplicates = 0
+            for inserted, duplicates, errors in load_records(
+                EventSerializer, records, options["batch_size"]
+            ):
+                for i, detail in errors:
+                    self.stdout.write(f"{path}, record {i} invalid: {detail}")
+                n_inserted += inserted
+                n_duplicates += duplicates
+                if options["verbosity"] > 1:
+                    elapsed = time.monotonic() - start
+                    self.stdout.write(
+                        f"{path}: {n_inserted + n_duplicates} record(s) processed "
+                        f"({(total + n_inserted) / elapsed:.0f} rows/s)"
+                    )
+            self.stdout.write(
+                f"{path}: imported {n_inserted} record(s), "
+                f"skipped {n_duplicates} duplicate(s)"
+            )
+            total += n_inserted
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f"imported {total} record(s) in {elapsed:.1f} s "
+            f"({total / elapsed if elapsed else 0:.0f} rows/s)"
+        )
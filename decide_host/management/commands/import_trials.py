@@ -1,13 +1,30 @@
 # -*- mode: python -*-
-"""Import line-delimited records into trial objects using the Django ORM"""
+"""Import line-delimited records into trial objects"""
 
-import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from django.core.management.base import BaseCommand
+from django.db import connections
 
+from decide_host.ingest import load_records, read_jsonl
 from decide_host.serializers import TrialSerializer
 
 
+def import_file(path, defaults, batch_size):
+    """Imports the trials in path. Returns (n_inserted, n_duplicates, errors)"""
+    n_inserted = n_duplicates = 0
+    errors = []
+    for inserted, duplicates, batch_errors in load_records(
+        TrialSerializer, read_jsonl(path), batch_size, defaults
+    ):
+        n_inserted += inserted
+        n_duplicates += duplicates
+        errors.extend(batch_errors)
+    return n_inserted, n_duplicates, errors
+
+
 class Command(BaseCommand):
     help = "import trials from line-delimited JSON (jsonl) files"
 
@@ -18,22 +35,50 @@ class Command(BaseCommand):
         parser.add_argument(
             "-a", "--addr", help="controller name (required)", required=True
         )
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="number of trials to insert per query (default %(default)s)",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of files to import in parallel (default %(default)s)",
+        )
         parser.add_argument("files", nargs="+", help="files to import")
 
     def handle(self, *args, **options):
-        for path in options["files"]:
-            with open(path) as fp:
-                n = 0
-                for i, line in enumerate(fp):
-                    record = json.loads(line.strip())
-                    record["addr"] = options["addr"]
-                    record["name"] = options["name"]
-                    serializer = TrialSerializer(data=record)
-                    if serializer.is_valid():
-                        n += 1
-                        serializer.save()
-                    else:
-                        self.stdout.write(
-                            f"{path}, record {i} invalid: {serializer.errors}"
-                        )
-                self.stdout.write(f"{path}: imported {n} record(s)")
+        defaults = {"addr": options["addr"], "name": options["name"]}
+        files = options["files"]
+        jobs = [(path, defaults, options["batch_size"]) for path in files]
+        start = time.monotonic()
+        if options["jobs"] > 1 and len(files) > 1:
+            # each worker opens its own database connection
+            connections.close_all()
+            with ProcessPoolExecutor(
+                min(options["jobs"], len(files)),
+                mp_context=multiprocessing.get_context("fork"),
+            ) as pool:
+                results = list(pool.map(import_file, *zip(*jobs, strict=True)))
+        else:
+            results = (import_file(*job) for job in jobs)
+        total = 0
+        for path, (n_inserted, n_duplicates, errors) in zip(
+            files, results, strict=True
+        ):
+            for i, detail in errors:
+                self.stdout.write(f"{path}, record {i} invalid: {detail}")
+            self.stdout.write(
+                f"{path}: imported {n_inserted} record(s), "
+                f"skipped {n_duplicates} duplicate(s)"
+            )
+            total += n_inserted
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f"imported {total} record(s) in {elapsed:.1f} s "
+            f"({total / elapsed if elapsed else 0:.0f} rows/s)"
+        )
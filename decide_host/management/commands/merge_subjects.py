@@ -1,13 +1,31 @@
 # -*- mode: python -*-
 """Combine duplicate subject objects using the Django ORM"""
 
-from django.core.management.base import BaseCommand
+import time
 
-from decide_host.models import Subject
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Exists, F, OuterRef
+
+from decide_host import response_cache
+from decide_host.models import DailyTrialStats, Subject, SubjectStats, Trial
+
+# SQLSTATE for lock_timeout expiring
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+def is_lock_timeout(err):
+    cause = err.__cause__
+    code = getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+    return code == LOCK_NOT_AVAILABLE
 
 
 class Command(BaseCommand):
-    help = "combine duplicate subjects using the Django ORM"
+    help = (
+        "combine duplicate subjects using the Django ORM. Trials are moved in "
+        "batches, each in its own short transaction, so trials can still be "
+        "recorded during the merge."
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -15,6 +33,26 @@ class Command(BaseCommand):
             action="store_true",
             help="don't commit the result to the database",
         )
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="number of trials to move per transaction (default %(default)s)",
+        )
+        parser.add_argument(
+            "--lock-timeout",
+            type=float,
+            default=5.0,
+            help="seconds to wait for locks before retrying a batch (default %(default)s)",
+        )
+        parser.add_argument(
+            "--retries",
+            type=int,
+            default=5,
+            help="number of times to retry a batch that can't get its locks "
+            "(default %(default)s)",
+        )
         parser.add_argument("to_keep", help="name of the subject that will be kept")
         parser.add_argument(
             "to_combine",
@@ -23,23 +61,153 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
+        self.options = options
         try:
             dest_subj = Subject.objects.get(name=options["to_keep"])
         except Subject.DoesNotExist:
             self.stdout.write(f"- no such subject {options['to_keep']}, aborting")
             return
-        for subj_name in options["to_combine"]:
+        sources = []
+        for subj_name in dict.fromkeys(options["to_combine"]):
             try:
                 src_subj = Subject.objects.get(name=subj_name)
             except Subject.DoesNotExist:
                 self.stdout.write(f"- no such subject {subj_name}, skipping")
                 continue
+            if src_subj == dest_subj:
+                self.stdout.write(f"- {subj_name} is the subject being kept, skipping")
+                continue
+            sources.append(src_subj)
+        for src_subj in sources:
             n_trials = src_subj.trial_set.count()
             self.stdout.write(
                 f"- reassigning {n_trials} trial(s) from {src_subj.name} to {dest_subj.name}"
             )
             if not options["dry_run"]:
-                src_subj.trial_set.update(subject=dest_subj)
-                assert src_subj.trial_set.count() == 0
-                src_subj.delete()
+                self.move_trials(src_subj, dest_subj, n_trials)
+        if not options["dry_run"]:
+            self.finish(sources, dest_subj)
+
+    def conflicts(self, dest_subj):
+        """Matches trials that are already recorded for dest_subj"""
+        return Exists(
+            Trial.objects.filter(
+                subject=dest_subj, name=OuterRef("name"), time=OuterRef("time")
+            )
+        )
+
+    def run_batch(self, func, *args):
+        """Calls func in a transaction with a lock timeout, retrying if it expires"""
+        for attempt in range(self.options["retries"] + 1):
+            try:
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            "SET LOCAL lock_timeout = %s",
+                            [f"{int(self.options['lock_timeout'] * 1000)}ms"],
+                        )
+                    return func(*args)
+            except OperationalError as err:
+                if not is_lock_timeout(err) or attempt == self.options["retries"]:
+                    raise
+                self.stdout.write("- timed out waiting for locks, retrying")
+                time.sleep(min(2**attempt, 30))
+
+    def move_batch(self, src_subj, dest_subj, after):
+        """Moves the next batch of trials after time `after`.
+
+        Batches are chunks of the source subject's trials in time order, so
+        they can be found with the (subject, time) index. Returns the number of
+        trials moved and the time of the last one (None if this was the last
+        batch).
+        """
+        trials = src_subj.trial_set.all()
+        if after is not None:
+            trials = trials.filter(time__gt=after)
+        bound = (
+            trials.order_by("time")
+            .values_list("time", flat=True)[self.options["batch_size"] - 1 :]
+            .first()
+        )
+        if bound is not None:
+            trials = trials.filter(time__lte=bound)
+        moved = trials.exclude(self.conflicts(dest_subj)).update(subject=dest_subj)
+        # keep the running totals right while the merge is in progress
+        SubjectStats.objects.filter(subject=src_subj).update(
+            n_trials=F("n_trials") - moved
+        )
+        SubjectStats.objects.filter(subject=dest_subj).update(
+            n_trials=F("n_trials") + moved
+        )
+        return moved, bound
+
+    def move_trials(self, src_subj, dest_subj, n_trials):
+        after = None
+        total = 0
+        start = time.monotonic()
+        while True:
+            try:
+                moved, after = self.run_batch(
+                    self.move_batch, src_subj, dest_subj, after
+                )
+            except IntegrityError as err:
+                raise CommandError(
+                    f"unable to move trials from {src_subj.name}: {err}"
+                ) from err
+            total += moved
+            if self.options["verbosity"] > 1:
+                elapsed = time.monotonic() - start
+                self.stdout.write(
+                    f"  - moved {total}/{n_trials} trial(s) "
+                    f"({total / elapsed if elapsed else 0:.0f} rows/s)"
+                )
+            if after is None:
+                break
+
+    def finish(self, sources, dest_subj):
+        """Deletes the merged subjects and recomputes the totals"""
+
+        def delete_source(src_subj):
+            # blocks new trials for this subject until the transaction is done
+            Subject.objects.select_for_update().get(pk=src_subj.pk)
+            # move any trials that were recorded during the merge
+            after = None
+            while True:
+                _, after = self.move_batch(src_subj, dest_subj, after)
+                if after is None:
+                    break
+            remaining = src_subj.trial_set.count()
+            if remaining:
+                return remaining
+            src_subj.delete()
+            return 0
+
+        kept = []
+        for src_subj in sources:
+            remaining = self.run_batch(delete_source, src_subj)
+            if remaining:
+                kept.append(src_subj)
+                self.stdout.write(
+                    f"- {remaining} trial(s) from {src_subj.name} conflict with "
+                    f"trials already recorded for {dest_subj.name}; "
+                    f"not deleting {src_subj.name}"
+                )
+            else:
                 self.stdout.write(f"- deleted {src_subj.name}")
+        subjects = [dest_subj, *kept]
+        self.run_batch(self.rebuild_stats, subjects)
+        response_cache.bump(["subjects", *(f"subject:{subj.pk}" for subj in subjects)])
+
+    def rebuild_stats(self, subjects):
+        """Recomputes the totals for subjects. Call in a transaction"""
+        # Trials are still being recorded, and ingest updates SubjectStats before
+        # DailyTrialStats in the same transaction. Locking these rows waits for
+        # any ingest that has already counted trials for the subjects, and holds
+        # back the rest until the totals are rewritten, so their increments
+        # can't land between the aggregate and the rewrite and be lost.
+        SubjectStats.objects.bulk_create(
+            [SubjectStats(subject=subj) for subj in subjects], ignore_conflicts=True
+        )
+        list(SubjectStats.objects.select_for_update().filter(subject__in=subjects))
+        SubjectStats.objects.rebuild(subjects)
+        DailyTrialStats.objects.rebuild(subjects)
@@ -0,0 +1,353 @@
+# -*- mode: python -*-
+"""Manage monthly range partitions of the event and trial tables"""
+
+import datetime
+import gzip
+import json
+import re
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from decide_host import response_cache
+from decide_host.models import (
+    DailyTrialStats,
+    Event,
+    EventDailySummary,
+    EventSchema,
+    SubjectStats,
+    Trial,
+)
+
+MODELS = {"event": Event, "trial": Trial}
+
+
+def month_start(date):
+    return datetime.date(date.year, date.month, 1)
+
+
+def next_month(date):
+    return datetime.date(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+def parse_month(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m").date()
+    except ValueError:
+        raise CommandError(f"invalid month {value!r} (use YYYY-MM)") from None
+
+
+class Command(BaseCommand):
+    help = "manage monthly partitions of the event (or trial) table on PostgreSQL"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-m",
+            "--model",
+            choices=sorted(MODELS),
+            default="event",
+            help="which table to manage (default %(default)s)",
+        )
+        actions = parser.add_subparsers(dest="action", required=True)
+        convert = actions.add_parser(
+            "convert",
+            help="convert the table to one partitioned by month. This copies "
+            "every row and locks the table until it's done!",
+        )
+        convert.add_argument(
+            "--months-ahead",
+            type=int,
+            default=3,
+            help="number of future months to create partitions for",
+        )
+        create = actions.add_parser(
+            "create", help="create partitions for future months"
+        )
+        create.add_argument(
+            "--months-ahead",
+            type=int,
+            default=3,
+            help="number of future months to create partitions for",
+        )
+        actions.add_parser("list", help="list partitions and their sizes")
+        detach = actions.add_parser(
+            "detach", help="detach (and optionally archive) partitions of old months"
+        )
+        detach.add_argument(
+            "--before",
+            required=True,
+            help="detach partitions for months before this one (YYYY-MM)",
+        )
+        detach.add_argument(
+            "--archive",
+            metavar="DIR",
+            help="write the records in each partition to a gzipped jsonl file in DIR",
+        )
+        detach.add_argument(
+            "--drop",
+            action="store_true",
+            help="drop the partitions after detaching them",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("partitioning is only supported on PostgreSQL")
+        self.model = MODELS[options["model"]]
+        self.table = self.model._meta.db_table
+        getattr(self, f"handle_{options['action']}")(**options)
+
+    def is_partitioned(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relkind FROM pg_class WHERE oid = %s::regclass", [self.table]
+            )
+            return cursor.fetchone()[0] == "p"
+
+    def partitions(self):
+        """Returns a list of (name, month) for the table's partitions.
+
+        The month is None for the default partition and for any partitions not
+        created by this command.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = %s::regclass ORDER BY c.relname
+                """,
+                [self.table],
+            )
+            names = [row[0] for row in cursor.fetchall()]
+        pattern = re.compile(rf"^{self.table}_p(\d{{4}})(\d{{2}})$")
+        out = []
+        for name in names:
+            match = pattern.match(name)
+            month = datetime.date(int(match[1]), int(match[2]), 1) if match else None
+            out.append((name, month))
+        return out
+
+    def partition_name(self, month):
+        return f"{self.table}_p{month:%Y%m}"
+
+    def create_partition(self, cursor, month):
+        qn = connection.ops.quote_name
+        name = self.partition_name(month)
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {qn(name)} PARTITION OF {qn(self.table)} "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            [self.bound(month), self.bound(next_month(month))],
+        )
+        return name
+
+    def bound(self, month):
+        return timezone.make_aware(datetime.datetime.combine(month, datetime.time()))
+
+    def handle_convert(self, months_ahead, **options):
+        if self.is_partitioned():
+            raise CommandError(f"{self.table} is already partitioned")
+        qn = connection.ops.quote_name
+        old = f"{self.table}_unpartitioned"
+        seq = f"{self.table}_id_seq"
+        start = time.monotonic()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {qn(self.table)} IN ACCESS EXCLUSIVE MODE")
+            # the old table can't be dropped while deferred foreign key checks
+            # are pending
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            # save the definitions of the constraints and indexes so they can be
+            # recreated on the partitioned table with the same names
+            cursor.execute(
+                """
+                SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint
+                WHERE conrelid = %s::regclass AND contype IN ('c', 'f', 'p', 'u')
+                ORDER BY contype
+                """,
+                [self.table],
+            )
+            constraints = cursor.fetchall()
+            cursor.execute(
+                """
+                SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s
+                AND indexname NOT IN (
+                  SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass
+                )
+                """,
+                [self.table, self.table],
+            )
+            indexes = cursor.fetchall()
+            cursor.execute("SELECT MIN(time), MAX(id) FROM " + qn(self.table))
+            first_time, max_id = cursor.fetchone()
+
+            cursor.execute(f"ALTER TABLE {qn(self.table)} RENAME TO {qn(old)}")
+            cursor.execute(
+                f"CREATE TABLE {qn(self.table)} (LIKE {qn(old)} INCLUDING DEFAULTS) "
+                f'PARTITION BY RANGE ("time")'
+            )
+            # the id column may be an identity column or use a sequence owned by
+            # the old table, so the new table gets its own sequence below
+            cursor.execute(f"ALTER TABLE {qn(self.table)} ALTER COLUMN id DROP DEFAULT")
+
+            month = month_start(
+                timezone.localdate(first_time) if first_time else timezone.localdate()
+            )
+            last = timezone.localdate()
+            for _ in range(months_ahead):
+                last = next_month(last)
+            while month <= last:
+                self.create_partition(cursor, month)
+                month = next_month(month)
+            cursor.execute(
+                f"CREATE TABLE {qn(self.table + '_default')} "
+                f"PARTITION OF {qn(self.table)} DEFAULT"
+            )
+            cursor.execute(f"INSERT INTO {qn(self.table)} SELECT * FROM {qn(old)}")
+            n_rows = cursor.rowcount
+            cursor.execute(f"DROP TABLE {qn(old)}")
+            cursor.execute(f"CREATE SEQUENCE {qn(seq)} OWNED BY {qn(self.table)}.id")
+            cursor.execute(
+                "SELECT setval(%s, %s, %s)", [seq, max_id or 1, max_id is not None]
+            )
+            cursor.execute(
+                f"ALTER TABLE {qn(self.table)} ALTER COLUMN id "
+                f"SET DEFAULT nextval('{seq}'::regclass)"
+            )
+
+            for name, kind, definition in constraints:
+                if kind == "p":
+                    # unique constraints on a partitioned table must include the
+                    # partition key
+                    definition = 'PRIMARY KEY (id, "time")'
+                cursor.execute(
+                    f"ALTER TABLE {qn(self.table)} ADD CONSTRAINT {qn(name)} {definition}"
+                )
+            # the index definitions name the table, which has its old name again
+            for _name, definition in indexes:
+                cursor.execute(definition)
+        self.stdout.write(
+            f"- converted {self.table} to {len(self.partitions())} partitions: "
+            f"{n_rows} rows copied in {time.monotonic() - start:.1f} s"
+        )
+
+    def handle_create(self, months_ahead, **options):
+        if not self.is_partitioned():
+            raise CommandError(f"{self.table} is not partitioned; use convert first")
+        month = month_start(timezone.localdate())
+        existing = {name for name, _ in self.partitions()}
+        with transaction.atomic(), connection.cursor() as cursor:
+            for _ in range(months_ahead + 1):
+                if self.partition_name(month) not in existing:
+                    name = self.create_partition(cursor, month)
+                    self.stdout.write(f"- created {name}")
+                month = next_month(month)
+
+    def handle_list(self, **options):
+        if not self.is_partitioned():
+            raise CommandError(f"{self.table} is not partitioned")
+        with connection.cursor() as cursor:
+            for name, month in self.partitions():
+                cursor.execute(
+                    "SELECT reltuples::bigint, pg_size_pretty(pg_total_relation_size(oid)) "
+                    "FROM pg_class WHERE relname = %s",
+                    [name],
+                )
+                rows, size = cursor.fetchone()
+                span = f"{month:%Y-%m}" if month else "-"
+                self.stdout.write(f"{name}\t{span}\t~{max(rows, 0)} rows\t{size}")
+
+    def handle_detach(self, before, archive, drop, **options):
+        if not self.is_partitioned():
+            raise CommandError(f"{self.table} is not partitioned")
+        before = parse_month(before)
+        qn = connection.ops.quote_name
+        for name, month in self.partitions():
+            if month is None or month >= before:
+                continue
+            # each partition is detached, accounted for, archived and dropped
+            # in one transaction, so the totals match what's left in the table
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f"ALTER TABLE {qn(self.table)} DETACH PARTITION {qn(name)}"
+                )
+                self.update_totals(cursor, name)
+                if archive:
+                    path = Path(archive) / f"{name}.jsonl.gz"
+                    n = self.archive_partition(name, path)
+                if drop:
+                    cursor.execute(f"DROP TABLE {qn(name)}")
+            self.stdout.write(f"- detached {name}")
+            if archive:
+                self.stdout.write(f"- wrote {n} record(s) to {path}")
+            if drop:
+                self.stdout.write(f"- dropped {name}")
+
+    def update_totals(self, cursor, name):
+        """Updates the running totals for the records in a detached partition.
+
+        Events are added to the daily summaries, like those removed by
+        archive_events, so the controller totals still count them. The totals
+        for the subjects of trials are recomputed without them.
+        """
+        qn = connection.ops.quote_name
+        if self.model is Event:
+            cursor.execute(
+                "SELECT addr_id, name_id, (time AT TIME ZONE %s)::date, COUNT(*), "
+                f"MAX(time) FROM {qn(name)} GROUP BY 1, 2, 3",
+                [timezone.get_current_timezone_name()],
+            )
+            EventDailySummary.objects.record_totals(
+                {
+                    (addr, component, date): (n, last)
+                    for addr, component, date, n, last in cursor
+                }
+            )
+        else:
+            cursor.execute(f"SELECT DISTINCT subject_id FROM {qn(name)}")
+            subjects = [row[0] for row in cursor]
+            if subjects:
+                SubjectStats.objects.rebuild(subjects)
+                DailyTrialStats.objects.rebuild(subjects)
+                scopes = ["subjects", *(f"subject:{pk}" for pk in subjects)]
+                transaction.on_commit(lambda: response_cache.bump(scopes))
+
+    def archive_partition(self, name, path):
+        """Write the records in a detached partition to a gzipped jsonl file"""
+        # the schema of compacted events is used to decode the data instead
+        related = [
+            f.name
+            for f in self.model._meta.concrete_fields
+            if f.is_relation and f.name != "schema"
+        ]
+        queryset = self.model.objects.raw(
+            f"SELECT * FROM {connection.ops.quote_name(name)} ORDER BY time"
+        )
+        slugs = {
+            field: dict(
+                self.model._meta.get_field(field).related_model.objects.values_list(
+                    "id", "name"
+                )
+            )
+            for field in related
+        }
+        schemas = {}
+        if self.model is Event:
+            schemas = dict(EventSchema.objects.values_list("id", "keys"))
+        n = 0
+        with gzip.open(path, "wt") as fp:
+            for obj in queryset.iterator():
+                record = {
+                    field: slugs[field][getattr(obj, f"{field}_id")]
+                    for field in related
+                }
+                # DjangoJSONEncoder would cut the time to milliseconds
+                record["time"] = obj.time.isoformat()
+                schema_id = getattr(obj, "schema_id", None)
+                if schema_id is None:
+                    record.update(obj.data)
+                else:
+                    record.update(zip(schemas[schema_id], obj.data, strict=True))
+                fp.write(json.dumps(record) + "\n")
+                n += 1
+        return n
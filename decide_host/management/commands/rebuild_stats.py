@@ -0,0 +1,46 @@
+# -*- mode: python -*-
+"""Recompute the running totals for controllers and subjects"""
+
+from django.core.management.base import BaseCommand
+
+from decide_host.models import (
+    Controller,
+    ControllerStats,
+    DailyTrialStats,
+    Subject,
+    SubjectStats,
+)
+
+
+class Command(BaseCommand):
+    help = "recompute event and trial totals for controllers and subjects"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-c",
+            "--controller",
+            action="append",
+            help="only rebuild totals for this controller (may be repeated)",
+        )
+        parser.add_argument(
+            "-s",
+            "--subject",
+            action="append",
+            help="only rebuild totals for this subject (may be repeated)",
+        )
+
+    def handle(self, *args, **options):
+        controllers = options["controller"]
+        subjects = options["subject"]
+        if controllers or not subjects:
+            if controllers:
+                controllers = Controller.objects.filter(name__in=controllers)
+            n = ControllerStats.objects.rebuild(controllers)
+            self.stdout.write(f"- rebuilt event totals for {n} controller(s)")
+        if subjects or not controllers:
+            if subjects:
+                subjects = Subject.objects.filter(name__in=subjects)
+            n = SubjectStats.objects.rebuild(subjects)
+            self.stdout.write(f"- rebuilt trial totals for {n} subject(s)")
+            n = DailyTrialStats.objects.rebuild(subjects)
+            self.stdout.write(f"- rebuilt {n} daily trial total(s)")
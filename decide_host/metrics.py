@@ -0,0 +1,187 @@
+# -*- mode: python -*-
+"""Per-view request statistics, collected by `decide_host.middleware`"""
+
+import bisect
+import heapq
+import itertools
+import threading
+import time
+from collections import defaultdict
+
+# name, Prometheus metric, help text
+FIELDS = (
+    ("requests", "decide_host_requests_total", "Number of requests"),
+    ("seconds", "decide_host_request_seconds_total", "Time spent handling requests"),
+    ("queries", "decide_host_db_queries_total", "Number of SQL queries"),
+    ("db_seconds", "decide_host_db_seconds_total", "Time spent in SQL queries"),
+    (
+        "render_seconds",
+        "decide_host_render_seconds_total",
+        "Time spent rendering responses",
+    ),
+    ("response_bytes", "decide_host_response_bytes_total", "Size of response bodies"),
+)
+
+# name, Prometheus metric, help text, bucket upper bounds. These are only
+# observed for requests that record a value.
+HISTOGRAMS = (
+    (
+        "serialize_seconds",
+        "decide_host_serialize_seconds",
+        "Time spent serializing records for list and detail responses",
+        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+    ),
+)
+
+
+def format_value(value):
+    """Formats a total without losing precision (unlike the `g` format)"""
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class QueryCollector:
+    """Database execute wrapper that counts and times queries.
+
+    The `keep` slowest queries are retained so they can be logged.
+    """
+
+    def __init__(self, keep=5):
+        self.count = 0
+        self.seconds = 0.0
+        self.keep = keep
+        self._slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.seconds += elapsed
+            entry = (elapsed, self.count, sql)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+
+    def slowest(self):
+        """Returns (seconds, sql) for the slowest queries, slowest first"""
+        return [(elapsed, sql) for elapsed, _, sql in sorted(self._slowest)[::-1]]
+
+
+class Histogram:
+    """Counts observations in buckets, like a Prometheus histogram"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        # buckets are upper bounds (le), so a value on a bound falls in it
+        i = bisect.bisect_left(self.bounds, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+
+    def to_dict(self):
+        """Returns the cumulative count for each bound, the count and the sum"""
+        return {
+            "buckets": dict(
+                zip(self.bounds, itertools.accumulate(self.counts), strict=True)
+            ),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class Metrics:
+    """Running totals and histograms for each combination of view and HTTP method.
+
+    The totals are kept in memory, so each worker process has its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: [0] * len(FIELDS))
+        self._histograms = defaultdict(
+            lambda: [Histogram(bounds) for _, _, _, bounds in HISTOGRAMS]
+        )
+
+    def record(self, view, method, **values):
+        values["requests"] = 1
+        with self._lock:
+            totals = self._totals[(view, method)]
+            for i, (name, _, _) in enumerate(FIELDS):
+                totals[i] += values.get(name, 0)
+            histograms = self._histograms[(view, method)]
+            for histogram, (name, _, _, _) in zip(histograms, HISTOGRAMS, strict=True):
+                if values.get(name) is not None:
+                    histogram.observe(values[name])
+
+    def snapshot(self):
+        """Returns a dict mapping (view, method) to a dict of totals.
+
+        Histograms are dicts with the cumulative counts for each bucket, the
+        number of observations and their sum.
+        """
+        with self._lock:
+            return {
+                key: {
+                    **{
+                        name: value
+                        for (name, _, _), value in zip(FIELDS, totals, strict=True)
+                    },
+                    **{
+                        name: histogram.to_dict()
+                        for (name, _, _, _), histogram in zip(
+                            HISTOGRAMS, self._histograms[key], strict=True
+                        )
+                    },
+                }
+                for key, totals in self._totals.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self._totals.clear()
+            self._histograms.clear()
+
+    def to_prometheus(self):
+        """Formats the totals in the Prometheus text exposition format"""
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+        for name, metric, help_text in FIELDS:
+            lines.append(f"# HELP {metric} {help_text}.")
+            lines.append(f"# TYPE {metric} counter")
+            for (view, method), totals in snapshot:
+                lines.append(
+                    f'{metric}{{view="{view}",method="{method}"}} '
+                    f"{format_value(totals[name])}"
+                )
+        for name, metric, help_text, _ in HISTOGRAMS:
+            lines.append(f"# HELP {metric} {help_text}.")
+            lines.append(f"# TYPE {metric} histogram")
+            for (view, method), totals in snapshot:
+                histogram = totals[name]
+                if histogram["count"] == 0:
+                    continue
+                labels = f'view="{view}",method="{method}"'
+                for bound, count in histogram["buckets"].items():
+                    lines.append(
+                        f'{metric}_bucket{{{labels},le="{format_value(bound)}"}} {count}'
+                    )
+                lines.append(
+                    f'{metric}_bucket{{{labels},le="+Inf"}} {histogram["count"]}'
+                )
+                lines.append(
+                    f"{metric}_sum{{{labels}}} {format_value(histogram['sum'])}"
+                )
+                lines.append(f"{metric}_count{{{labels}}} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
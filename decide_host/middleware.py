@@ -0,0 +1,145 @@
+# -*- mode: python -*-
+"""Middleware that records how much work each request takes.
+
+Add "decide_host.middleware.MetricsMiddleware" to MIDDLEWARE to collect the
+number of requests, SQL queries, time in the database, time rendering the
+response, total time, and response size for each view and method. List and
+detail views also time serializing their records, which is kept as a
+histogram. The metrics are served in the Prometheus text format at
+/api/metrics/. Requests that take longer than
+DECIDE_HOST["SLOW_REQUEST_THRESHOLD"] seconds (default 1.0; None to disable)
+are logged to `decide_host.middleware` with their data__ filters and slowest
+queries.
+
+"""
+
+import contextlib
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from decide_host.metrics import QueryCollector, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def slow_request_threshold():
+    return getattr(settings, "DECIDE_HOST", {}).get("SLOW_REQUEST_THRESHOLD", 1.0)
+
+
+def serializing(request):
+    """Times serialization for the request, if the middleware is installed"""
+    timer = getattr(request, "decide_metrics", None)
+    return contextlib.nullcontext() if timer is None else timer.serializing()
+
+
+class RequestTimer:
+    """Accumulates the measurements for a single request"""
+
+    def __init__(self, request):
+        self.request = request
+        self.view = "unresolved"
+        self.start = time.perf_counter()
+        self.queries = QueryCollector()
+        self.render_start = None
+        self.render_seconds = 0.0
+        self.serialize_seconds = None
+        self.response_bytes = 0
+        self.event_stream = False
+
+    @contextlib.contextmanager
+    def serializing(self):
+        """Times the serialization of records, which views do before rendering"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.serialize_seconds = (self.serialize_seconds or 0.0) + elapsed
+
+    def before_render(self):
+        self.render_start = time.perf_counter()
+
+    def after_render(self, response):
+        self.render_seconds = time.perf_counter() - self.render_start
+
+    def stream(self, content):
+        """Wraps streaming content so it's measured as it's sent"""
+        try:
+            with connection.execute_wrapper(self.queries):
+                for chunk in content:
+                    self.response_bytes += len(chunk)
+                    yield chunk
+        finally:
+            self.finish(streaming=True)
+
+    def finish(self, streaming=False):
+        seconds = time.perf_counter() - self.start
+        request = self.request
+        metrics.record(
+            self.view,
+            request.method,
+            seconds=seconds,
+            queries=self.queries.count,
+            db_seconds=self.queries.seconds,
+            render_seconds=self.render_seconds,
+            serialize_seconds=self.serialize_seconds,
+            response_bytes=self.response_bytes,
+        )
+        threshold = slow_request_threshold()
+        # event streams are slow on purpose
+        if threshold is None or seconds < threshold or self.event_stream:
+            return
+        filters = {k: v for k, v in request.GET.items() if k.startswith("data__")}
+        logger.warning(
+            "slow request: %s %s (%s) took %.3f s%s; %d queries took %.3f s; "
+            "data filters: %s; slowest queries:\n%s",
+            request.method,
+            request.path,
+            self.view,
+            seconds,
+            " to stream" if streaming else "",
+            self.queries.count,
+            self.queries.seconds,
+            filters or "none",
+            "\n".join(
+                f"  {elapsed:.3f} s: {sql}" for elapsed, sql in self.queries.slowest()
+            ),
+        )
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = request.decide_metrics = RequestTimer(request)
+        with connection.execute_wrapper(timer.queries):
+            response = self.get_response(request)
+        if response.streaming:
+            content_type = response.get("Content-Type", "")
+            timer.event_stream = content_type.startswith("text/event-stream")
+            if not response.is_async:
+                response.streaming_content = timer.stream(response.streaming_content)
+                return response
+        else:
+            timer.response_bytes = len(response.content)
+        timer.finish()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, "view_class", None) or getattr(
+            view_func, "cls", None
+        )
+        request.decide_metrics.view = (
+            view_class.__name__ if view_class is not None else view_func.__name__
+        )
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after this, so the rendering can be timed
+        timer = request.decide_metrics
+        timer.before_render()
+        response.add_post_render_callback(timer.after_render)
+        return response
@@ -0,0 +1,92 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:31
+
+import datetime
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max
+from django.utils import timezone
+
+
+def populate_stats(apps, schema_editor):
+    Event = apps.get_model("decide_host", "Event")
+    Trial = apps.get_model("decide_host", "Trial")
+    ControllerStats = apps.get_model("decide_host", "ControllerStats")
+    SubjectStats = apps.get_model("decide_host", "SubjectStats")
+    ControllerStats.objects.bulk_create(
+        ControllerStats(
+            controller_id=row["addr"], n_events=row["n"], last_event_time=row["last"]
+        )
+        for row in Event.objects.values("addr").annotate(
+            n=Count("id"), last=Max("time")
+        )
+    )
+    stats = []
+    for row in Trial.objects.values("subject").annotate(
+        n=Count("id"), last=Max("time")
+    ):
+        date = timezone.localdate(row["last"])
+        day_start = timezone.make_aware(
+            datetime.datetime.combine(date, datetime.time())
+        )
+        stats.append(
+            SubjectStats(
+                subject_id=row["subject"],
+                n_trials=row["n"],
+                last_trial_time=row["last"],
+                last_trial_date=date,
+                n_trials_last_date=Trial.objects.filter(
+                    subject=row["subject"], time__gte=day_start
+                ).count(),
+            )
+        )
+    SubjectStats.objects.bulk_create(stats)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "decide_host",
+            "0002_alter_component_options_alter_controller_options_and_more",
+        ),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ControllerStats",
+            fields=[
+                (
+                    "controller",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="stats",
+                        serialize=False,
+                        to="decide_host.controller",
+                    ),
+                ),
+                ("n_events", models.PositiveBigIntegerField(default=0)),
+                ("last_event_time", models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="SubjectStats",
+            fields=[
+                (
+                    "subject",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="stats",
+                        serialize=False,
+                        to="decide_host.subject",
+                    ),
+                ),
+                ("n_trials", models.PositiveBigIntegerField(default=0)),
+                ("last_trial_time", models.DateTimeField(null=True)),
+                ("last_trial_date", models.DateField(null=True)),
+                ("n_trials_last_date", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+from decide_host.models import daily_trial_totals
+
+
+def populate_daily_stats(apps, schema_editor):
+    Trial = apps.get_model("decide_host", "Trial")
+    DailyTrialStats = apps.get_model("decide_host", "DailyTrialStats")
+    totals = (
+        Trial.objects.annotate(date=TruncDate("time"))
+        .values("subject", "name", "date")
+        # the same totals as DailyTrialStats.objects.rebuild()
+        .annotate(**daily_trial_totals())
+        .order_by()
+    )
+    DailyTrialStats.objects.bulk_create(
+        DailyTrialStats(subject_id=row.pop("subject"), name_id=row.pop("name"), **row)
+        for row in totals
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("decide_host", "0003_stats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyTrialStats",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("date", models.DateField()),
+                ("n_trials", models.PositiveIntegerField(default=0)),
+                ("n_scored", models.PositiveIntegerField(default=0)),
+                ("n_correct", models.PositiveIntegerField(default=0)),
+                ("n_responses", models.PositiveIntegerField(default=0)),
+                (
+                    "name",
+                    models.ForeignKey(
+                        help_text="the experiment paradigm (e.g., shape)",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="decide_host.component",
+                    ),
+                ),
+                (
+                    "subject",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="daily_stats",
+                        to="decide_host.subject",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("date", "name"),
+                "unique_together": {("subject", "name", "date")},
+            },
+        ),
+        migrations.RunPython(populate_daily_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:34
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # build the indexes without blocking inserts
+    atomic = False
+
+    dependencies = [
+        ("decide_host", "0004_dailytrialstats"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="event",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["data"], name="event_data_gin_idx", opclasses=["jsonb_path_ops"]
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="trial",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["data"], name="trial_data_gin_idx", opclasses=["jsonb_path_ops"]
+            ),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("decide_host", "0005_data_gin_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EventDailySummary",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("date", models.DateField()),
+                ("n_events", models.PositiveBigIntegerField(default=0)),
+                ("last_time", models.DateTimeField()),
+                (
+                    "controller",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="archived_events",
+                        to="decide_host.controller",
+                    ),
+                ),
+                (
+                    "name",
+                    models.ForeignKey(
+                        help_text="the name of the component",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="decide_host.component",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("date", "name"),
+                "unique_together": {("controller", "name", "date")},
+            },
+        ),
+    ]
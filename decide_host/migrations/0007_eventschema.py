@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:06
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("decide_host", "0006_eventdailysummary"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EventSchema",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "keys",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.TextField(), size=None
+                    ),
+                ),
+                (
+                    "component",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="decide_host.component",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("component", "keys")},
+            },
+        ),
+        migrations.AddField(
+            model_name="event",
+            name="schema",
+            field=models.ForeignKey(
+                blank=True,
+                db_index=False,
+                help_text="if set, data is a compact array of values for the schema's keys",
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="decide_host.eventschema",
+            ),
+        ),
+    ]
@@ -1,7 +1,25 @@
 # -*- mode: python -*-
 
-from django.db import models
-from django.db.models import Count, JSONField, Max, Q
+import datetime
+from collections import defaultdict
+
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.db import IntegrityError, models, transaction
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    JSONField,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, Greatest, TruncDate
 from django.utils import timezone
 
 
@@ -24,14 +42,34 @@ class Event(models.Model):
     )
     time = models.DateTimeField(db_index=True)
     data = JSONField()
+    schema = models.ForeignKey(
+        "EventSchema",
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        db_index=False,
+        related_name="+",
+        help_text="if set, data is a compact array of values for the schema's keys",
+    )
     objects = EventQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.addr}:{self.name} @ {self.time.isoformat()}"
 
+    def get_data(self):
+        """Returns the data as a dict, whether or not it's been compacted"""
+        if self.schema_id is None:
+            return self.data
+        return self.schema.decode(self.data)
+
     class Meta:
         unique_together = ("addr", "name", "time")
-        indexes = [models.Index(fields=["addr", "-time"], name="addr_time_desc_idx")]
+        indexes = [
+            models.Index(fields=["addr", "-time"], name="addr_time_desc_idx"),
+            GinIndex(
+                fields=["data"], opclasses=["jsonb_path_ops"], name="event_data_gin_idx"
+            ),
+        ]
         ordering = ("-time",)
 
 
@@ -65,15 +103,43 @@ class Trial(models.Model):
     class Meta:
         unique_together = ("name", "subject", "time")
         indexes = [
-            models.Index(fields=["subject", "-time"], name="subject_time_desc_idx")
+            models.Index(fields=["subject", "-time"], name="subject_time_desc_idx"),
+            GinIndex(
+                fields=["data"], opclasses=["jsonb_path_ops"], name="trial_data_gin_idx"
+            ),
         ]
         ordering = ("-time",)
 
 
 class ControllerQuerySet(models.QuerySet):
     def with_counts(self):
+        """Annotate with the number and latest time of events, including archived ones"""
+        archived = (
+            EventDailySummary.objects.filter(controller=OuterRef("pk"))
+            .order_by()
+            .values("controller")
+        )
+        return self.annotate(
+            n_events=Count("event")
+            + Coalesce(
+                Subquery(archived.annotate(n=Sum("n_events")).values("n")),
+                0,
+                output_field=models.BigIntegerField(),
+            ),
+            # GREATEST ignores nulls in PostgreSQL
+            last_event_time=Greatest(
+                Max("event__time"),
+                Subquery(archived.annotate(last=Max("last_time")).values("last")),
+            ),
+        )
+
+    def with_stats(self):
+        """Like with_counts(), but uses the running totals in ControllerStats"""
         return self.annotate(
-            n_events=Count("event"), last_event_time=Max("event__time")
+            n_events=Coalesce(
+                F("stats__n_events"), 0, output_field=models.BigIntegerField()
+            ),
+            last_event_time=F("stats__last_event_time"),
         )
 
 
@@ -117,6 +183,23 @@ class SubjectQuerySet(models.QuerySet):
             n_trials_today=Count("trial", filter=Q(trial__time__gte=today_start)),
         )
 
+    def with_stats(self):
+        """Like with_counts(), but uses the running totals in SubjectStats"""
+        return self.annotate(
+            n_trials=Coalesce(
+                F("stats__n_trials"), 0, output_field=models.BigIntegerField()
+            ),
+            last_trial_time=F("stats__last_trial_time"),
+            n_trials_today=Case(
+                When(
+                    stats__last_trial_date=timezone.localdate(),
+                    then=F("stats__n_trials_last_date"),
+                ),
+                default=0,
+                output_field=models.IntegerField(),
+            ),
+        )
+
 
 class Subject(models.Model):
     """Represents an experimental subject"""
@@ -126,14 +209,423 @@ class Subject(models.Model):
     objects = SubjectQuerySet.as_manager()
 
     def n_trials_today(self):
-        today_start = timezone.localtime(timezone.now()).replace(
-            hour=0, minute=0, second=0
+        return (
+            self.daily_stats.filter(date=timezone.localdate()).aggregate(
+                n=Sum("n_trials")
+            )["n"]
+            or 0
         )
-        today_end = today_start.replace(hour=23, minute=59, second=59)
-        return self.trial_set.filter(time__gte=today_start, time__lte=today_end).count()
 
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ("name",)
+
+
+def _update_or_create(manager, key, updates, defaults):
+    """Apply updates to the row identified by key, or create it with defaults.
+
+    This takes one UPDATE statement if the row already exists.
+    """
+    if manager.filter(**key).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            manager.create(**key, **defaults)
+    except IntegrityError:
+        # another process created the row first
+        manager.filter(**key).update(**updates)
+
+
+class ControllerStatsManager(models.Manager):
+    def record(self, events):
+        """Add newly inserted events to the running totals for their controllers"""
+        totals = defaultdict(lambda: [0, None])
+        for event in events:
+            total = totals[event.addr_id]
+            total[0] += 1
+            if total[1] is None or event.time > total[1]:
+                total[1] = event.time
+        with transaction.atomic():
+            for controller_id, (n, last) in sorted(totals.items()):
+                _update_or_create(
+                    self,
+                    {"controller_id": controller_id},
+                    {
+                        "n_events": F("n_events") + n,
+                        "last_event_time": Greatest(
+                            Coalesce(F("last_event_time"), Value(last)), Value(last)
+                        ),
+                    },
+                    {"n_events": n, "last_event_time": last},
+                )
+
+    def rebuild(self, controllers=None):
+        """Recompute the totals from the event table and the summaries of archived
+        events. Returns the number of controllers"""
+        events = Event.objects.all()
+        archived = EventDailySummary.objects.all()
+        if controllers is not None:
+            events = events.filter(addr__in=controllers)
+            archived = archived.filter(controller__in=controllers)
+        totals = defaultdict(lambda: [0, None])
+        for rows in (
+            events.values_list("addr").annotate(n=Count("id"), last=Max("time")),
+            archived.values_list("controller")
+            .annotate(n=Sum("n_events"), last=Max("last_time"))
+            .order_by(),
+        ):
+            for controller_id, n, last in rows:
+                total = totals[controller_id]
+                total[0] += n
+                if total[1] is None or last > total[1]:
+                    total[1] = last
+        with transaction.atomic():
+            stale = self.all()
+            if controllers is not None:
+                stale = stale.filter(controller__in=controllers)
+            stale.delete()
+            return len(
+                self.bulk_create(
+                    self.model(
+                        controller_id=controller_id, n_events=n, last_event_time=last
+                    )
+                    for controller_id, (n, last) in totals.items()
+                )
+            )
+
+
+class EventSchemaManager(models.Manager):
+    def positions(self):
+        """Maps each key to the (schema id, index) pairs of the schemas it's in"""
+        positions = defaultdict(list)
+        for schema_id, keys in self.values_list("id", "keys"):
+            for index, key in enumerate(keys):
+                positions[key].append((schema_id, index))
+        return dict(positions)
+
+
+class EventSchema(models.Model):
+    """The keys of event payloads that are stored compactly.
+
+    Most components always report the same few keys. Events compacted by
+    `compact_events` store their data as an array of values, in the order of
+    the keys in their schema, instead of repeating the keys in every row.
+    """
+
+    id = models.AutoField(primary_key=True)
+    component = models.ForeignKey("Component", on_delete=models.PROTECT)
+    keys = ArrayField(models.TextField())
+    objects = EventSchemaManager()
+
+    def __str__(self):
+        return f"{self.component_id}:{','.join(self.keys)}"
+
+    def encode(self, data):
+        return [data[key] for key in self.keys]
+
+    def decode(self, values):
+        return dict(zip(self.keys, values, strict=True))
+
+    class Meta:
+        unique_together = ("component", "keys")
+
+
+class EventDailySummaryManager(models.Manager):
+    def record(self, events):
+        """Add events that are being archived to the daily totals"""
+        tz = timezone.get_current_timezone()
+        totals = defaultdict(lambda: [0, None])
+        for event in events:
+            time = event["time"]
+            total = totals[(event["addr"], event["name"], time.astimezone(tz).date())]
+            total[0] += 1
+            if total[1] is None or time > total[1]:
+                total[1] = time
+        self.record_totals(totals)
+
+    def record_totals(self, totals):
+        """Add totals, a dict mapping (controller id, component id, date) to
+        (number of events, time of the last one), to the daily totals"""
+        with transaction.atomic():
+            for (controller_id, name_id, date), (n, last) in sorted(totals.items()):
+                _update_or_create(
+                    self,
+                    {"controller_id": controller_id, "name_id": name_id, "date": date},
+                    {
+                        "n_events": F("n_events") + n,
+                        "last_time": Greatest(F("last_time"), Value(last)),
+                    },
+                    {"n_events": n, "last_time": last},
+                )
+
+
+class EventDailySummary(models.Model):
+    """Daily totals of the events that have been archived and removed.
+
+    There is one row for each controller, component and date (in the local
+    time zone), so that event counts stay correct after the events are gone.
+    """
+
+    id = models.AutoField(primary_key=True)
+    controller = models.ForeignKey(
+        "Controller", on_delete=models.CASCADE, related_name="archived_events"
+    )
+    name = models.ForeignKey(
+        "Component", on_delete=models.CASCADE, help_text="the name of the component"
+    )
+    date = models.DateField()
+    n_events = models.PositiveBigIntegerField(default=0)
+    last_time = models.DateTimeField()
+    objects = EventDailySummaryManager()
+
+    def __str__(self):
+        return f"{self.controller_id}:{self.name_id} @ {self.date}"
+
+    class Meta:
+        unique_together = ("controller", "name", "date")
+        ordering = ("date", "name")
+
+
+class ControllerStats(models.Model):
+    """Running totals of the events recorded for each controller.
+
+    These are updated as events are ingested so that the controller list
+    doesn't need to aggregate over the entire event table.
+    """
+
+    controller = models.OneToOneField(
+        "Controller", primary_key=True, on_delete=models.CASCADE, related_name="stats"
+    )
+    n_events = models.PositiveBigIntegerField(default=0)
+    last_event_time = models.DateTimeField(null=True)
+    objects = ControllerStatsManager()
+
+    def __str__(self):
+        return f"{self.controller_id}: {self.n_events} event(s)"
+
+
+class SubjectStatsManager(models.Manager):
+    def record(self, trials):
+        """Add newly inserted trials to the running totals for their subjects"""
+        tz = timezone.get_current_timezone()
+        # n, last time, last date, n on last date
+        totals = defaultdict(lambda: [0, None, None, 0])
+        for trial in trials:
+            total = totals[trial.subject_id]
+            total[0] += 1
+            if total[1] is None or trial.time > total[1]:
+                total[1] = trial.time
+            date = trial.time.astimezone(tz).date()
+            if total[2] is None or date > total[2]:
+                total[2:] = [date, 1]
+            elif date == total[2]:
+                total[3] += 1
+        with transaction.atomic():
+            # only the latest date in the batch can become the last date
+            for subject_id, (n, last, date, n_date) in sorted(totals.items()):
+                _update_or_create(
+                    self,
+                    {"subject_id": subject_id},
+                    {
+                        "n_trials": F("n_trials") + n,
+                        "last_trial_time": Greatest(
+                            Coalesce(F("last_trial_time"), Value(last)), Value(last)
+                        ),
+                        "last_trial_date": Greatest(
+                            Coalesce(F("last_trial_date"), Value(date)), Value(date)
+                        ),
+                        "n_trials_last_date": Case(
+                            When(
+                                last_trial_date=date,
+                                then=F("n_trials_last_date") + n_date,
+                            ),
+                            When(
+                                Q(last_trial_date__lt=date)
+                                | Q(last_trial_date__isnull=True),
+                                then=Value(n_date),
+                            ),
+                            default=F("n_trials_last_date"),
+                            output_field=models.PositiveIntegerField(),
+                        ),
+                    },
+                    {
+                        "n_trials": n,
+                        "last_trial_time": last,
+                        "last_trial_date": date,
+                        "n_trials_last_date": n_date,
+                    },
+                )
+
+    def rebuild(self, subjects=None):
+        """Recompute the totals from the trial table. Returns the number of subjects"""
+        trials = Trial.objects.all()
+        if subjects is not None:
+            trials = trials.filter(subject__in=subjects)
+        totals = trials.values("subject").annotate(n=Count("id"), last=Max("time"))
+        with transaction.atomic():
+            stale = self.all()
+            if subjects is not None:
+                stale = stale.filter(subject__in=subjects)
+            stale.delete()
+            stats = []
+            for row in totals:
+                date = timezone.localdate(row["last"])
+                day_start = timezone.make_aware(
+                    datetime.datetime.combine(date, datetime.time())
+                )
+                stats.append(
+                    self.model(
+                        subject_id=row["subject"],
+                        n_trials=row["n"],
+                        last_trial_time=row["last"],
+                        last_trial_date=date,
+                        n_trials_last_date=trials.filter(
+                            subject=row["subject"], time__gte=day_start
+                        ).count(),
+                    )
+                )
+            return len(self.bulk_create(stats))
+
+
+class SubjectStats(models.Model):
+    """Running totals of the trials recorded for each subject.
+
+    These are updated as trials are ingested so that the subject list doesn't
+    need to aggregate over the entire trial table. Only the count for the most
+    recent day with trials is kept.
+    """
+
+    subject = models.OneToOneField(
+        "Subject", primary_key=True, on_delete=models.CASCADE, related_name="stats"
+    )
+    n_trials = models.PositiveBigIntegerField(default=0)
+    last_trial_time = models.DateTimeField(null=True)
+    last_trial_date = models.DateField(null=True)
+    n_trials_last_date = models.PositiveIntegerField(default=0)
+    objects = SubjectStatsManager()
+
+    def __str__(self):
+        return f"{self.subject_id}: {self.n_trials} trial(s)"
+
+
+def _is_response(data):
+    return data.get("response") not in (None, "timeout")
+
+
+def daily_trial_totals():
+    """Aggregates for the columns of DailyTrialStats, counted like record() does.
+
+    Shared by DailyTrialStatsManager.rebuild() and the migration that fills the
+    table, so that both agree with the totals kept during ingest.
+    """
+    return {
+        "n_trials": Count("id"),
+        "n_scored": Count("id", filter=Q(data__has_key="correct")),
+        "n_correct": Count("id", filter=Q(data__correct=True)),
+        # the same test as _is_response(): present, not JSON null, and not a
+        # timeout
+        "n_responses": Count(
+            "id",
+            filter=Q(data__response__isnull=False)
+            & ~Q(data__response=None)
+            & ~Q(data__response="timeout"),
+        ),
+    }
+
+
+class DailyTrialStatsManager(models.Manager):
+    def record(self, trials):
+        """Add newly inserted trials to the daily totals"""
+        tz = timezone.get_current_timezone()
+        totals = defaultdict(lambda: [0, 0, 0, 0])
+        for trial in trials:
+            date = trial.time.astimezone(tz).date()
+            total = totals[(trial.subject_id, trial.name_id, date)]
+            total[0] += 1
+            total[1] += "correct" in trial.data
+            total[2] += trial.data.get("correct") is True
+            total[3] += _is_response(trial.data)
+        with transaction.atomic():
+            for (subject_id, name_id, date), counts in sorted(totals.items()):
+                n_trials, n_scored, n_correct, n_responses = counts
+                _update_or_create(
+                    self,
+                    {"subject_id": subject_id, "name_id": name_id, "date": date},
+                    {
+                        "n_trials": F("n_trials") + n_trials,
+                        "n_scored": F("n_scored") + n_scored,
+                        "n_correct": F("n_correct") + n_correct,
+                        "n_responses": F("n_responses") + n_responses,
+                    },
+                    {
+                        "n_trials": n_trials,
+                        "n_scored": n_scored,
+                        "n_correct": n_correct,
+                        "n_responses": n_responses,
+                    },
+                )
+
+    def rebuild(self, subjects=None):
+        """Recompute the daily totals from the trial table. Returns the number of rows"""
+        trials = Trial.objects.all()
+        if subjects is not None:
+            trials = trials.filter(subject__in=subjects)
+        totals = (
+            trials.annotate(date=TruncDate("time"))
+            .values("subject", "name", "date")
+            .annotate(**daily_trial_totals())
+            .order_by()
+        )
+        with transaction.atomic():
+            stale = self.all()
+            if subjects is not None:
+                stale = stale.filter(subject__in=subjects)
+            stale.delete()
+            return len(
+                self.bulk_create(
+                    self.model(
+                        subject_id=row["subject"],
+                        name_id=row["name"],
+                        date=row["date"],
+                        n_trials=row["n_trials"],
+                        n_scored=row["n_scored"],
+                        n_correct=row["n_correct"],
+                        n_responses=row["n_responses"],
+                    )
+                    for row in totals
+                )
+            )
+
+
+class DailyTrialStats(models.Model):
+    """Daily totals of the trials for each subject and procedure.
+
+    `n_scored` is the number of trials with a `correct` field, of which
+    `n_correct` were correct. `n_responses` is the number of trials with a
+    `response` other than "timeout". Dates are in the local time zone.
+    """
+
+    id = models.AutoField(primary_key=True)
+    subject = models.ForeignKey(
+        "Subject", on_delete=models.CASCADE, related_name="daily_stats"
+    )
+    name = models.ForeignKey(
+        "Component",
+        on_delete=models.CASCADE,
+        help_text="the experiment paradigm (e.g., shape)",
+    )
+    date = models.DateField()
+    n_trials = models.PositiveIntegerField(default=0)
+    n_scored = models.PositiveIntegerField(default=0)
+    n_correct = models.PositiveIntegerField(default=0)
+    n_responses = models.PositiveIntegerField(default=0)
+    objects = DailyTrialStatsManager()
+
+    def __str__(self):
+        return f"{self.subject_id}:{self.name_id} @ {self.date}"
+
+    class Meta:
+        unique_together = ("subject", "name", "date")
+        ordering = ("date", "name")
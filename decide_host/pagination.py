@@ -0,0 +1,420 @@
+# -*- mode: python -*-
+
+import base64
+import binascii
+import json
+import time
+
+from django.conf import settings
+from django.core.paginator import (
+    EmptyPage,
+    InvalidPage,
+    Page,
+    PageNotAnInteger,
+    Paginator,
+)
+from django.db import connections
+from django.db.models import Max, Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from drf_link_header_pagination import LinkHeaderPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def link_header(links):
+    """Format a sequence of (url, rel) pairs as a Link header, skipping empty urls"""
+    links = [f'<{url}>; rel="{rel}"' for url, rel in links if url is not None]
+    return {"Link": ", ".join(links)} if links else {}
+
+
+def estimate_count(queryset):
+    """Returns the query planner's estimate of the number of rows in queryset.
+
+    Returns None if the database can't provide an estimate.
+    """
+    if connections[queryset.db].vendor != "postgresql":
+        return None
+    plan = json.loads(queryset.order_by().explain(format="json"))
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class EstimatedCountPaginator(Paginator):
+    """A Paginator that only counts the rows in the queryset when that is cheap.
+
+    If the planner estimates that the queryset has more rows than
+    DECIDE_HOST["EXACT_COUNT_LIMIT"], `count` and `num_pages` are None, and
+    pages are fetched with one extra row to find out if there is a next page.
+    Set the limit to None to always count.
+    """
+
+    @property
+    def exact_count_limit(self):
+        return getattr(settings, "DECIDE_HOST", {}).get("EXACT_COUNT_LIMIT", 100_000)
+
+    @cached_property
+    def count(self):
+        limit = self.exact_count_limit
+        if limit is not None:
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate > limit:
+                return None
+        return super().count
+
+    @cached_property
+    def num_pages(self):
+        if self.count is None:
+            return None
+        return super().num_pages
+
+    def validate_number(self, number):
+        if self.count is not None:
+            return super().validate_number(number)
+        # the upper bound can't be checked without a count
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages["invalid_page"]) from None
+        if number < 1:
+            raise EmptyPage(self.error_messages["min_page"])
+        return number
+
+    def page(self, number):
+        if self.count is not None:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        objects = list(self.object_list[bottom : bottom + self.per_page + 1])
+        if not objects and number > 1:
+            raise InvalidPage(self.error_messages["no_results"])
+        return UncountedPage(
+            objects[: self.per_page], number, self, len(objects) > self.per_page
+        )
+
+
+class UncountedPage(Page):
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def end_index(self):
+        return (self.number - 1) * self.paginator.per_page + len(self)
+
+
+class LinkHeaderPaginationByTimestamp(LinkHeaderPagination):
+    ordering = "-time"
+    django_paginator_class = EstimatedCountPaginator
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        paginator = self.django_paginator_class(queryset, page_size)
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            msg = self.invalid_page_message.format(
+                page_number=page_number, message=str(exc)
+            )
+            raise NotFound(msg) from exc
+        if paginator.num_pages is not None and paginator.num_pages > 1:
+            self.display_page_controls = self.template is not None
+        return list(self.page)
+
+    def get_page_number(self, request, paginator):
+        page_number = request.query_params.get(self.page_query_param) or 1
+        if page_number in self.last_page_strings:
+            if paginator.num_pages is None:
+                raise NotFound("The last page is not available for this query.")
+            page_number = paginator.num_pages
+        return page_number
+
+    def get_last_link(self):
+        if self.page.paginator.num_pages is None:
+            return None
+        return super().get_last_link()
+
+
+class KeysetPaginationByTimestamp(BasePagination):
+    """Paginates records in reverse chronological order using a (time, id) keyset.
+
+    The cursor in the `next` and `prev` links encodes the position of the last
+    or first record on the current page, so each page is an index range scan
+    that costs the same no matter how deep into the history it is, and no
+    count of the whole queryset is needed.
+
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.get_page_queryset(queryset, request)
+        if queryset is None:
+            return None
+        return self.set_page(list(queryset))
+
+    def get_page_queryset(self, queryset, request):
+        """Returns the queryset for the requested page, including one extra row.
+
+        Async views can evaluate this queryset themselves and then call
+        set_page() with the result.
+        """
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.position, self.reverse = self.decode_cursor(request)
+        if self.position is None:
+            queryset = queryset.order_by("-time", "-id")
+        else:
+            time, pk = self.position
+            if self.reverse:
+                queryset = queryset.filter(time__gte=time).filter(
+                    Q(time__gt=time) | Q(id__gt=pk)
+                )
+                queryset = queryset.order_by("time", "id")
+            else:
+                queryset = queryset.filter(time__lte=time).filter(
+                    Q(time__lt=time) | Q(id__lt=pk)
+                )
+                queryset = queryset.order_by("-time", "-id")
+        return queryset[: self.page_size + 1]
+
+    def set_page(self, results):
+        """Sets the current page from the rows of get_page_queryset() and returns it"""
+        has_more = len(results) > self.page_size
+        del results[self.page_size :]
+        if self.reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.position is not None
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(data, headers=link_header(self.get_links()))
+
+    def get_links(self):
+        return (
+            (self.get_first_link(), "first"),
+            (self.get_previous_link(), "prev"),
+            (self.get_next_link(), "next"),
+        )
+
+    def get_first_link(self):
+        if not self.has_previous:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, "")
+
+    def get_next_link(self):
+        if not (self.has_next and self.page):
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not (self.has_previous and self.page):
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, row, reverse):
+        time, pk = row_position(row)
+        token = f"{time.isoformat()}|{pk}|{int(reverse)}"
+        encoded = base64.urlsafe_b64encode(token.encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        """Returns ((time, id), reverse), or (None, False) for the first page"""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            token = base64.urlsafe_b64decode(encoded.encode("ascii")).decode("ascii")
+            time, pk, reverse = token.split("|")
+            time = parse_datetime(time)
+            if time is None:
+                raise ValueError
+            return (time, int(pk)), bool(int(reverse))
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message) from None
+
+
+def row_position(row):
+    """The (time, id) keyset of a model instance or values() row"""
+    if isinstance(row, dict):
+        return row["time"], row["id"]
+    return row.time, row.id
+
+
+# the transactions (other than this one) in this database that are writing to
+# a table, and that started less than a given number of seconds ago. Each holds
+# a RowExclusiveLock on the table until it finishes. The start time of another
+# user's transaction may be hidden, in which case it counts as recent.
+WRITING_TRANSACTIONS = """
+    SELECT l.virtualtransaction FROM pg_locks l JOIN pg_stat_activity a USING (pid)
+    WHERE l.locktype = 'relation' AND l.mode = 'RowExclusiveLock' AND l.granted
+    AND l.database = (SELECT oid FROM pg_database WHERE datname = current_database())
+    AND l.relation = %s::regclass AND l.pid <> pg_backend_pid()
+    AND COALESCE(a.xact_start, clock_timestamp())
+        > clock_timestamp() - make_interval(secs => %s)
+"""
+
+
+def settled_id(queryset, timeout, max_hold):
+    """Returns the largest id below which no more records can appear in queryset.
+
+    Ids are assigned when a record is inserted, but transactions commit in a
+    different order, so a record may become visible after others with higher
+    ids. This finds the largest committed id and then waits (up to `timeout`
+    seconds) for the transactions that were writing to the table at that point
+    to finish, after which every record with a smaller id has either committed
+    or rolled back. Returns None if they're still running. Transactions that
+    started more than `max_hold` seconds ago aren't waited for, so that one
+    that is stuck can't hold back the feed forever.
+    """
+    connection = connections[queryset.db]
+    table = connection.ops.quote_name(queryset.model._meta.db_table)
+    deadline = time.monotonic() + timeout
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT (SELECT MAX(id) FROM {table}), ARRAY({WRITING_TRANSACTIONS})",
+            [table, max_hold],
+        )
+        last, running = cursor.fetchone()
+        while running:
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.01)
+            cursor.execute(
+                f"SELECT ARRAY({WRITING_TRANSACTIONS} "
+                "AND l.virtualtransaction = ANY(%s))",
+                [table, max_hold, running],
+            )
+            running = cursor.fetchone()[0]
+    return last or 0
+
+
+class ChangeFeedPagination(BasePagination):
+    """Pages through the records inserted after the one with id `since_id`.
+
+    Records are returned in primary-key (i.e. insertion) order. The `next` link
+    is always included, so clients can store it as a high-water mark and
+    follow it later to fetch only what has been added since. Records are only
+    returned once every record with a lower id has been committed (see
+    `settled_id`), so following the links never skips one. If other inserts
+    are still in progress after DECIDE_HOST["CHANGE_FEED_SETTLE_TIMEOUT"]
+    seconds (default 1), the page is empty and the `next` link is unchanged.
+    Transactions that have been running for more than
+    DECIDE_HOST["CHANGE_FEED_MAX_HOLD"] seconds (default 60) are no longer
+    waited for, and records they commit later may be missed.
+
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    since_query_param = "since_id"
+    invalid_since_message = "Invalid since_id"
+
+    @property
+    def settle_timeout(self):
+        return getattr(settings, "DECIDE_HOST", {}).get(
+            "CHANGE_FEED_SETTLE_TIMEOUT", 1.0
+        )
+
+    @property
+    def max_hold(self):
+        return getattr(settings, "DECIDE_HOST", {}).get("CHANGE_FEED_MAX_HOLD", 60.0)
+
+    def get_since(self, request):
+        try:
+            since = int(request.query_params[self.since_query_param] or 0)
+        except ValueError:
+            raise NotFound(self.invalid_since_message) from None
+        if since < 0:
+            raise NotFound(self.invalid_since_message)
+        return since
+
+    def get_settled_queryset(self, queryset, request):
+        """Limits queryset to the settled records after since_id"""
+        self.base_url = request.build_absolute_uri()
+        self.since = self.get_since(request)
+        last = settled_id(queryset, self.settle_timeout, self.max_hold)
+        if last is None:
+            return queryset.none()
+        return queryset.filter(id__gt=self.since, id__lte=last)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.get_settled_queryset(queryset, request).order_by("id")
+        if self.page_size:
+            queryset = queryset[: self.page_size]
+        self.page = list(queryset)
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(data, headers=link_header(self.get_links()))
+
+    def get_links(self):
+        return ((self.get_next_link(), "next"),)
+
+    def get_next_link(self):
+        last = row_id(self.page[-1]) if self.page else self.since
+        return replace_query_param(self.base_url, self.since_query_param, last)
+
+    def get_export_queryset(self, queryset, request):
+        """Returns the queryset to stream for an export, and the Link headers.
+
+        The export is limited to the records that were present when it started,
+        so that the `next` link can be sent before the records.
+        """
+        queryset = self.get_settled_queryset(queryset, request)
+        last = queryset.aggregate(last=Max("id"))["last"] or self.since
+        self.page = []
+        self.since = last
+        queryset = queryset.filter(id__lte=last).order_by("id")
+        return queryset, link_header(self.get_links())
+
+
+def row_id(row):
+    return row["id"] if isinstance(row, dict) else row.id
+
+
+class TimestampPagination(BasePagination):
+    """Chooses between page-number and keyset pagination for each request.
+
+    Requests with a `since_id` parameter get the change feed. Requests with a
+    `cursor` query parameter (which may be empty, to start from the most recent
+    records) use keyset pagination, as do requests without a `page` parameter if
+    DECIDE_HOST["PAGINATION"] is set to "keyset". Otherwise the page-number
+    links are used.
+
+    """
+
+    page_class = LinkHeaderPaginationByTimestamp
+    keyset_class = KeysetPaginationByTimestamp
+    change_feed_class = ChangeFeedPagination
+
+    def get_paginator(self, request):
+        params = request.query_params
+        if self.change_feed_class.since_query_param in params:
+            return self.change_feed_class()
+        if self.keyset_class.cursor_query_param in params:
+            return self.keyset_class()
+        default = getattr(settings, "DECIDE_HOST", {}).get("PAGINATION", "page")
+        if default == "keyset" and self.page_class.page_query_param not in params:
+            return self.keyset_class()
+        return self.page_class()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.paginator = self.get_paginator(request)
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
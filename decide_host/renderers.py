@@ -0,0 +1,258 @@
+# -*- mode: python -*-
+
+import csv
+import io
+import itertools
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = pq = None
+
+# approximate size of the chunks sent to the client when streaming
+CHUNK_SIZE = 64 * 1024
+
+
+def _as_rows(data):
+    if data is None:
+        return []
+    if isinstance(data, dict):
+        return [data]
+    return data
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Renders a list of records as newline-delimited JSON.
+
+    Views can also pass an iterable of records to `stream()` to produce the
+    output incrementally.
+    """
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b"".join(self.stream(_as_rows(data)))
+
+    def stream(self, rows):
+        chunk = []
+        size = 0
+        for row in rows:
+            line = json.dumps(row, cls=JSONEncoder, ensure_ascii=False) + "\n"
+            chunk.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield "".join(chunk).encode("utf-8")
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk).encode("utf-8")
+
+
+class CSVRenderer(BaseRenderer):
+    """Renders a list of records as comma-separated values.
+
+    The columns are taken from the first `header_sample_size` records, so
+    fields that only appear later in a stream are dropped. Nested values are
+    encoded as JSON.
+    """
+
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+    header_sample_size = 1000
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b"".join(self.stream(_as_rows(data)))
+
+    def stream(self, rows):
+        rows = iter(rows)
+        sample = list(itertools.islice(rows, self.header_sample_size))
+        fieldnames = list(dict.fromkeys(key for row in sample for key in row))
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        for row in itertools.chain(sample, rows):
+            writer.writerow(
+                {
+                    key: json.dumps(value) if isinstance(value, dict | list) else value
+                    for key, value in row.items()
+                }
+            )
+            if buffer.tell() >= CHUNK_SIZE:
+                yield buffer.getvalue().encode(self.charset)
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode(self.charset)
+
+
+class _Drain(io.RawIOBase):
+    """A write-only file that hands back what was written since the last drain()"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _column_type(values):
+    types = {type(value) for value in values if value is not None}
+    if types == {bool}:
+        return pa.bool_()
+    if types == {int}:
+        return pa.int64()
+    if types and types <= {int, float}:
+        return pa.float64()
+    return pa.string()
+
+
+def _is_number(value, *types):
+    # bool is a subclass of int, but it shouldn't be counted as a number
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def _column_values(values, column_type):
+    if column_type == pa.bool_():
+        return [v if isinstance(v, bool) else None for v in values]
+    if column_type == pa.int64():
+        return [v if _is_number(v, int) else None for v in values]
+    if column_type == pa.float64():
+        return [float(v) if _is_number(v, int, float) else None for v in values]
+    return [
+        v if v is None or isinstance(v, str) else json.dumps(v, cls=JSONEncoder)
+        for v in values
+    ]
+
+
+class ColumnarRenderer(BaseRenderer):
+    """Base class for renderers that write records as typed columns with pyarrow.
+
+    Records are converted in batches of `batch_size`. The columns and their
+    types are taken from the first batch: keys that only appear later are
+    dropped, integers are widened to floats if the column also has fractional
+    numbers, and columns with any other mix of types (or nested values, which
+    are encoded as JSON) are written as strings. In later batches, values that
+    don't match the type of their column are written as nulls. Fields in
+    `timestamp_fields` are converted from ISO 8601 strings to UTC timestamps.
+    """
+
+    charset = None
+    batch_size = 50_000
+    timestamp_fields = ("time",)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b"".join(self.stream(_as_rows(data)))
+
+    def open_writer(self, sink, schema):
+        raise NotImplementedError
+
+    def stream(self, rows):
+        rows = iter(rows)
+        sink = _Drain()
+        batch = list(itertools.islice(rows, self.batch_size))
+        schema = self.infer_schema(batch)
+        writer = self.open_writer(sink, schema)
+        while batch:
+            writer.write_batch(self.make_batch(batch, schema))
+            yield sink.drain()
+            batch = list(itertools.islice(rows, self.batch_size))
+        writer.close()
+        yield sink.drain()
+
+    def infer_schema(self, rows):
+        names = list(dict.fromkeys(key for row in rows for key in row))
+        fields = []
+        for name in names:
+            column_type = _column_type(row.get(name) for row in rows)
+            if name in self.timestamp_fields and column_type == pa.string():
+                column = pa.array([row.get(name) for row in rows], pa.string())
+                try:
+                    column_type = column.cast(pa.timestamp("us", tz="UTC")).type
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                    pass
+            fields.append(pa.field(name, column_type))
+        return pa.schema(fields)
+
+    def make_batch(self, rows, schema):
+        columns = []
+        for field in schema:
+            values = [row.get(field.name) for row in rows]
+            if pa.types.is_timestamp(field.type):
+                column = pa.array(values, pa.string()).cast(field.type)
+            else:
+                column = pa.array(_column_values(values, field.type), field.type)
+            columns.append(column)
+        return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+class ParquetRenderer(ColumnarRenderer):
+    """Renders a list of records as a Parquet file, with one row group per batch"""
+
+    media_type = "application/vnd.apache.parquet"
+    format = "parquet"
+    compression = "zstd"
+
+    def open_writer(self, sink, schema):
+        return pq.ParquetWriter(sink, schema, compression=self.compression)
+
+
+class ArrowRenderer(ColumnarRenderer):
+    """Renders a list of records in the Arrow IPC streaming format"""
+
+    media_type = "application/vnd.apache.arrow.stream"
+    format = "arrow"
+
+    def open_writer(self, sink, schema):
+        return pa.ipc.new_stream(sink, schema)
+
+
+# these need the optional pyarrow package
+COLUMNAR_RENDERERS = () if pa is None else (ParquetRenderer, ArrowRenderer)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Renders a list of records as server-sent events.
+
+    Each record is sent as one message, with its database id as the message
+    id so that a reconnecting client can resume with Last-Event-ID.
+    """
+
+    media_type = "text/event-stream"
+    format = "sse"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict) and "detail" in data:
+            # errors are sent as a single message
+            return self.message(data, event="error")
+        return b"".join(self.message(row, id=row.get("id")) for row in _as_rows(data))
+
+    def message(self, data, id=None, event=None):
+        lines = []
+        if id is not None:
+            lines.append(f"id: {id}")
+        if event is not None:
+            lines.append(f"event: {event}")
+        lines.append("data: " + json.dumps(data, cls=JSONEncoder, ensure_ascii=False))
+        return ("\n".join(lines) + "\n\n").encode(self.charset)
@@ -0,0 +1,66 @@
+# -*- mode: python -*-
+"""Shared cache of controller and subject responses.
+
+Cached responses are keyed on version counters, which are stored in the same
+cache and bumped (see `decide_host.signals`) when records are written for the
+controller or subject they depend on. Bumping a counter makes every entry that
+used the old value unreachable, so nothing has to be deleted and other worker
+processes see the change immediately. Entries also expire after
+DECIDE_HOST["RESPONSE_CACHE_TIMEOUT"] seconds, to bound how long changes made
+without sending signals (e.g. with raw SQL) can go unnoticed.
+
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def get_cache():
+    """Returns the cache named by DECIDE_HOST["RESPONSE_CACHE"], or None if unset"""
+    alias = getattr(settings, "DECIDE_HOST", {}).get("RESPONSE_CACHE")
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def get_timeout():
+    return getattr(settings, "DECIDE_HOST", {}).get("RESPONSE_CACHE_TIMEOUT", 60)
+
+
+def version_key(scope):
+    return f"decide_host:version:{scope}"
+
+
+def get_versions(cache, scopes):
+    """Returns the current values of the version counters for scopes"""
+    keys = [version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # start evicted counters somewhere new so old entries stay unreachable
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return tuple(versions[key] for key in keys)
+
+
+def make_key(cache, scopes, *parts):
+    """Returns a cache key for a response that depends on scopes and parts"""
+    versions = get_versions(cache, scopes)
+    digest = hashlib.sha1(repr((versions, parts)).encode()).hexdigest()
+    return f"decide_host:response:{digest}"
+
+
+def bump(scopes):
+    """Invalidates the cached responses that depend on any of scopes"""
+    cache = get_cache()
+    if cache is None:
+        return
+    for scope in scopes:
+        key = version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
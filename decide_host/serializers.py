@@ -1,22 +1,42 @@
 # -*- mode: python -*-
 
+import copy
 import datetime
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import QuerySet
+from django.db.models.manager import BaseManager
+from django.db.models.query import ModelIterable
 from django.utils.encoding import smart_str
-from django.utils.timezone import make_aware
-from rest_framework import serializers
+from django.utils.functional import cached_property
+from django.utils.timezone import is_aware, make_aware
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
 
-from decide_host.models import Component, Controller, Event, Subject, Trial
+from decide_host.lookups import slug_cache
+from decide_host.models import (
+    Component,
+    Controller,
+    DailyTrialStats,
+    Event,
+    Subject,
+    Trial,
+)
 
 # ideally, I'd like to flatten the JSON so that all the data fields are at the
 # top level. This simplifies the representation
 
 
 class CreatableSlugRelatedField(serializers.SlugRelatedField):
+    """Looks up related objects by slug, creating them if they don't exist.
+
+    Lookups go through the per-process slug cache, so only the first record
+    that refers to a controller, component, or subject needs to hit the database.
+    """
+
     def to_internal_value(self, data):
         try:
-            return self.get_queryset().get_or_create(**{self.slug_field: data})[0]
+            return slug_cache.get_or_create(self.get_queryset(), self.slug_field, data)
         except ObjectDoesNotExist:
             self.fail(
                 "does_not_exist", slug_name=self.slug_field, value=smart_str(data)
@@ -37,9 +57,36 @@ class MicroDateTimeField(serializers.DateTimeField):
             return super().to_internal_value(data)
 
 
+def datetime_converter(field):
+    """Returns a function equivalent to field.to_representation for aware datetimes.
+
+    The timezone and output format are looked up once rather than for every
+    value, which is most of the cost of serializing a timestamp.
+    """
+    output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+    if output_format is None or output_format.lower() != ISO_8601:
+        return field.to_representation
+    tz = field.timezone if hasattr(field, "timezone") else field.default_timezone()
+    if tz is None:
+        return field.to_representation
+
+    def to_representation(value):
+        if not value or not is_aware(value):
+            return field.to_representation(value)
+        value = value.astimezone(tz).isoformat()
+        if value.endswith("+00:00"):
+            value = value[:-6] + "Z"
+        return value
+
+    return to_representation
+
+
 class JSONFlattenMixin:
     """Flatens the specified related objects in this representation"""
 
+    # columns that get_values() selects in addition to the fields
+    extra_lookups = ("id", "time")
+
     def to_representation(self, obj):
         """Move fields from data to top-level"""
         try:
@@ -54,6 +101,39 @@ class JSONFlattenMixin:
             repr[key] = data[key]
         return repr
 
+    @cached_property
+    def value_readers(self):
+        """(output key, values() lookup, converter) for each of the readable fields"""
+        readers = []
+        for name, field in self.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SlugRelatedField):
+                readers.append((name, f"{field.source}__{field.slug_field}", None))
+            elif isinstance(field, serializers.DateTimeField):
+                readers.append((name, field.source, datetime_converter(field)))
+            else:
+                readers.append((name, field.source, None))
+        return readers
+
+    def get_values(self, queryset):
+        """Returns a values() queryset with the columns needed by flatten_values()"""
+        lookups = [lookup for _, lookup, _ in self.value_readers]
+        for key in self.extra_lookups:
+            if key not in lookups:
+                lookups.append(key)
+        return queryset.values(*lookups)
+
+    def flatten_values(self, row):
+        """Builds the same representation as to_representation() from a values() row"""
+        flatten_field = self.Meta.flatten
+        repr = {}
+        for key, lookup, converter in self.value_readers:
+            value = row[lookup]
+            repr[key] = value if converter is None else converter(value)
+        repr.update(repr.pop(flatten_field))
+        return repr
+
     def to_internal_value(self, data):
         """Nest fields not in Meta.fields"""
         try:
@@ -72,6 +152,27 @@ class JSONFlattenMixin:
         return internal
 
 
+class FlatListSerializer(serializers.ListSerializer):
+    """Serializes lists of records from values() rows when possible.
+
+    Building the flattened dicts directly from the rows avoids the overhead of
+    dispatching through the child serializer's fields for every record, which
+    costs more than the query for large pages. Querysets are converted to
+    values() querysets, and model instances are passed to the child serializer.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, BaseManager) else data
+        if isinstance(iterable, QuerySet) and iterable._iterable_class is ModelIterable:
+            iterable = self.child.get_values(iterable)
+        flatten_values = self.child.flatten_values
+        to_representation = self.child.to_representation
+        return [
+            flatten_values(item) if isinstance(item, dict) else to_representation(item)
+            for item in iterable
+        ]
+
+
 class ControllerSerializer(serializers.ModelSerializer):
     n_events = serializers.IntegerField(read_only=True)
     last_event_time = serializers.DateTimeField(read_only=True)
@@ -96,6 +197,26 @@ class SubjectSerializer(serializers.ModelSerializer):
         )
 
 
+class DailyTrialStatsSerializer(serializers.ModelSerializer):
+    name = serializers.SlugRelatedField(read_only=True, slug_field="name")
+    p_correct = serializers.SerializerMethodField()
+
+    class Meta:
+        model = DailyTrialStats
+        fields = (
+            "date",
+            "name",
+            "n_trials",
+            "n_scored",
+            "n_correct",
+            "n_responses",
+            "p_correct",
+        )
+
+    def get_p_correct(self, obj):
+        return obj.n_correct / obj.n_scored if obj.n_scored else None
+
+
 class EventSerializer(JSONFlattenMixin, serializers.ModelSerializer):
     addr = CreatableSlugRelatedField(
         queryset=Controller.objects.all(), slug_field="name"
@@ -110,6 +231,22 @@ class EventSerializer(JSONFlattenMixin, serializers.ModelSerializer):
         model = Event
         fields = ("addr", "name", "time", "data")
         flatten = "data"
+        list_serializer_class = FlatListSerializer
+
+    # compacted payloads are decoded with the keys of their schema
+    extra_lookups = ("id", "time", "schema__keys")
+
+    def to_representation(self, obj):
+        if getattr(obj, "schema_id", None) is not None:
+            obj = copy.copy(obj)
+            obj.data = obj.get_data()
+        return super().to_representation(obj)
+
+    def flatten_values(self, row):
+        keys = row["schema__keys"]
+        if keys is not None:
+            row = {**row, "data": dict(zip(keys, row["data"], strict=True))}
+        return super().flatten_values(row)
 
 
 class TrialSerializer(JSONFlattenMixin, serializers.ModelSerializer):
@@ -129,3 +266,4 @@ class TrialSerializer(JSONFlattenMixin, serializers.ModelSerializer):
         model = Trial
         fields = ("id", "addr", "name", "subject", "time", "data")
         flatten = "data"
+        list_serializer_class = FlatListSerializer
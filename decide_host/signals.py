@@ -0,0 +1,107 @@
+# -*- mode: python -*-
+"""Signal handlers that keep derived state consistent with the database"""
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from decide_host import response_cache
+from decide_host.lookups import slug_cache
+from decide_host.models import (
+    Component,
+    Controller,
+    ControllerStats,
+    DailyTrialStats,
+    Event,
+    Subject,
+    SubjectStats,
+    Trial,
+)
+from decide_host.streams import event_hub
+
+# Sent with `events` or `trials`, a list of newly inserted objects. Code that
+# inserts records without calling save() (e.g. bulk_create) must send these
+# itself.
+events_recorded = Signal()
+trials_recorded = Signal()
+
+
+def send_recorded(model, objects):
+    """Send events_recorded or trials_recorded for objects of type model"""
+    if model is Event:
+        events_recorded.send(sender=Event, events=objects)
+    elif model is Trial:
+        trials_recorded.send(sender=Trial, trials=objects)
+
+
+@receiver(post_save, sender=Controller)
+@receiver(post_save, sender=Component)
+@receiver(post_save, sender=Subject)
+@receiver(post_delete, sender=Controller)
+@receiver(post_delete, sender=Component)
+@receiver(post_delete, sender=Subject)
+def invalidate_slug_cache(sender, instance, **kwargs):
+    slug_cache.invalidate(sender, instance.pk)
+
+
+@receiver(post_save, sender=Controller)
+@receiver(post_delete, sender=Controller)
+def invalidate_controller_responses(sender, instance, **kwargs):
+    scopes = ("controllers", f"controller:{instance.pk}")
+    transaction.on_commit(lambda: response_cache.bump(scopes))
+
+
+@receiver(post_save, sender=Subject)
+@receiver(post_delete, sender=Subject)
+def invalidate_subject_responses(sender, instance, **kwargs):
+    scopes = ("subjects", f"subject:{instance.pk}")
+    transaction.on_commit(lambda: response_cache.bump(scopes))
+
+
+@receiver(post_save, sender=Event)
+def event_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        events_recorded.send(sender=Event, events=[instance])
+
+
+@receiver(post_save, sender=Trial)
+def trial_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        trials_recorded.send(sender=Trial, trials=[instance])
+
+
+@receiver(events_recorded)
+def update_controller_stats(sender, events, **kwargs):
+    ControllerStats.objects.record(events)
+
+
+@receiver(events_recorded)
+def notify_event_streams(sender, events, **kwargs):
+    controllers = {event.addr_id for event in events}
+    transaction.on_commit(lambda: event_hub.publish(controllers))
+
+
+@receiver(events_recorded)
+def events_invalidate_responses(sender, events, **kwargs):
+    scopes = {"controllers"} | {f"controller:{event.addr_id}" for event in events}
+    # after the commit, so that a response built from the old data can't be
+    # cached under the new version
+    transaction.on_commit(lambda: response_cache.bump(scopes))
+
+
+@receiver(trials_recorded)
+def trials_invalidate_responses(sender, trials, **kwargs):
+    scopes = {"subjects"} | {
+        f"subject:{trial.subject_id}" for trial in trials if trial.subject_id
+    }
+    transaction.on_commit(lambda: response_cache.bump(scopes))
+
+
+@receiver(trials_recorded)
+def update_subject_stats(sender, trials, **kwargs):
+    SubjectStats.objects.record(trials)
+
+
+@receiver(trials_recorded)
+def update_daily_trial_stats(sender, trials, **kwargs):
+    DailyTrialStats.objects.record(trials)
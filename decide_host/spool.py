@@ -0,0 +1,122 @@
+# -*- mode: python -*-
+"""Durable local queue for records that are waiting to be written to the database"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+
+class Spool:
+    """An append-only queue of records stored in a SQLite database.
+
+    The web workers append validated records and acknowledge them without
+    touching the main database, and `manage.py flush_ingest` moves them into
+    the database in batches. Each append is synced to disk before it returns,
+    so acknowledged records survive a crash. The SQLite file uses write-ahead
+    logging, so readers don't block writers. Each thread has its own
+    connection.
+
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # records are acknowledged once appended, so each commit is synced
+            # to disk. NORMAL would only sync at checkpoints in WAL mode, and
+            # could lose the last appends on power loss or an OS crash
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, "
+                "kind TEXT NOT NULL, body TEXT NOT NULL, received REAL NOT NULL)"
+            )
+            self._local.connection = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    def append(self, kind, records):
+        """Add records (a list of dicts) of the given kind to the end of the queue"""
+        now = time.time()
+        conn = self.connection
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO records (kind, body, received) VALUES (?, ?, ?)",
+                [(kind, json.dumps(record), now) for record in records],
+            )
+
+    def peek(self, limit):
+        """Returns up to limit of the oldest records as (id, kind, record) tuples"""
+        rows = self.connection.execute(
+            "SELECT id, kind, body FROM records ORDER BY id LIMIT ?", [limit]
+        )
+        return [(pk, kind, json.loads(body)) for pk, kind, body in rows]
+
+    def remove(self, last_id):
+        """Remove the records up to and including last_id"""
+        conn = self.connection
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM records WHERE id <= ?", [last_id])
+
+    def pending(self):
+        """The number of records in the queue"""
+        # records are removed from the head of the queue, so ids are contiguous
+        first, last = self.connection.execute(
+            "SELECT MIN(id), MAX(id) FROM records"
+        ).fetchone()
+        return 0 if first is None else last - first + 1
+
+    def stats(self):
+        """Returns a dict with the size of the queue and the age of the oldest record"""
+        oldest = self.connection.execute(
+            "SELECT received FROM records ORDER BY id LIMIT 1"
+        ).fetchone()
+        size = 0
+        for suffix in ("", "-wal"):
+            try:
+                size += os.path.getsize(self.path + suffix)
+            except OSError:
+                pass
+        return {
+            "pending": self.pending(),
+            "max_pending": max_pending(),
+            "oldest_age": None if oldest is None else time.time() - oldest[0],
+            "size_bytes": size,
+        }
+
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+def get_spool():
+    """Returns the Spool for DECIDE_HOST["INGEST_SPOOL"], or None if it isn't set"""
+    path = getattr(settings, "DECIDE_HOST", {}).get("INGEST_SPOOL")
+    if not path:
+        return None
+    with _spools_lock:
+        try:
+            return _spools[path]
+        except KeyError:
+            spool = _spools[path] = Spool(path)
+            return spool
+
+
+def max_pending():
+    return getattr(settings, "DECIDE_HOST", {}).get("INGEST_SPOOL_MAX", 1_000_000)
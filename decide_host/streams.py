@@ -0,0 +1,45 @@
+# -*- mode: python -*-
+"""In-process notification of newly recorded events"""
+
+import threading
+from collections import defaultdict
+
+
+class EventHub:
+    """Wakes up threads that are waiting for new events from a controller.
+
+    Each controller has a version number that is incremented whenever events
+    from it are committed in this process. A waiter reads the version, checks
+    the database, and then waits for the version to change. The hub only
+    carries notifications; the events themselves are always read from the
+    database, so waiters should also poll in case the events were recorded by
+    another process.
+
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = defaultdict(int)
+
+    def version(self, controller_id):
+        with self._condition:
+            return self._versions[controller_id]
+
+    def publish(self, controller_ids):
+        with self._condition:
+            for controller_id in controller_ids:
+                self._versions[controller_id] += 1
+            self._condition.notify_all()
+
+    def wait(self, controller_id, version, timeout):
+        """Blocks until the version for controller_id differs from version.
+
+        Returns False if the timeout (in seconds) expired first.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._versions[controller_id] != version, timeout
+            )
+
+
+event_hub = EventHub()
@@ -54,3 +54,5 @@ TEMPLATES = [
 USE_TZ = True
 DEBUG = True
 ROOT_URLCONF = "decide_host.tests.urls"
+
+DECIDE_HOST = {"READWRITE_SUBNETS": ["127.0.0.0/8"]}
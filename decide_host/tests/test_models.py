@@ -1,11 +1,31 @@
 # -*- mode: python -*-
 import datetime
+import gzip
+import importlib
+import io
+import json
+import threading
 
 import pytest
+from django.apps import apps
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Sum
 from django.utils import timezone
 
-from decide_host.models import Component, Controller, Event, Subject, Trial
+from decide_host.management.commands import merge_subjects
+from decide_host.models import (
+    Component,
+    Controller,
+    ControllerStats,
+    DailyTrialStats,
+    Event,
+    EventDailySummary,
+    Subject,
+    SubjectStats,
+    Trial,
+)
 
 
 @pytest.fixture
@@ -61,3 +81,408 @@ def test_subject_trial_counts():
     assert subj.n_trials == 2
     assert subj.last_trial_time == timestamp_today
     assert subj.n_trials_today == 1
+
+
+@pytest.mark.django_db
+def test_controller_stats_follow_inserts():
+    controller = Controller.objects.create(name="beagle-1")
+    component = Component.objects.create(name="peck-keys")
+    timestamp = timezone.now()
+    for i in range(3):
+        Event.objects.create(
+            name=component,
+            addr=controller,
+            time=timestamp - datetime.timedelta(seconds=i),
+            data={},
+        )
+    stats = ControllerStats.objects.get(controller=controller)
+    assert stats.n_events == 3
+    assert stats.last_event_time == timestamp
+
+    expected = Controller.objects.with_counts().values("n_events", "last_event_time")
+    assert list(Controller.objects.with_stats().values(*expected[0])) == list(expected)
+    ControllerStats.objects.all().delete()
+    assert ControllerStats.objects.rebuild() == 1
+    assert list(Controller.objects.with_stats().values(*expected[0])) == list(expected)
+
+
+@pytest.mark.django_db
+def test_subject_stats_follow_inserts():
+    subject = Subject.objects.create(name="ruby_1")
+    component = Component.objects.create(name="gng")
+    controller = Controller.objects.create(name="beagle-1")
+    timestamp_today = timezone.now()
+    for i, days in enumerate((3, 1, 0, 0)):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp_today - datetime.timedelta(days=days, microseconds=i),
+            data={},
+        )
+    # a late-arriving trial from an earlier day doesn't change today's count
+    Trial.objects.create(
+        name=component,
+        addr=controller,
+        subject=subject,
+        time=timestamp_today - datetime.timedelta(days=2),
+        data={},
+    )
+    fields = ("n_trials", "last_trial_time", "n_trials_today")
+    expected = list(Subject.objects.with_counts().values(*fields))
+    assert list(Subject.objects.with_stats().values(*fields)) == expected
+    SubjectStats.objects.all().delete()
+    assert SubjectStats.objects.rebuild() == 1
+    assert list(Subject.objects.with_stats().values(*fields)) == expected
+
+
+@pytest.mark.django_db
+def test_daily_trial_stats_follow_inserts():
+    subject = Subject.objects.create(name="ruby_1")
+    component = Component.objects.create(name="gng")
+    controller = Controller.objects.create(name="beagle-1")
+    timestamp_today = timezone.now()
+    records = [
+        (0, {"correct": True, "response": "peck_left"}),
+        (0, {"correct": False, "response": "timeout"}),
+        (0, {"comment": "starting"}),
+        (1, {"correct": True, "response": "peck_right"}),
+    ]
+    for i, (days, data) in enumerate(records):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp_today - datetime.timedelta(days=days, microseconds=i),
+            data=data,
+        )
+    fields = ("date", "n_trials", "n_scored", "n_correct", "n_responses")
+    expected = [
+        (timezone.localdate() - datetime.timedelta(days=1), 1, 1, 1, 1),
+        (timezone.localdate(), 3, 2, 1, 1),
+    ]
+    assert list(subject.daily_stats.values_list(*fields)) == expected
+    assert subject.n_trials_today() == 3
+    DailyTrialStats.objects.all().delete()
+    assert DailyTrialStats.objects.rebuild() == 2
+    assert list(subject.daily_stats.values_list(*fields)) == expected
+
+
+@pytest.mark.django_db
+def test_daily_trial_stats_rebuild_matches_record():
+    subject = Subject.objects.create(name="ruby_1")
+    component = Component.objects.create(name="gng")
+    controller = Controller.objects.create(name="beagle-1")
+    payloads = [
+        {"response": None, "correct": None},
+        {"response": "timeout", "correct": "true"},
+        {"response": "", "correct": False},
+        {"response": 0, "correct": 1},
+        {"response": {"key": "peck_left"}, "correct": True},
+        {"response": "Timeout"},
+        {},
+    ]
+    timestamp = timezone.now()
+    for i, data in enumerate(payloads):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp - datetime.timedelta(microseconds=i),
+            data=data,
+        )
+    fields = ("n_trials", "n_scored", "n_correct", "n_responses")
+    recorded = list(subject.daily_stats.values_list(*fields))
+    assert recorded == [(7, 5, 1, 4)]
+    DailyTrialStats.objects.rebuild()
+    assert list(subject.daily_stats.values_list(*fields)) == recorded
+    # and so does the migration that fills the table
+    migration = importlib.import_module("decide_host.migrations.0004_dailytrialstats")
+    DailyTrialStats.objects.all().delete()
+    migration.populate_daily_stats(apps, None)
+    assert list(subject.daily_stats.values_list(*fields)) == recorded
+
+
+@pytest.mark.django_db
+def test_partitioned_events(tmp_path):
+    controller = Controller.objects.create(name="beagle-1")
+    component = Component.objects.create(name="peck-keys")
+    now = timezone.now().replace(microsecond=123456)
+    old = now - datetime.timedelta(days=400)
+    for time in (old, now):
+        Event.objects.create(name=component, addr=controller, time=time, data={})
+
+    call_command("partition_table", "convert", stdout=io.StringIO())
+    assert Event.objects.count() == 2
+    recent = Event.objects.create(
+        name=component,
+        addr=controller,
+        time=now + datetime.timedelta(seconds=1),
+        data={},
+    )
+    assert recent.id > max(
+        Event.objects.exclude(id=recent.id).values_list("id", flat=True)
+    )
+    assert Event.objects.filter(time__gte=now).count() == 2
+
+    before = timezone.localdate(old) + datetime.timedelta(days=31)
+    call_command(
+        "partition_table",
+        "detach",
+        before=f"{before:%Y-%m}",
+        archive=str(tmp_path),
+        drop=True,
+        stdout=io.StringIO(),
+    )
+    assert Event.objects.count() == 2
+    (archive,) = tmp_path.iterdir()
+    with gzip.open(archive, "rt") as fp:
+        (line,) = fp
+    assert json.loads(line)["addr"] == "beagle-1"
+    # the dropped event is counted like an archived one
+    assert EventDailySummary.objects.get().n_events == 1
+    fields = ("n_events", "last_event_time")
+    expected = list(Controller.objects.with_counts().values_list(*fields))
+    assert expected[0][0] == 3
+    assert list(Controller.objects.with_stats().values_list(*fields)) == expected
+    ControllerStats.objects.rebuild()
+    assert list(Controller.objects.with_stats().values_list(*fields)) == expected
+
+    # the archive restores the detached event exactly, and only once
+    for _ in range(2):
+        call_command("import_events", str(archive), stdout=io.StringIO())
+        assert list(Event.objects.filter(time__lt=now).values_list("time")) == [(old,)]
+
+
+@pytest.mark.django_db
+def test_partitioned_trials(tmp_path):
+    subject = Subject.objects.create(name="ruby_1")
+    component = Component.objects.create(name="gng")
+    controller = Controller.objects.create(name="beagle-1")
+    now = timezone.now().replace(microsecond=123456)
+    old = now - datetime.timedelta(days=400)
+    for time in (old, now):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=time,
+            data={"correct": True},
+        )
+    call_command("partition_table", "-m", "trial", "convert", stdout=io.StringIO())
+    before = timezone.localdate(old) + datetime.timedelta(days=31)
+    call_command(
+        "partition_table",
+        "-m",
+        "trial",
+        "detach",
+        before=f"{before:%Y-%m}",
+        archive=str(tmp_path),
+        drop=True,
+        stdout=io.StringIO(),
+    )
+    # the totals no longer count the dropped trial
+    assert Trial.objects.count() == 1
+    fields = ("n_trials", "last_trial_time")
+    expected = list(Subject.objects.with_counts().values_list(*fields))
+    assert expected[0][0] == 1
+    assert list(Subject.objects.with_stats().values_list(*fields)) == expected
+    assert list(subject.daily_stats.values_list("date", "n_trials")) == [
+        (timezone.localdate(now), 1)
+    ]
+
+    # the archive restores the detached trial exactly, and only once
+    (archive,) = tmp_path.iterdir()
+    for _ in range(2):
+        call_command(
+            "import_trials",
+            "-a",
+            "beagle-1",
+            "-n",
+            "gng",
+            str(archive),
+            stdout=io.StringIO(),
+        )
+        assert list(Trial.objects.filter(time__lt=now).values_list("time")) == [(old,)]
+
+
+@pytest.mark.django_db
+def test_import_trials_skips_duplicates(tmp_path):
+    path = tmp_path / "trials.jsonl"
+    records = [
+        {"subject": "ruby_1", "time": 1700000000000000 + i, "correct": i % 2 == 0}
+        for i in range(5)
+    ]
+    lines = [json.dumps(record) for record in [*records, records[0]]]
+    path.write_text("\n".join([*lines, "{not json", '{"subject": "ruby_1"}']) + "\n")
+    out = io.StringIO()
+    call_command(
+        "import_trials", "-a", "beagle-1", "-n", "gng", "-b", "4", path, stdout=out
+    )
+    assert Trial.objects.count() == 5
+    assert "imported 5 record(s), skipped 1 duplicate(s)" in out.getvalue()
+    assert "record 6 invalid" in out.getvalue()
+    assert "record 7 invalid" in out.getvalue()
+    call_command("import_trials", "-a", "beagle-1", "-n", "gng", path, stdout=out)
+    assert Trial.objects.count() == 5
+    assert Subject.objects.get(name="ruby_1").stats.n_trials == 5
+
+
+@pytest.mark.django_db
+def test_import_events_from_gzip(tmp_path):
+    path = tmp_path / "events.jsonl.gz"
+    now = timezone.now()
+    records = [
+        {
+            "name": "house-light",
+            "time": (now + datetime.timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(3)
+    ]
+    records.append({**records[0], "addr": "beagle-2"})
+    with gzip.open(path, "wt") as fp:
+        fp.writelines(json.dumps(record) + "\n" for record in records)
+    out = io.StringIO()
+    call_command("import_events", "-a", "beagle-1", path, stdout=out)
+    call_command("import_events", "-a", "beagle-1", path, stdout=out)
+    assert "imported 4 record(s), skipped 0 duplicate(s)" in out.getvalue()
+    assert "imported 0 record(s), skipped 4 duplicate(s)" in out.getvalue()
+    assert Controller.objects.get(name="beagle-1").stats.n_events == 3
+    assert Controller.objects.get(name="beagle-2").stats.n_events == 1
+
+
+@pytest.mark.django_db
+def test_merge_subjects():
+    dest = Subject.objects.create(name="ruby_1")
+    sources = [Subject.objects.create(name=name) for name in ("ruby1", "Ruby_1")]
+    component = Component.objects.create(name="gng")
+    controller = Controller.objects.create(name="beagle-1")
+    now = timezone.now()
+    for i in range(7):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=(dest, *sources)[i % 3],
+            time=now - datetime.timedelta(seconds=i),
+            data={},
+        )
+    # the same trial recorded under two names can't be moved
+    Trial.objects.create(
+        name=component, addr=controller, subject=sources[1], time=now, data={}
+    )
+    out = io.StringIO()
+    call_command(
+        "merge_subjects", "-b", "2", "ruby_1", "ruby1", "Ruby_1", "nobody", stdout=out
+    )
+    output = out.getvalue()
+    assert "no such subject nobody" in output
+    assert "deleted ruby1" in output
+    assert "1 trial(s) from Ruby_1 conflict" in output
+    assert set(Subject.objects.values_list("name", flat=True)) == {"Ruby_1", "ruby_1"}
+    assert dest.trial_set.count() == 7
+    fields = ("name", "n_trials", "last_trial_time", "n_trials_today")
+    expected = list(Subject.objects.with_counts().order_by("id").values(*fields))
+    assert list(Subject.objects.with_stats().order_by("id").values(*fields)) == expected
+    assert dest.daily_stats.get().n_trials == 7
+
+
+@pytest.mark.django_db(transaction=True)
+def test_merge_subjects_keeps_trials_recorded_during_rebuild(monkeypatch):
+    dest = Subject.objects.create(name="ruby_1")
+    source = Subject.objects.create(name="ruby1")
+    component = Component.objects.create(name="gng")
+    controller = Controller.objects.create(name="beagle-1")
+    now = timezone.now()
+    for i, subject in enumerate((dest, source), start=1):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=now - datetime.timedelta(seconds=i),
+            data={},
+        )
+    recorded = threading.Event()
+    release = threading.Event()
+
+    def record_trial():
+        # ingest in another connection, which has counted the trial but not yet
+        # committed when the totals are rebuilt
+        try:
+            with transaction.atomic():
+                Trial.objects.create(
+                    name=component, addr=controller, subject=dest, time=now, data={}
+                )
+                recorded.set()
+                release.wait(5)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=record_trial)
+    rebuild_stats = merge_subjects.Command.rebuild_stats
+
+    def rebuild_during_ingest(self, subjects):
+        thread.start()
+        recorded.wait(5)
+        # the ingest commits while the rebuild is under way
+        threading.Timer(0.5, release.set).start()
+        rebuild_stats(self, subjects)
+
+    monkeypatch.setattr(merge_subjects.Command, "rebuild_stats", rebuild_during_ingest)
+    call_command("merge_subjects", "ruby_1", "ruby1", stdout=io.StringIO())
+    thread.join()
+    assert dest.trial_set.count() == 3
+    fields = ("name", "n_trials", "last_trial_time", "n_trials_today")
+    expected = list(Subject.objects.with_counts().values(*fields))
+    assert list(Subject.objects.with_stats().values(*fields)) == expected
+    assert dest.daily_stats.get().n_trials == 3
+
+
+@pytest.mark.django_db
+def test_archive_events(tmp_path):
+    component = Component.objects.create(name="hopper")
+    controller = Controller.objects.create(name="beagle-1")
+    # the archive keeps the microseconds
+    now = timezone.now().replace(microsecond=123456)
+    for days in (40, 40, 35, 1):
+        Event.objects.create(
+            name=component,
+            addr=controller,
+            time=now - datetime.timedelta(days=days, seconds=Event.objects.count()),
+            data={"up": True},
+        )
+    expected = list(
+        Controller.objects.with_counts().values("n_events", "last_event_time")
+    )
+    times = list(Event.objects.order_by("time").values_list("time", flat=True))
+    out = io.StringIO()
+    call_command(
+        "archive_events",
+        "--older-than",
+        "30d",
+        "--archive",
+        str(tmp_path),
+        "-b",
+        "2",
+        stdout=out,
+    )
+    assert "beagle-1: archived 3 event(s)" in out.getvalue()
+    assert Event.objects.count() == 1
+    assert EventDailySummary.objects.aggregate(n=Sum("n_events"))["n"] == 3
+    assert EventDailySummary.objects.count() == 2
+    # the totals still include the archived events
+    fields = ("n_events", "last_event_time")
+    assert list(Controller.objects.with_counts().values(*fields)) == expected
+    ControllerStats.objects.rebuild()
+    assert list(Controller.objects.with_stats().values(*fields)) == expected
+
+    # the archive can be imported again
+    (path,) = tmp_path.glob("beagle-1_before_*.jsonl.gz")
+    with gzip.open(path, "rt") as fp:
+        records = [json.loads(line) for line in fp]
+    assert len(records) == 3
+    assert records[0]["up"] is True
+    call_command("import_events", str(path), stdout=out)
+    assert list(Event.objects.order_by("time").values_list("time", flat=True)) == times
+    # replaying the archive again adds nothing
+    call_command("import_events", str(path), stdout=out)
+    assert Event.objects.count() == 4
@@ -1,7 +1,13 @@
 # -*- mode: python -*-
+import datetime
+
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
 
+from decide_host.lookups import slug_cache
 from decide_host.models import Component, Controller, Event, Subject, Trial
 from decide_host.serializers import EventSerializer, TrialSerializer
 
@@ -21,6 +27,13 @@ def subject(db):
     return Subject.objects.create(name="ruby_230")
 
 
+@pytest.fixture
+def empty_slug_cache():
+    slug_cache.clear()
+    yield slug_cache
+    slug_cache.clear()
+
+
 @pytest.mark.django_db
 def test_event_data_flattening(component, controller):
     timestamp = timezone.now()
@@ -117,3 +130,59 @@ def test_trial_creation_with_existing_objects(component, controller, subject):
     assert trial.addr == controller
     assert trial.subject == subject
     assert trial.time == timestamp
+
+
+@pytest.mark.django_db
+def test_slug_lookups_are_cached(empty_slug_cache, django_capture_on_commit_callbacks):
+    timestamp = timezone.now()
+    data = {"name": "peck_keys", "addr": "beagle-1", "state": "up"}
+    with django_capture_on_commit_callbacks(execute=True):
+        serializer = EventSerializer(data={**data, "time": timestamp.timestamp()})
+        assert serializer.is_valid()
+        serializer.save()
+    assert len(empty_slug_cache) == 2
+    with CaptureQueriesContext(connection) as queries:
+        serializer = EventSerializer(data={**data, "time": timestamp.timestamp() + 1})
+        assert serializer.is_valid()
+        serializer.save()
+    for table in ("decide_host_controller", "decide_host_component"):
+        assert not any(f'FROM "{table}"' in q["sql"] for q in queries)
+
+
+@pytest.mark.django_db
+def test_slug_cache_invalidated_on_delete(
+    empty_slug_cache, subject, django_capture_on_commit_callbacks
+):
+    with django_capture_on_commit_callbacks(execute=True):
+        cached = empty_slug_cache.get_or_create(
+            Subject.objects.all(), "name", "ruby_230"
+        )
+    assert cached == subject
+    assert empty_slug_cache.get(Subject, "ruby_230") == subject
+    subject.delete()
+    assert empty_slug_cache.get(Subject, "ruby_230") is None
+
+
+@pytest.mark.django_db
+def test_list_from_values_matches_instances(component, controller, subject):
+    timestamp = timezone.now()
+    for i in range(5):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp - datetime.timedelta(seconds=i, microseconds=i),
+            data={"trial": i, "stimulus": "stim-ü", "result": {"correct": i % 2 == 0}},
+        )
+        Event.objects.create(
+            name=component,
+            addr=controller,
+            time=timestamp - datetime.timedelta(seconds=i),
+            data={"state": {"peck_left": bool(i % 2)}},
+        )
+    renderer = JSONRenderer()
+    for model, serializer_class in ((Trial, TrialSerializer), (Event, EventSerializer)):
+        queryset = model.objects.with_names()
+        from_instances = serializer_class(list(queryset), many=True).data
+        from_values = serializer_class(queryset, many=True).data
+        assert renderer.render(from_values) == renderer.render(from_instances)
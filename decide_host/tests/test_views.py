@@ -1,11 +1,34 @@
 # -*- mode: python -*-
 import datetime
+import io
+import json
+import threading
 
+import psycopg2
 import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import AsyncRequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
-from decide_host.models import Component, Controller, Event, Subject, Trial
+from decide_host import pagination, renderers, spool
+from decide_host.async_views import AsyncEventList, AsyncTrialList
+from decide_host.lookups import slug_cache
+from decide_host.metrics import metrics
+from decide_host.models import (
+    Component,
+    Controller,
+    Event,
+    EventSchema,
+    Subject,
+    SubjectStats,
+    Trial,
+)
+from decide_host.streams import EventHub, event_hub
 
 
 @pytest.fixture
@@ -23,6 +46,22 @@ def subject(db):
     return Subject.objects.create(name="ruby_230")
 
 
+@pytest.fixture
+def small_pages(monkeypatch):
+    monkeypatch.setattr(pagination.LinkHeaderPaginationByTimestamp, "page_size", 2)
+    monkeypatch.setattr(pagination.KeysetPaginationByTimestamp, "page_size", 2)
+    monkeypatch.setattr(pagination.ChangeFeedPagination, "page_size", 2)
+
+
+def parse_links(response):
+    links = {}
+    for link in response.get("Link", "").split(", "):
+        if link:
+            url, rel = link.split("; ")
+            links[rel[5:-1]] = url[1:-1]
+    return links
+
+
 @pytest.mark.django_db
 def test_index(client):
     response = client.get(reverse("decide:index"))
@@ -158,3 +197,910 @@ def test_trial_list_filter(client, component, controller, subject):
     assert response.status_code == 200
     assert len(response.data) == 1
     assert response.data[0]["state"] == trial_2.data["state"]
+
+
+@pytest.mark.django_db
+def test_event_batch_create(client):
+    timestamp = timezone.now().timestamp()
+    records = [
+        {"addr": "beagle-1", "name": "peck_keys", "time": timestamp, "state": "up"},
+        {"addr": "beagle-1", "name": "hopper", "time": timestamp, "up": True},
+    ]
+    response = client.post(
+        reverse("decide:event-list"), records, content_type="application/json"
+    )
+    assert response.status_code == 201
+    assert [r["status"] for r in response.data] == [201, 201]
+    assert Event.objects.count() == 2
+    assert Event.objects.get(name__name="hopper").data == {"up": True}
+
+
+@pytest.mark.django_db
+def test_event_batch_create_partial(client):
+    timestamp = timezone.now().timestamp()
+    record = {"addr": "beagle-1", "name": "peck_keys", "time": timestamp}
+    records = [record, {"addr": "beagle-1", "name": "peck_keys"}, record]
+    response = client.post(
+        reverse("decide:event-list"), records, content_type="application/json"
+    )
+    assert response.status_code == 207
+    assert [r["status"] for r in response.data] == [201, 400, 200]
+    assert response.data[2]["already_present"]
+    assert Event.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_event_create_is_idempotent(client):
+    record = {
+        "addr": "beagle-1",
+        "name": "peck_keys",
+        "time": timezone.now().timestamp(),
+    }
+    url = reverse("decide:event-list")
+    response = client.post(url, record, content_type="application/json")
+    assert response.status_code == 201
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post(url, record, content_type="application/json")
+    assert response.status_code == 200
+    assert response.data["already_present"]
+    assert len([q for q in queries if q["sql"].startswith("INSERT")]) == 1
+    response = client.post(url, [record], content_type="application/json")
+    assert response.status_code == 200
+    assert response.data == [{"status": 200, "already_present": True}]
+    assert Controller.objects.get(name="beagle-1").stats.n_events == 1
+
+
+@pytest.mark.django_db
+def test_trial_dedup_can_be_disabled(client, settings):
+    settings.DECIDE_HOST = {**settings.DECIDE_HOST, "TRIAL_DEDUP": False}
+    record = {
+        "addr": "beagle-1",
+        "name": "gng",
+        "subject": "ruby_230",
+        "time": timezone.now().timestamp(),
+    }
+    url = reverse("decide:trial-list")
+    response = client.post(url, record, content_type="application/json")
+    assert response.status_code == 201
+    response = client.post(url, record, content_type="application/json")
+    assert response.status_code == 400
+    assert Trial.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_trial_batch_create_ndjson(client):
+    timestamp = timezone.now().timestamp()
+    lines = [
+        {
+            "addr": "beagle-1",
+            "name": "gng",
+            "subject": "ruby_230",
+            "time": timestamp + i,
+            "correct": True,
+        }
+        for i in range(3)
+    ]
+    response = client.post(
+        reverse("decide:trial-list"),
+        "\n".join(json.dumps(line) for line in lines),
+        content_type="application/x-ndjson",
+    )
+    assert response.status_code == 201
+    assert len(response.data) == 3
+    assert Trial.objects.filter(subject__name="ruby_230").count() == 3
+    assert {r["id"] for r in response.data} == set(
+        Trial.objects.values_list("id", flat=True)
+    )
+
+
+@pytest.mark.django_db
+def test_stale_slug_cache_entries_are_retried(client):
+    # a subject that was cached and then deleted by another process
+    ghost = Subject(pk=2**31 - 1, name="ruby_230")
+    with connection.cursor() as cursor:
+        # Django's foreign keys are deferred to the end of the test transaction
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    url = reverse("decide:trial-list")
+    timestamp = timezone.now().timestamp()
+    records = [
+        {
+            "addr": "beagle-1",
+            "name": "gng",
+            "subject": "ruby_230",
+            "time": timestamp + i,
+        }
+        for i in range(3)
+    ]
+    slug_cache.set(Subject, "ruby_230", ghost)
+    response = client.post(url, records[0], content_type="application/json")
+    assert response.status_code == 201
+    slug_cache.set(Subject, "ruby_230", ghost)
+    response = client.post(url, records[1:], content_type="application/json")
+    assert response.status_code == 201
+    slug_cache.set(Subject, "ruby_230", ghost)
+    request = AsyncRequestFactory().post(
+        "/", {**records[0], "time": timestamp + 3}, content_type="application/json"
+    )
+    response = async_to_sync(AsyncTrialList.as_view())(request)
+    assert response.status_code == 201
+    assert Trial.objects.filter(subject__name="ruby_230").count() == 4
+    slug_cache.clear()
+
+
+@pytest.mark.django_db
+def test_conflicting_records_in_batch_are_rejected_individually(client, monkeypatch):
+    # a subject that is still missing when the insert is retried
+    ghost = Subject(pk=2**31 - 1, name="ruby_230")
+    slug_cache.set(Subject, "ruby_230", ghost)
+    monkeypatch.setattr(slug_cache, "clear", lambda: None)
+    with connection.cursor() as cursor:
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    url = reverse("decide:trial-list")
+    timestamp = timezone.now().timestamp()
+    records = [
+        {
+            "addr": "beagle-1",
+            "name": "gng",
+            "subject": subject,
+            "time": timestamp + i,
+        }
+        for i, subject in enumerate(["jade_1", "ruby_230", "jade_1", "jade_2"])
+    ]
+    response = client.post(url, records[1], content_type="application/json")
+    assert response.status_code == 409
+    response = client.post(url, records, content_type="application/json")
+    assert response.status_code == 207
+    assert [r["status"] for r in response.data] == [201, 409, 201, 201]
+    assert Trial.objects.count() == 3
+    # resubmitting is still safe
+    response = client.post(url, records, content_type="application/json")
+    assert [r["status"] for r in response.data] == [200, 409, 200, 200]
+
+    view = AsyncTrialList.as_view()
+    records = [{**record, "time": record["time"] + 10} for record in records]
+    request = AsyncRequestFactory().post(
+        "/", records[1], content_type="application/json"
+    )
+    response = async_to_sync(view)(request)
+    assert response.status_code == 409
+    request = AsyncRequestFactory().post("/", records, content_type="application/json")
+    response = async_to_sync(view)(request)
+    assert response.status_code == 207
+    assert [r["status"] for r in json.loads(response.content)] == [201, 409, 201, 201]
+    assert Trial.objects.count() == 6
+    monkeypatch.undo()
+    slug_cache.clear()
+
+
+@pytest.mark.django_db
+def test_event_list_keyset_pagination(client, component, controller, small_pages):
+    timestamp = timezone.now()
+    # two events share a timestamp to check that ties are broken by id
+    times = [timestamp, timestamp] + [
+        timestamp - datetime.timedelta(seconds=i) for i in range(1, 4)
+    ]
+    for i, time in enumerate(times):
+        Event.objects.create(
+            name=component if i != 1 else Component.objects.create(name="hopper"),
+            addr=controller,
+            time=time,
+            data={"i": i},
+        )
+    expected = list(Event.objects.order_by("-time", "-id").values_list("data__i"))
+    expected = [i for (i,) in expected]
+
+    response = client.get(reverse("decide:event-list"), {"cursor": ""})
+    assert response.status_code == 200
+    seen = [r["i"] for r in response.data]
+    links = parse_links(response)
+    assert "prev" not in links
+    while "next" in links:
+        response = client.get(links["next"])
+        assert response.status_code == 200
+        seen.extend(r["i"] for r in response.data)
+        links = parse_links(response)
+    assert seen == expected
+
+    # and back again
+    assert "prev" in links
+    seen = [r["i"] for r in response.data]
+    while "prev" in links:
+        response = client.get(links["prev"])
+        seen = [r["i"] for r in response.data] + seen
+        links = parse_links(response)
+    assert seen == expected
+
+
+@pytest.mark.django_db
+def test_event_list_invalid_cursor(client, small_pages):
+    response = client.get(reverse("decide:event-list"), {"cursor": "garbage"})
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_trial_list_since_id(client, component, controller, subject, small_pages):
+    timestamp = timezone.now()
+
+    def add_trials(*indices):
+        for i in indices:
+            Trial.objects.create(
+                name=component,
+                addr=controller,
+                subject=subject,
+                # insertion order differs from time order
+                time=timestamp - datetime.timedelta(seconds=i),
+                data={"i": i},
+            )
+
+    def sync(url):
+        seen = []
+        while True:
+            response = client.get(url)
+            assert response.status_code == 200
+            url = parse_links(response)["next"]
+            if not response.data:
+                return seen, url
+            seen.extend(r["i"] for r in response.data)
+
+    add_trials(0, 1, 2)
+    seen, url = sync(reverse("decide:trial-list") + "?since_id=")
+    assert seen == [0, 1, 2]
+    add_trials(3, 4, 5)
+    seen, url = sync(url)
+    assert seen == [3, 4, 5]
+    seen, url = sync(url)
+    assert seen == []
+
+    # exports stream the whole delta and link to the high-water mark
+    last_id = Trial.objects.order_by("id").values_list("id", flat=True)[2]
+    response = client.get(
+        reverse("decide:trial-list"), {"since_id": last_id, "format": "ndjson"}
+    )
+    records = [json.loads(line) for line in response.getvalue().splitlines()]
+    assert [r["i"] for r in records] == [3, 4, 5]
+    assert parse_links(response)["next"].endswith(
+        f"since_id={Trial.objects.latest('id').id}"
+    )
+
+    response = client.get(reverse("decide:trial-list"), {"since_id": "garbage"})
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_change_feed_waits_for_inserts_in_progress(
+    client, settings, component, controller, subject
+):
+    settings.DECIDE_HOST = {
+        **settings.DECIDE_HOST,
+        "CHANGE_FEED_SETTLE_TIMEOUT": 0.05,
+    }
+    started = threading.Event()
+    finish = threading.Event()
+
+    def insert_in_other_transaction():
+        # this thread has its own connection, so the event isn't visible until
+        # the transaction ends (it's rolled back, because the controller and
+        # component only exist in the test's transaction)
+        try:
+            with transaction.atomic():
+                # no signals, so the running totals aren't locked
+                Event.objects.bulk_create(
+                    [
+                        Event(
+                            name_id=component.id,
+                            addr_id=controller.id,
+                            time=timezone.now(),
+                            data={},
+                        )
+                    ]
+                )
+                started.set()
+                finish.wait(5)
+                transaction.set_rollback(True)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=insert_in_other_transaction)
+    thread.start()
+    started.wait(5)
+    # inserted after the one in progress, so it has a higher id
+    event = Event.objects.create(
+        name=component, addr=controller, time=timezone.now(), data={"i": 1}
+    )
+    url = reverse("decide:event-list")
+    response = client.get(url, {"since_id": 0})
+    assert response.data == []
+    assert parse_links(response)["next"].endswith("since_id=0")
+    # a transaction that has been running too long is no longer waited for
+    settings.DECIDE_HOST = {**settings.DECIDE_HOST, "CHANGE_FEED_MAX_HOLD": 0}
+    response = client.get(url, {"since_id": 0})
+    assert [r["i"] for r in response.data] == [1]
+    settings.DECIDE_HOST = {**settings.DECIDE_HOST, "CHANGE_FEED_MAX_HOLD": 60}
+    finish.set()
+    thread.join()
+    response = client.get(url, {"since_id": 0})
+    assert [r["i"] for r in response.data] == [1]
+    assert parse_links(response)["next"].endswith(f"since_id={event.id}")
+
+
+@pytest.mark.django_db
+def test_change_feed_ignores_other_databases(client, settings, component, controller):
+    settings.DECIDE_HOST = {
+        **settings.DECIDE_HOST,
+        "CHANGE_FEED_SETTLE_TIMEOUT": 0.05,
+    }
+    event = Event.objects.create(
+        name=component, addr=controller, time=timezone.now(), data={"i": 1}
+    )
+    # an open transaction that has written to a table in another database on
+    # the same server
+    params = {**connection.get_connection_params(), "dbname": "postgres"}
+    other = psycopg2.connect(**params)
+    try:
+        with other.cursor() as cursor:
+            cursor.execute("CREATE TEMPORARY TABLE scratch (x integer)")
+            cursor.execute("INSERT INTO scratch VALUES (1)")
+        response = client.get(reverse("decide:event-list"), {"since_id": 0})
+        assert [r["i"] for r in response.data] == [1]
+        assert parse_links(response)["next"].endswith(f"since_id={event.id}")
+    finally:
+        other.close()
+
+
+@pytest.mark.django_db
+def test_trial_list_page_pagination(
+    client, component, controller, subject, small_pages
+):
+    timestamp = timezone.now()
+    for i in range(3):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp - datetime.timedelta(seconds=i),
+            data={"i": i},
+        )
+    response = client.get(reverse("decide:trial-list"))
+    assert [r["i"] for r in response.data] == [0, 1]
+    links = parse_links(response)
+    assert set(links) == {"next", "last"}
+    response = client.get(links["next"])
+    assert [r["i"] for r in response.data] == [2]
+
+
+@pytest.mark.django_db
+def test_trial_list_skips_count_for_large_tables(
+    client, component, controller, subject, small_pages, settings
+):
+    settings.DECIDE_HOST = {**settings.DECIDE_HOST, "EXACT_COUNT_LIMIT": 0}
+    timestamp = timezone.now()
+    for i in range(3):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp - datetime.timedelta(seconds=i),
+            data={"i": i},
+        )
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse("decide:trial-list"))
+    assert not any("COUNT(" in q["sql"] for q in queries.captured_queries)
+    assert [r["i"] for r in response.data] == [0, 1]
+    links = parse_links(response)
+    assert set(links) == {"next"}
+    response = client.get(links["next"])
+    assert [r["i"] for r in response.data] == [2]
+    assert set(parse_links(response)) == {"first", "prev"}
+    response = client.get(reverse("decide:trial-list"), {"page": "last"})
+    assert response.status_code == 404
+    response = client.get(reverse("decide:trial-list"), {"page": 5})
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_subject_trial_export(client, component, controller, subject):
+    timestamp = timezone.now()
+    for i in range(3):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp - datetime.timedelta(seconds=i),
+            data={"i": i, "result": "hit" if i % 2 == 0 else "miss"},
+        )
+    url = reverse("decide:subject-trial-list", args=[subject.name])
+    response = client.get(url, {"format": "ndjson", "data__result": "hit"})
+    assert response.status_code == 200
+    assert response.streaming
+    assert response["Content-Type"] == "application/x-ndjson"
+    records = [
+        json.loads(line) for line in b"".join(response.streaming_content).splitlines()
+    ]
+    assert [r["i"] for r in records] == [0, 2]
+    assert records == client.get(url, {"data__result": "hit"}).json()
+
+    response = client.get(url, {"format": "csv"})
+    assert response.status_code == 200
+    lines = b"".join(response.streaming_content).decode().splitlines()
+    assert lines[0] == "id,addr,name,subject,time,i,result"
+    assert len(lines) == 4
+
+
+@pytest.mark.django_db
+def test_subject_trial_export_parquet(
+    client, component, controller, subject, monkeypatch
+):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(renderers.ColumnarRenderer, "batch_size", 2)
+    timestamp = timezone.now()
+    for i in range(3):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp - datetime.timedelta(seconds=i),
+            data={"i": i, "rtime": 1.5 * i, "correct": i > 0, "stim": {"n": i}},
+        )
+    url = reverse("decide:subject-trial-list", args=[subject.name])
+    response = client.get(url, {"format": "parquet"})
+    assert response.status_code == 200
+    data = pa.BufferReader(b"".join(response.streaming_content))
+    assert pq.ParquetFile(data).num_row_groups == 2
+    table = pq.read_table(data)
+    assert table.schema.field("time").type == pa.timestamp("us", tz="UTC")
+    assert table.schema.field("i").type == pa.int64()
+    assert table.schema.field("rtime").type == pa.float64()
+    assert table.schema.field("correct").type == pa.bool_()
+    records = table.to_pylist()
+    assert [r["time"] for r in records] == list(
+        Trial.objects.order_by("-time").values_list("time", flat=True)
+    )
+    assert [json.loads(r["stim"]) for r in records] == [{"n": i} for i in range(3)]
+
+    response = client.get(url, {"format": "arrow"})
+    table = pa.ipc.open_stream(b"".join(response.streaming_content)).read_all()
+    assert table.column("i").to_pylist() == [0, 1, 2]
+
+
+@pytest.mark.django_db
+def test_subject_daily_list(client, component, controller, subject):
+    timestamp = timezone.now()
+    for i in range(4):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp - datetime.timedelta(seconds=i),
+            data={"correct": i > 0, "response": "peck_left"},
+        )
+    response = client.get(reverse("decide:subject-detail", args=[subject.name]))
+    assert "daily" in parse_links(response)
+    response = client.get(parse_links(response)["daily"])
+    assert response.status_code == 200
+    assert len(response.data) == 1
+    assert response.data[0]["n_trials"] == 4
+    assert response.data[0]["p_correct"] == 0.75
+    response = client.get(
+        reverse("decide:subject-daily-list", args=[subject.name]),
+        {"date_before": "2000-01-01"},
+    )
+    assert response.data == []
+
+
+@pytest.mark.django_db
+def test_conditional_get(client, component, controller, subject):
+    def post_trial(i):
+        trial = {
+            "addr": controller.name,
+            "name": component.name,
+            "subject": subject.name,
+            "time": timezone.now().isoformat(),
+            "trial": i,
+        }
+        response = client.post(
+            reverse("decide:trial-list"), trial, content_type="application/json"
+        )
+        assert response.status_code == 201
+
+    post_trial(0)
+    for url in (
+        reverse("decide:trial-list"),
+        reverse("decide:subject-list"),
+        reverse("decide:subject-detail", args=[subject.name]),
+        reverse("decide:subject-trial-list", args=[subject.name]),
+    ):
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response["ETag"]
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response["ETag"] == etag
+        post_trial(1)
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response["ETag"] != etag
+
+    # a different representation has a different tag
+    url = reverse("decide:trial-list")
+    etag = client.get(url)["ETag"]
+    response = client.get(url, {"format": "ndjson"}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+
+    response = client.get(reverse("decide:subject-detail", args=["nobody"]))
+    assert response.status_code == 404
+
+    # a record that commits late, with an id inside the range already seen
+    url = reverse("decide:trial-list")
+    first = Trial.objects.latest("id")
+
+    def add_trial(**kwargs):
+        return Trial.objects.create(
+            name=component,
+            addr=controller,
+            data={},
+            **{"subject": subject, "time": timezone.now(), **kwargs},
+        )
+
+    add_trial(id=first.id + 100)
+    etag = client.get(url)["ETag"]
+    add_trial(id=first.id + 50)
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+    # a trial moved to another subject by merge_subjects, which keeps the other
+    # subject because it also has a trial that conflicts
+    other = Subject.objects.create(name="ruby_231")
+    moved = add_trial(subject=other)
+    when = timezone.now()
+    add_trial(subject=other, time=when)
+    add_trial(time=when)
+    urls = (url, reverse("decide:subject-list"))
+    etags = [client.get(url)["ETag"] for url in urls]
+    call_command("merge_subjects", subject.name, other.name, stdout=io.StringIO())
+    assert Subject.objects.filter(name=other.name).exists()
+    moved.refresh_from_db()
+    assert moved.subject == subject
+    for url, etag in zip(urls, etags, strict=True):
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+
+@pytest.mark.django_db
+def test_response_cache(
+    client,
+    settings,
+    component,
+    controller,
+    subject,
+    django_capture_on_commit_callbacks,
+):
+    settings.DECIDE_HOST = {**settings.DECIDE_HOST, "RESPONSE_CACHE": "default"}
+    caches["default"].clear()
+    urls = (
+        reverse("decide:subject-list"),
+        reverse("decide:subject-detail", args=[subject.name]),
+    )
+
+    def n_trials():
+        responses = [client.get(url) for url in urls]
+        return (responses[0].data[0]["n_trials"], responses[1].data["n_trials"])
+
+    assert n_trials() == (0, 0)
+    # changes that don't go through the API are not seen until the entries expire
+    SubjectStats.objects.update_or_create(subject=subject, defaults={"n_trials": 5})
+    assert n_trials() == (0, 0)
+    trial = {
+        "addr": controller.name,
+        "name": component.name,
+        "subject": subject.name,
+        "time": timezone.now().isoformat(),
+    }
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.post(
+            reverse("decide:trial-list"), trial, content_type="application/json"
+        )
+    # the callbacks cached slugs for rows that are about to be rolled back
+    slug_cache.clear()
+    assert response.status_code == 201
+    assert n_trials() == (6, 6)
+
+
+@pytest.mark.django_db
+def test_metrics_middleware(client, settings, caplog, component, controller):
+    settings.MIDDLEWARE = [
+        *settings.MIDDLEWARE,
+        "decide_host.middleware.MetricsMiddleware",
+    ]
+    settings.DECIDE_HOST = {**settings.DECIDE_HOST, "SLOW_REQUEST_THRESHOLD": 0}
+    metrics.clear()
+    Event.objects.create(
+        name=component, addr=controller, time=timezone.now(), data={"state": "on"}
+    )
+    url = reverse("decide:event-list")
+    response = client.get(url, {"data__state": "on"})
+    assert response.status_code == 200
+    response = client.get(url, {"format": "ndjson"})
+    assert len(b"".join(response.streaming_content)) > 0
+    totals = metrics.snapshot()[("EventList", "GET")]
+    assert totals["requests"] == 2
+    assert totals["queries"] > 0
+    assert totals["response_bytes"] > 0
+    # the export is serialized while it's streamed, so only the page is timed
+    assert totals["serialize_seconds"]["count"] == 1
+    assert 0 < totals["serialize_seconds"]["sum"] < totals["seconds"]
+    assert "data filters: {'data__state': 'on'}" in caplog.text
+    assert "SELECT" in caplog.text
+
+    response = client.get(reverse("decide:metrics"))
+    assert response["Content-Type"].startswith("text/plain")
+    assert (
+        'decide_host_requests_total{view="EventList",method="GET"} 2'
+        in response.content.decode()
+    )
+    assert "# TYPE decide_host_serialize_seconds histogram" in response.content.decode()
+    assert (
+        'decide_host_serialize_seconds_count{view="EventList",method="GET"} 1'
+        in response.content.decode()
+    )
+    # serializing isn't timed for the metrics view itself
+    assert 'serialize_seconds_count{view="metrics_view"' not in metrics.to_prometheus()
+    # buckets are cumulative upper bounds
+    metrics.record("Small", "GET", serialize_seconds=0.005)
+    metrics.record("Small", "GET", serialize_seconds=0.25)
+    text = metrics.to_prometheus()
+    labels = 'view="Small",method="GET"'
+    assert f'decide_host_serialize_seconds_bucket{{{labels},le="0.001"}} 0\n' in text
+    assert f'decide_host_serialize_seconds_bucket{{{labels},le="0.005"}} 1\n' in text
+    assert f'decide_host_serialize_seconds_bucket{{{labels},le="0.25"}} 2\n' in text
+    assert f'decide_host_serialize_seconds_bucket{{{labels},le="+Inf"}} 2\n' in text
+    assert f"decide_host_serialize_seconds_sum{{{labels}}} 0.255\n" in text
+    # large counters keep all their digits
+    metrics.record("Big", "GET", response_bytes=1234567, seconds=1234567.25)
+    text = metrics.to_prometheus()
+    assert 'decide_host_response_bytes_total{view="Big",method="GET"} 1234567\n' in text
+    assert (
+        'decide_host_request_seconds_total{view="Big",method="GET"} 1234567.25' in text
+    )
+
+
+@pytest.mark.django_db
+def test_trial_list_data_filters(client, component, controller, subject):
+    timestamp = timezone.now()
+    records = [
+        {"correct": True, "rtime": 500, "result": {"feed": True}},
+        {"correct": False, "rtime": 1500, "result": {"feed": False}},
+        {"correct": "True", "rtime": "2000", "comment": "string values"},
+    ]
+    for i, data in enumerate(records):
+        Trial.objects.create(
+            name=component,
+            addr=controller,
+            subject=subject,
+            time=timestamp - datetime.timedelta(seconds=i),
+            data=data,
+        )
+    url = reverse("decide:trial-list")
+
+    def matches(**query):
+        response = client.get(url, query)
+        assert response.status_code == 200
+        return len(response.data)
+
+    assert matches(data__correct="True") == 2
+    assert matches(data__correct="false") == 1
+    assert matches(data__rtime__gt="1000") == 1
+    assert matches(data__rtime="2000") == 1
+    assert matches(data__result__feed="true") == 1
+    assert matches(data__comment__isnull="true") == 2
+    assert matches(data__comment__icontains="STRING") == 1
+
+    with CaptureQueriesContext(connection) as queries:
+        client.get(url, {"data__correct": "True"})
+    assert any("@>" in q["sql"] for q in queries.captured_queries)
+
+    for param in ("data__", "data__a__b__c__d__e", "data__a;drop", "data__a__b c"):
+        response = client.get(url, {param: "x"})
+        assert response.status_code == 400, param
+
+
+@pytest.mark.django_db
+def test_compact_events(client, component, controller):
+    now = timezone.now()
+    records = [
+        {"peck_left": True, "peck_right": False},
+        {"peck_left": False, "peck_right": True},
+        {"peck_left": "True", "rtime": 2000, "result": {"feed": True}},
+        {"rtime": 500, "result": {"feed": False}},
+        {},
+    ]
+    for i, data in enumerate(records):
+        Event.objects.create(
+            name=component,
+            addr=controller,
+            # the last record is too recent to be compacted
+            time=now - datetime.timedelta(days=10 - 2 * i),
+            data=data,
+        )
+    url = reverse("decide:event-list")
+    queries = [
+        {"data__peck_left": "true"},
+        {"data__peck_left": "false"},
+        {"data__peck_right": "true"},
+        {"data__rtime__gt": "1000"},
+        {"data__rtime": "2000"},
+        {"data__result__feed": "true"},
+        {"data__result__feed__isnull": "true"},
+        {"data__rtime__isnull": "true"},
+        {"data__rtime__isnull": "false"},
+        {"data__peck_left__icontains": "TRU"},
+        {"data__missing": "1"},
+    ]
+
+    def results():
+        return [client.get(url, query).json() for query in [{}, *queries]]
+
+    expected = results()
+    assert [len(r) for r in expected] == [5, 1, 1, 1, 1, 1, 1, 3, 3, 2, 2, 0]
+    out = io.StringIO()
+    call_command("compact_events", "--older-than", "1d", "-b", "2", stdout=out)
+    assert "updated 4 event(s)" in out.getvalue()
+    assert Event.objects.filter(schema__isnull=False).count() == 4
+    assert EventSchema.objects.count() == 3
+    event = Event.objects.exclude(schema=None).order_by("time").first()
+    assert event.data == [True, False]
+    assert event.get_data() == records[0]
+    # the API output and the filters are unchanged
+    assert results() == expected
+    response = client.get(url, {"format": "ndjson"})
+    rows = [json.loads(line) for line in response.getvalue().splitlines()]
+    assert rows == expected[0]
+
+    call_command("compact_events", "--expand", stdout=out)
+    assert not Event.objects.filter(schema__isnull=False).exists()
+    assert Event.objects.order_by("time").first().data == records[0]
+    assert results() == expected
+
+
+@pytest.mark.django_db
+def test_event_write_behind_spool(client, settings, tmp_path):
+    settings.DECIDE_HOST = {
+        **settings.DECIDE_HOST,
+        "INGEST_SPOOL": str(tmp_path / "spool.db"),
+        "INGEST_SPOOL_MAX": 2,
+    }
+    timestamp = timezone.now().timestamp()
+    url = reverse("decide:event-list")
+    records = [
+        {"addr": "beagle-1", "name": "peck_keys", "time": timestamp + i}
+        for i in range(2)
+    ]
+    response = client.post(url, records[0], content_type="application/json")
+    assert response.status_code == 202
+    response = client.post(
+        url, [records[1], {"addr": "beagle-1"}], content_type="application/json"
+    )
+    assert response.status_code == 207
+    assert [r["status"] for r in response.data] == [202, 400]
+    assert Event.objects.count() == 0
+    response = client.post(url, records[0], content_type="application/json")
+    assert response.status_code == 503
+    assert response["Retry-After"]
+    response = client.get(reverse("decide:ingest-status"))
+    assert response.data["pending"] == 2
+    # appends are synced to disk before they're acknowledged
+    pragma = spool.get_spool().connection.execute("PRAGMA synchronous")
+    assert pragma.fetchone() == (2,)
+
+    call_command("flush_ingest", stdout=io.StringIO())
+    assert Event.objects.count() == 2
+    assert Controller.objects.get(name="beagle-1").stats.n_events == 2
+    response = client.get(reverse("decide:ingest-status"))
+    assert response.data["pending"] == 0
+
+
+@pytest.mark.django_db
+def test_async_event_list(small_pages):
+    view = AsyncEventList.as_view()
+    factory = AsyncRequestFactory()
+    timestamp = timezone.now().timestamp() - 60
+    records = [
+        {"addr": "beagle-1", "name": "peck_keys", "time": timestamp + i, "up": i}
+        for i in range(3)
+    ]
+    request = factory.post("/", records, content_type="application/json")
+    response = async_to_sync(view)(request)
+    assert response.status_code == 201
+    request = factory.post("/", records[0], content_type="application/json")
+    response = async_to_sync(view)(request)
+    assert response.status_code == 200
+    assert json.loads(response.content)["already_present"]
+    assert Controller.objects.get(name="beagle-1").stats.n_events == 3
+
+    response = async_to_sync(view)(factory.get("/", {"cursor": ""}))
+    assert response.status_code == 200
+    assert [r["up"] for r in json.loads(response.content)] == [2, 1]
+    response = async_to_sync(view)(factory.get(parse_links(response)["next"]))
+    assert [r["up"] for r in json.loads(response.content)] == [0]
+
+    response = async_to_sync(view)(factory.get("/", {"format": "ndjson"}))
+    content = b"".join(async_to_sync(collect)(response.streaming_content))
+    assert len(content.splitlines()) == 3
+
+    # slugs that aren't strings are converted or rejected, like the sync view does
+    record = {"addr": 5, "name": "peck_keys", "time": timestamp + 10}
+    response = async_to_sync(view)(
+        factory.post("/", record, content_type="application/json")
+    )
+    assert response.status_code == 201
+    assert json.loads(response.content)["addr"] == "5"
+    records = [{**record, "time": timestamp + 11}, {**record, "addr": ["x"]}]
+    response = async_to_sync(view)(
+        factory.post("/", records, content_type="application/json")
+    )
+    assert response.status_code == 207
+    assert [r["status"] for r in json.loads(response.content)] == [201, 400]
+    response = async_to_sync(view)(
+        factory.post("/", {**record, "addr": {}}, content_type="application/json")
+    )
+    assert response.status_code == 400
+    Event.objects.filter(addr__name="5").delete()
+
+    # data filters also match compacted payloads
+    call_command("compact_events", "--older-than", "0d", stdout=io.StringIO())
+    assert Event.objects.filter(schema__isnull=False).count() == 3
+    response = async_to_sync(view)(factory.get("/", {"cursor": "", "data__up": "1"}))
+    assert response.status_code == 200
+    assert [r["up"] for r in json.loads(response.content)] == [1]
+    response = async_to_sync(view)(
+        factory.get("/", {"format": "ndjson", "data__up": "1"})
+    )
+    content = b"".join(async_to_sync(collect)(response.streaming_content))
+    assert [json.loads(line)["up"] for line in content.splitlines()] == [1]
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+@pytest.mark.django_db
+def test_controller_event_stream(
+    client, component, controller, settings, django_capture_on_commit_callbacks
+):
+    settings.DECIDE_HOST = {
+        **settings.DECIDE_HOST,
+        "STREAM_TIMEOUT": 0.2,
+        "STREAM_POLL_INTERVAL": 0.05,
+    }
+    url = reverse("decide:controller-event-stream", args=[controller.name])
+    version = event_hub.version(controller.pk)
+    with django_capture_on_commit_callbacks(execute=True):
+        event = Event.objects.create(
+            name=component, addr=controller, time=timezone.now(), data={"up": 1}
+        )
+    assert event_hub.version(controller.pk) == version + 1
+
+    response = client.get(url, {"wait": 0})
+    assert response.status_code == 200
+    assert response.data == []
+    response = client.get(url, {"after": 0, "wait": 0})
+    assert [r["up"] for r in response.data] == [1]
+    assert f"after={event.id}" in parse_links(response)["next"]
+    for wait in ("nan", "inf", "abc"):
+        assert client.get(url, {"wait": wait}).status_code == 400, wait
+    # negative waits don't wait at all
+    assert client.get(url, {"after": 0, "wait": -5}).status_code == 200
+
+    response = client.get(url, {"after": 0}, HTTP_ACCEPT="text/event-stream")
+    assert response["Content-Type"] == "text/event-stream"
+    content = b"".join(response.streaming_content).decode()
+    assert f"id: {event.id}\ndata: " in content
+    assert content.endswith(": keepalive\n\n")
+
+
+def test_event_hub_wakes_waiters():
+    hub = EventHub()
+    version = hub.version(1)
+    timer = threading.Timer(0.05, hub.publish, [{1}])
+    timer.start()
+    assert hub.wait(1, version, timeout=5)
+    assert not hub.wait(2, hub.version(2), timeout=0.01)
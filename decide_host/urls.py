@@ -8,6 +8,8 @@ urlpatterns = [
     re_path(r"^$", views.api_root, name="index"),
     re_path(r"^api/$", views.api_root, name="index"),
     re_path(r"^api/info/$", views.api_info, name="api-info"),
+    re_path(r"^api/ingest/$", views.ingest_status, name="ingest-status"),
+    re_path(r"^api/metrics/$", views.metrics_view, name="metrics"),
     re_path(r"^api/events/$", views.EventList.as_view(), name="event-list"),
     re_path(r"^api/trials/$", views.TrialList.as_view(), name="trial-list"),
     re_path(
@@ -23,6 +25,11 @@ urlpatterns = [
         views.ControllerEventList.as_view(),
         name="controller-event-list",
     ),
+    re_path(
+        r"^api/controllers/(?P<addr>[\w-]+)/events/stream/$",
+        views.ControllerEventStream.as_view(),
+        name="controller-event-stream",
+    ),
     re_path(r"^api/subjects/$", views.SubjectList.as_view(), name="subject-list"),
     re_path(
         r"^api/subjects/(?P<name>[\w-]+)/$",
@@ -34,6 +41,11 @@ urlpatterns = [
         views.SubjectTrialList.as_view(),
         name="subject-trial-list",
     ),
+    re_path(
+        r"^api/subjects/(?P<subject>[\w-]+)/daily/$",
+        views.SubjectDailyList.as_view(),
+        name="subject-daily-list",
+    ),
     # fallthrough to 404
     re_path(r"^.*/$", views.notfound, name="notfound"),
 ]
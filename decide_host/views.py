@@ -1,30 +1,56 @@
 # -*- mode: python -*-
 
+import functools
+import hashlib
 import ipaddress
 import logging
+import math
+import re
+import time
 
 from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.functional import cached_property
 from django_filters import rest_framework as filters
-from drf_link_header_pagination import LinkHeaderPagination
 from rest_framework import generics, permissions, status
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
-from decide_host import __version__, api_version, models, serializers
+from decide_host import (
+    __version__,
+    api_version,
+    ingest,
+    models,
+    pagination,
+    parsers,
+    renderers,
+    response_cache,
+    serializers,
+    signals,
+    spool,
+    streams,
+)
+from decide_host.lookups import is_foreign_key_violation, slug_cache
+from decide_host.metrics import metrics
+from decide_host.middleware import serializing
 
 logger = logging.getLogger(__name__)
 
 
-class LinkHeaderPaginationByTimestamp(LinkHeaderPagination):
-    ordering = "-time"
-
-
 @api_view(["HEAD", "GET"])
 def api_root(request, format=None):
     urls = {
         "info": reverse("decide:api-info", request=request, format=format),
+        "ingest": reverse("decide:ingest-status", request=request, format=format),
         "events": reverse("decide:event-list", request=request, format=format),
         "trials": reverse("decide:trial-list", request=request, format=format),
         "controllers": reverse(
@@ -49,6 +75,26 @@ def api_info(request, format=None):
     )
 
 
+@api_view(["GET"])
+def ingest_status(request, format=None):
+    """Status of the write-behind queue for uploaded events"""
+    queue = spool.get_spool()
+    if queue is None:
+        return Response({"enabled": False})
+    return Response({"enabled": True, **queue.stats()})
+
+
+def metrics_view(request):
+    """Request statistics for this worker process, in Prometheus text format.
+
+    These are only collected if decide_host.middleware.MetricsMiddleware is
+    installed.
+    """
+    return HttpResponse(
+        metrics.to_prometheus(), content_type="text/plain; version=0.0.4"
+    )
+
+
 @api_view(["GET"])
 def notfound(request, format=None):
     return Response({"detail": "not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -68,14 +114,588 @@ class IsAuthorizedSubnetOrReadOnly(permissions.BasePermission):
             return False
 
 
+DATA_KEY_RE = re.compile(r"^[\w-]+$")
+DATA_LOOKUPS = {
+    "exact",
+    "iexact",
+    "contains",
+    "icontains",
+    "startswith",
+    "istartswith",
+    "gt",
+    "gte",
+    "lt",
+    "lte",
+    "isnull",
+}
+DATA_MAX_DEPTH = 4
+
+
+def parse_data_value(value):
+    """Returns the JSON scalar a query string value could stand for, or None"""
+    if value in ("true", "True"):
+        return True
+    if value in ("false", "False"):
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        parsed = float(value)
+    except ValueError:
+        return None
+    return parsed if math.isfinite(parsed) else None
+
+
+def data_filter(param, value, indexed_keys=(), positions=None):
+    """Translates a data__ query parameter into a Q object.
+
+    Raises ValueError if the parameter is not a supported lookup on a key (or
+    nested key) of the data field. Equality tests are written as containment
+    (@>) so they can use the GIN index on the field, unless the key has its own
+    expression index. A value that looks like a boolean or a number matches
+    either the string or the parsed value, and is compared as a number in
+    range lookups. If `positions` (from EventSchema.objects.positions()) is
+    given, compacted payloads are matched as well.
+    """
+    path = param.split("__")[1:]
+    lookup = "exact"
+    if len(path) > 1 and path[-1] in DATA_LOOKUPS:
+        lookup = path.pop()
+    if not path or len(path) > DATA_MAX_DEPTH:
+        raise ValueError("unsupported data filter")
+    if not all(DATA_KEY_RE.match(key) for key in path):
+        raise ValueError("invalid key in data filter")
+    if lookup == "isnull":
+        values = [value.lower() == "true"]
+    else:
+        values = [value]
+        parsed = parse_data_value(value)
+        if parsed is not None and lookup == "exact":
+            values.append(parsed)
+        elif parsed is not None and lookup in ("gt", "gte", "lt", "lte"):
+            # JSON values of different types are never ordered sensibly
+            values = [parsed]
+    q = Q()
+    for v in values:
+        if lookup == "exact" and not (len(path) == 1 and path[0] in indexed_keys):
+            for key in reversed(path):
+                v = {key: v}
+            q |= Q(data__contains=v)
+        else:
+            q |= Q(**{f"data__{'__'.join(path)}__{lookup}": v})
+    if positions is None:
+        return q
+    return (Q(schema__isnull=True) & q) | compact_data_filter(
+        path, lookup, values, positions
+    )
+
+
+def compact_data_filter(path, lookup, values, positions):
+    """Matches compacted payloads the way data_filter() matches documents.
+
+    The top-level key is replaced by its index in each schema that has it. For
+    equality tests, containment in the array is checked as well, so the GIN
+    index can still be used.
+    """
+    key, rest = path[0], path[1:]
+    schema_ids = [schema_id for schema_id, _ in positions.get(key, ())]
+    absent = Q(schema__isnull=False) & ~Q(schema_id__in=schema_ids)
+    if lookup == "isnull" and not rest:
+        return absent if values[0] else Q(schema_id__in=schema_ids)
+    q = Q()
+    for schema_id, index in positions.get(key, ()):
+        field = "__".join(["data", str(index), *rest, lookup])
+        matches = Q()
+        for v in values:
+            matches |= Q(**{field: v})
+        q |= Q(schema_id=schema_id) & matches
+    if lookup == "isnull":
+        # a nested key is also missing if the top-level key is
+        return q | absent if values[0] else q
+    if lookup == "exact" and q:
+        contained = Q()
+        for v in values:
+            for k in reversed(rest):
+                v = {k: v}
+            contained |= Q(data__contains=[v])
+        q &= contained
+    # no schema has the key, so no compacted payload matches
+    return q or Q(pk__in=[])
+
+
 class DataFieldFilterMixin:
     """Provides filtering based on components of the data JSONField"""
 
+    @cached_property
+    def schema_positions(self):
+        """Key positions in compacted payloads, or None until compact_events is run"""
+        if self.get_serializer_class().Meta.model is not models.Event:
+            return None
+        return models.EventSchema.objects.positions() or None
+
     def filter_queryset(self, queryset):
         qs = super().filter_queryset(queryset)
-        # this could be a little dangerous b/c we're letting the user design queries
-        mq = {k: v for k, v in self.request.GET.items() if k.startswith("data__")}
-        return qs.filter(**mq)
+        indexed_keys = (
+            getattr(settings, "DECIDE_HOST", {})
+            .get("DATA_INDEXES", {})
+            .get(qs.model._meta.model_name, ())
+        )
+        params = [
+            (param, value)
+            for param, value in self.request.GET.items()
+            if param.startswith("data__")
+        ]
+        positions = self.schema_positions if params else None
+        errors = {}
+        for param, value in params:
+            try:
+                qs = qs.filter(data_filter(param, value, indexed_keys, positions))
+            except ValueError as err:
+                errors[param] = [str(err)]
+        if errors:
+            raise ValidationError(errors)
+        return qs
+
+
+def conflict_detail(err):
+    """Describes an IntegrityError raised when inserting a record"""
+    if is_foreign_key_violation(err):
+        return "refers to a record that no longer exists"
+    return "conflicts with an existing record"
+
+
+class BulkCreateMixin:
+    """Allows clients to POST a list of records to be inserted in one transaction.
+
+    The body can be a JSON array or newline-delimited JSON. Each record is
+    validated separately, and the response is a list giving the status of each
+    record in the order it was submitted. Valid records are inserted even if
+    some of the others were rejected.
+
+    Records that are already in the database are accepted as no-ops (status
+    200, with `already_present` set), so that clients can safely retry. Set
+    `dedup_setting` to the name of a DECIDE_HOST setting that can turn this off,
+    in which case duplicates are rejected.
+
+    If a batch can't be inserted because it conflicts with the database (for
+    example, a controller or subject was deleted by another process), the
+    records are inserted one at a time, and the ones that fail get status 409.
+
+    If `spooled` is True and DECIDE_HOST["INGEST_SPOOL"] is set, valid records
+    are appended to the spool and acknowledged with status 202 instead of being
+    inserted. When the spool is full, requests are refused with status 503.
+
+    """
+
+    parser_classes = (*api_settings.DEFAULT_PARSER_CLASSES, parsers.NDJSONParser)
+    dedup_setting = None
+    spooled = False
+
+    @property
+    def deduplicate(self):
+        if self.dedup_setting is None:
+            return True
+        return getattr(settings, "DECIDE_HOST", {}).get(self.dedup_setting, True)
+
+    def get_ingest_serializer(self, data):
+        serializer = self.get_serializer(data=data)
+        if self.deduplicate:
+            # the database checks uniqueness when the record is inserted
+            serializer.validators = []
+        return serializer
+
+    def perform_create(self, serializer):
+        # the running totals are updated in the same transaction
+        with transaction.atomic():
+            serializer.save()
+
+    def create(self, request, *args, **kwargs):
+        queue = spool.get_spool() if self.spooled else None
+        if queue is not None:
+            return self.create_spooled(queue, request.data)
+        if isinstance(request.data, list):
+            return self.create_many(request.data)
+        if not self.deduplicate:
+            create = functools.partial(super().create, request, *args, **kwargs)
+            try:
+                return slug_cache.retry_stale(create)
+            except IntegrityError as err:
+                return self.conflict_response(err)
+
+        def insert():
+            serializer = self.get_ingest_serializer(request.data)
+            serializer.is_valid(raise_exception=True)
+            instance = model(**serializer.validated_data)
+            with transaction.atomic():
+                inserted = ingest.insert_ignore_conflicts(model, [instance])
+            return serializer, instance, inserted
+
+        model = self.get_serializer_class().Meta.model
+        try:
+            serializer, instance, inserted = slug_cache.retry_stale(insert)
+        except IntegrityError as err:
+            return self.conflict_response(err)
+        serializer.instance = instance
+        if inserted:
+            headers = self.get_success_headers(serializer.data)
+            return Response(
+                serializer.data, status=status.HTTP_201_CREATED, headers=headers
+            )
+        unique_fields = [
+            model._meta.get_field(f) for f in model._meta.unique_together[0]
+        ]
+        instance.pk = (
+            model.objects.filter(
+                **{f.attname: getattr(instance, f.attname) for f in unique_fields}
+            )
+            .values_list("pk", flat=True)
+            .first()
+        )
+        return Response(
+            {**serializer.data, "already_present": True}, status=status.HTTP_200_OK
+        )
+
+    def create_spooled(self, queue, data):
+        if queue.pending() >= spool.max_pending():
+            retry_after = getattr(settings, "DECIDE_HOST", {}).get(
+                "INGEST_SPOOL_RETRY_AFTER", 10
+            )
+            return Response(
+                {"detail": "ingest queue is full, try again later"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(retry_after)},
+            )
+        records = data if isinstance(data, list) else [data]
+        results = []
+        accepted = []
+        for record in records:
+            if not isinstance(record, dict):
+                results.append(
+                    {"status": status.HTTP_400_BAD_REQUEST, "errors": "not an object"}
+                )
+                continue
+            serializer = self.get_ingest_serializer(record)
+            if not serializer.is_valid():
+                results.append(
+                    {"status": status.HTTP_400_BAD_REQUEST, "errors": serializer.errors}
+                )
+                continue
+            accepted.append(record)
+            results.append({"status": status.HTTP_202_ACCEPTED})
+        if accepted:
+            model = self.get_serializer_class().Meta.model
+            queue.append(model._meta.model_name, accepted)
+        if not isinstance(data, list):
+            if not accepted:
+                raise ValidationError(results[0]["errors"])
+            return Response({"queued": True}, status=status.HTTP_202_ACCEPTED)
+        if not accepted:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif len(accepted) < len(results):
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_202_ACCEPTED
+        return Response(results, status=response_status)
+
+    def create_many(self, records):
+        model = self.get_serializer_class().Meta.model
+
+        def validate(record):
+            serializer = self.get_ingest_serializer(record)
+            serializer.is_valid(raise_exception=True)
+            return model(**serializer.validated_data)
+
+        def insert():
+            results, instances = self.validate_many(model, records, validate)
+            with transaction.atomic():
+                return results, instances, self.insert_many(model, instances)
+
+        try:
+            results, instances, inserted = slug_cache.retry_stale(insert)
+        except IntegrityError as err:
+            logger.warning("batch insert failed, inserting one at a time: %s", err)
+            results, instances = self.validate_many(model, records, validate)
+            instances, inserted = self.insert_each(model, results, instances)
+        return self.batch_response(results, instances, inserted)
+
+    def conflict_response(self, err):
+        logger.warning("insert failed: %s", err)
+        return Response(
+            {"detail": conflict_detail(err)}, status=status.HTTP_409_CONFLICT
+        )
+
+    def validate_many(self, model, records, validate):
+        """Converts records to unsaved instances with validate(record).
+
+        Returns a list with the status of each record, and the list of
+        instances to insert.
+        """
+        unique_fields = [
+            model._meta.get_field(f) for f in model._meta.unique_together[0]
+        ]
+        deduplicate = self.deduplicate
+        results = []
+        instances = []
+        seen = set()
+        for record in records:
+            if not isinstance(record, dict):
+                results.append(
+                    {"status": status.HTTP_400_BAD_REQUEST, "errors": "not an object"}
+                )
+                continue
+            try:
+                instance = validate(record)
+            except ValidationError as err:
+                results.append(
+                    {"status": status.HTTP_400_BAD_REQUEST, "errors": err.detail}
+                )
+                continue
+            key = tuple(getattr(instance, f.attname) for f in unique_fields)
+            if key in seen:
+                if deduplicate:
+                    results.append(
+                        {"status": status.HTTP_200_OK, "already_present": True}
+                    )
+                else:
+                    results.append(
+                        {
+                            "status": status.HTTP_400_BAD_REQUEST,
+                            "errors": "duplicate record in batch",
+                        }
+                    )
+                continue
+            seen.add(key)
+            instances.append(instance)
+            results.append({"status": status.HTTP_201_CREATED})
+        return results, instances
+
+    def insert_many(self, model, instances):
+        """Inserts instances and returns the ones that were new. Call in a transaction"""
+        if self.deduplicate:
+            return ingest.insert_ignore_conflicts(model, instances)
+        inserted = model.objects.bulk_create(instances)
+        signals.send_recorded(model, inserted)
+        return inserted
+
+    def insert_each(self, model, results, instances):
+        """Inserts instances one at a time, each in its own savepoint.
+
+        This is the fallback when inserting them together fails. The results of
+        records that fail are changed to status 409. Returns the instances that
+        were stored (new or already present) and the ones that were new.
+        """
+        pending = [r for r in results if r["status"] == status.HTTP_201_CREATED]
+        stored = []
+        inserted = []
+        with transaction.atomic(), connection.cursor() as cursor:
+            # check foreign keys as each record is inserted instead of at commit
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            for instance, result in zip(instances, pending, strict=True):
+                try:
+                    with transaction.atomic():
+                        inserted.extend(self.insert_many(model, [instance]))
+                except IntegrityError as err:
+                    logger.warning("insert failed: %s", err)
+                    result.update(
+                        status=status.HTTP_409_CONFLICT, errors=conflict_detail(err)
+                    )
+                    continue
+                stored.append(instance)
+        return stored, inserted
+
+    def batch_response(self, results, instances, inserted):
+        inserted_ids = {id(instance) for instance in inserted}
+        submitted = iter(instances)
+        for result in results:
+            if result["status"] == status.HTTP_201_CREATED:
+                instance = next(submitted)
+                if id(instance) in inserted_ids:
+                    result["id"] = instance.id
+                else:
+                    result.update(status=status.HTTP_200_OK, already_present=True)
+        n_accepted = sum(r["status"] < status.HTTP_400_BAD_REQUEST for r in results)
+        if n_accepted == 0:
+            statuses = {r["status"] for r in results}
+            response_status = (
+                statuses.pop() if len(statuses) == 1 else status.HTTP_400_BAD_REQUEST
+            )
+        elif n_accepted < len(results):
+            response_status = status.HTTP_207_MULTI_STATUS
+        elif inserted:
+            response_status = status.HTTP_201_CREATED
+        else:
+            response_status = status.HTTP_200_OK
+        return Response(results, status=response_status)
+
+
+class ConditionalGetMixin:
+    """Answers GET requests with 304 Not Modified if the response hasn't changed.
+
+    Subclasses implement get_validator(), which returns a tuple of values that
+    changes whenever the response would and which should be much cheaper to
+    compute than the response itself. The ETag is derived from the validator and
+    the format of the response.
+
+    """
+
+    def get_validator(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        validator = self.get_validator()
+        if validator is None:
+            return super().get(request, *args, **kwargs)
+        key = repr((request.accepted_renderer.format, validator)).encode()
+        etag = quote_etag(hashlib.sha1(key).hexdigest()[:20])
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        if 200 <= response.status_code < 300 or response.status_code == 304:
+            response["ETag"] = etag
+        return response
+
+
+class CachedResponseMixin:
+    """Caches responses in DECIDE_HOST["RESPONSE_CACHE"], if that is set.
+
+    Subclasses implement get_cache_scopes(), which returns the names of the
+    version counters in `decide_host.response_cache` that are bumped when the
+    response may have changed. Only the data and Link header are cached; the
+    response is rendered again for each request.
+
+    """
+
+    def get_cache_scopes(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        cache = response_cache.get_cache()
+        if cache is None:
+            return super().get(request, *args, **kwargs)
+        key = response_cache.make_key(
+            cache,
+            self.get_cache_scopes(),
+            request.accepted_renderer.format,
+            request.get_full_path(),
+            # some of the counts are for the current day
+            timezone.localdate(),
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            data, headers = cached
+            return Response(data, headers=headers)
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            data = response.data
+            # drop the reference to the serializer in ReturnList/ReturnDict
+            data = list(data) if isinstance(data, list) else dict(data)
+            headers = {"Link": response["Link"]} if "Link" in response else {}
+            cache.set(key, (data, headers), response_cache.get_timeout())
+        return response
+
+
+def record_validator(model):
+    """The range of ids in a list of events or trials, read from the primary key index.
+
+    This isn't enough on its own: transactions can commit out of id order, so a
+    record can be added inside the range. The validators below add running
+    totals that are updated in the same transaction as every insert.
+    """
+    return tuple(model.objects.aggregate(first=Min("id"), last=Max("id")).values())
+
+
+def event_validator():
+    # archive_events deletes old events, which aren't always the ones with the
+    # smallest ids, but it always adds them to the daily summaries
+    archived = models.EventDailySummary.objects.aggregate(n=Sum("n_events"))["n"]
+    recorded = models.ControllerStats.objects.aggregate(n=Sum("n_events"))["n"]
+    return (*record_validator(models.Event), archived, recorded)
+
+
+def trial_validator():
+    # merge_subjects moves trials between subjects without changing the total,
+    # so the totals are also weighted by subject id
+    totals = models.SubjectStats.objects.aggregate(
+        n=Sum("n_trials"), weighted=Sum(F("subject_id") * F("n_trials"))
+    )
+    return (*record_validator(models.Trial), *totals.values())
+
+
+class SerializeTimingMixin:
+    """Times serializing the records in list and retrieve responses.
+
+    The time is reported by MetricsMiddleware separately from the rest of the
+    view. It includes any queries made by the serializer, which are also
+    counted in the database time.
+    """
+
+    def serialize(self, instance, many=False):
+        serializer = self.get_serializer(instance, many=many)
+        with serializing(self.request):
+            return serializer.data
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.serialize(page, many=True))
+        return Response(self.serialize(queryset, many=True))
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self.serialize(self.get_object()))
+
+
+class FlatValuesMixin:
+    """Serializes pages of results from values() rows instead of model instances"""
+
+    def paginate_queryset(self, queryset):
+        return super().paginate_queryset(self.get_serializer().get_values(queryset))
+
+
+class StreamingExportMixin:
+    """Streams the entire filtered queryset if a streaming format is requested.
+
+    Use `?format=ndjson` or `?format=csv` (or the corresponding Accept header),
+    or `?format=parquet` or `?format=arrow` if pyarrow is installed.
+    Records are read from the database with a server-side cursor and written to
+    the response as they are serialized, without pagination. With `since_id`,
+    the export is the change feed up to the time of the request, and the `next`
+    link to continue from is in the Link header.
+
+    """
+
+    renderer_classes = (
+        *api_settings.DEFAULT_RENDERER_CLASSES,
+        renderers.NDJSONRenderer,
+        renderers.CSVRenderer,
+        *renderers.COLUMNAR_RENDERERS,
+    )
+    export_chunk_size = 2000
+
+    def list(self, request, *args, **kwargs):
+        renderer = request.accepted_renderer
+        if not hasattr(renderer, "stream"):
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        headers = {}
+        feed = pagination.ChangeFeedPagination
+        if feed.since_query_param in request.query_params:
+            queryset, headers = feed().get_export_queryset(queryset, request)
+        serializer = self.get_serializer()
+        records = (
+            serializer.flatten_values(row)
+            for row in serializer.get_values(queryset).iterator(
+                chunk_size=self.export_chunk_size
+            )
+        )
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type = f"{content_type}; charset={renderer.charset}"
+        return StreamingHttpResponse(
+            renderer.stream(records), content_type=content_type, headers=headers
+        )
 
 
 class EventFilter(filters.FilterSet):
@@ -112,16 +732,55 @@ class TrialFilter(filters.FilterSet):
         fields = {"time": ["exact", "date"]}
 
 
-class EventList(DataFieldFilterMixin, generics.ListCreateAPIView):
+class DailyTrialStatsFilter(filters.FilterSet):
+    name = filters.CharFilter(
+        field_name="name__name", label="name", lookup_expr="iexact"
+    )
+    date = filters.DateFromToRangeFilter(field_name="date")
+
+    class Meta:
+        model = models.DailyTrialStats
+        fields = ("date",)
+
+
+class EventList(
+    ConditionalGetMixin,
+    BulkCreateMixin,
+    StreamingExportMixin,
+    FlatValuesMixin,
+    DataFieldFilterMixin,
+    SerializeTimingMixin,
+    generics.ListCreateAPIView,
+):
+    """Records of state changes in connected controllers.
+
+    POST a single record, or a JSON array (or newline-delimited JSON) of records
+    to insert them in one transaction. Records that have already been stored are
+    acknowledged with status 200 and `already_present` set, so retries are safe.
+
+    """
+
     queryset = models.Event.objects.with_names()
     serializer_class = serializers.EventSerializer
+    spooled = True
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_class = EventFilter
-    pagination_class = LinkHeaderPaginationByTimestamp
+    pagination_class = pagination.TimestampPagination
     permission_classes = (IsAuthorizedSubnetOrReadOnly,)
 
+    def get_validator(self):
+        return event_validator()
 
-class TrialList(DataFieldFilterMixin, generics.ListCreateAPIView):
+
+class TrialList(
+    ConditionalGetMixin,
+    BulkCreateMixin,
+    StreamingExportMixin,
+    FlatValuesMixin,
+    DataFieldFilterMixin,
+    SerializeTimingMixin,
+    generics.ListCreateAPIView,
+):
     """Records of trials and trial-related comments.
 
     This endpoint returns a list of records from the database of trial records.
@@ -138,32 +797,85 @@ class TrialList(DataFieldFilterMixin, generics.ListCreateAPIView):
     You can filter on other fields of the record, but these need to be prefaced
     by `data__` due to the way they're stored in the database. For example, to
     restrict returned records to ones in which `correct` was `True`, add the
-    query `data__correct=True`.
+    query `data__correct=True`. Nested fields and the lookups `iexact`,
+    `contains`, `icontains`, `startswith`, `istartswith`, `gt`, `gte`, `lt`,
+    `lte` and `isnull` are also supported, e.g. `data__rtime__gt=1000000`.
 
     Multiple queries produce a more restrictive filter.
 
     Example: "?subject=P24&date_after=2022-02-01&date_before=2022-02-28"
 
+    Results are paginated, with links to other pages in the `Link` header. Add
+    the query `cursor=` to page with `next` and `prev` links that stay fast no
+    matter how far back in time they go.
+
+    Add `format=ndjson` or `format=csv` to download all the matching records in
+    one unpaginated response, or `format=parquet` or `format=arrow` for typed
+    columns that load quickly into pandas (if the server has pyarrow).
+
+    POST a single record, or a JSON array (or newline-delimited JSON) of records
+    to insert them in one transaction. Records that have already been stored are
+    acknowledged with status 200 and `already_present` set, so retries are safe.
+
     """
 
     queryset = models.Trial.objects.with_names()
     serializer_class = serializers.TrialSerializer
+    dedup_setting = "TRIAL_DEDUP"
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_class = TrialFilter
-    pagination_class = LinkHeaderPaginationByTimestamp
+    pagination_class = pagination.TimestampPagination
     permission_classes = (IsAuthorizedSubnetOrReadOnly,)
 
+    def get_validator(self):
+        return trial_validator()
+
 
-class ControllerList(generics.ListAPIView):
-    queryset = models.Controller.objects.with_counts().order_by("-last_event_time")
+class ControllerList(
+    ConditionalGetMixin, CachedResponseMixin, SerializeTimingMixin, generics.ListAPIView
+):
+    queryset = models.Controller.objects.with_stats().order_by("-last_event_time")
     serializer_class = serializers.ControllerSerializer
 
+    def get_cache_scopes(self):
+        return ("controllers",)
+
+    def get_validator(self):
+        return tuple(
+            models.Controller.objects.aggregate(
+                n=Count("id"),
+                last=Max("id"),
+                n_events=Sum("stats__n_events"),
+                last_event_time=Max("stats__last_event_time"),
+            ).values()
+        )
+
 
-class ControllerDetail(generics.RetrieveAPIView):
+class ControllerDetail(
+    ConditionalGetMixin,
+    CachedResponseMixin,
+    SerializeTimingMixin,
+    generics.RetrieveAPIView,
+):
     lookup_field = "name"
-    queryset = models.Controller.objects.with_counts()
+    queryset = models.Controller.objects.with_stats()
     serializer_class = serializers.ControllerSerializer
 
+    def get_cache_scopes(self):
+        pk = (
+            models.Controller.objects.filter(name=self.kwargs["name"])
+            .values_list("id", flat=True)
+            .first()
+        )
+        return (f"controller:{pk}",)
+
+    def get_validator(self):
+        return (
+            models.Controller.objects.filter(name=self.kwargs["name"])
+            .values_list("id", "stats__n_events", "stats__last_event_time")
+            .first()
+        )
+
     def retrieve(self, request, **kwargs):
         response = super().retrieve(request, **kwargs)
         # add link to trials in header
@@ -174,12 +886,22 @@ class ControllerDetail(generics.RetrieveAPIView):
         return response
 
 
-class ControllerEventList(DataFieldFilterMixin, generics.ListAPIView):
+class ControllerEventList(
+    ConditionalGetMixin,
+    StreamingExportMixin,
+    FlatValuesMixin,
+    DataFieldFilterMixin,
+    SerializeTimingMixin,
+    generics.ListAPIView,
+):
     serializer_class = serializers.EventSerializer
     filter_backends = (filters.DjangoFilterBackend,)
-    pagination_class = LinkHeaderPaginationByTimestamp
+    pagination_class = pagination.TimestampPagination
     filterset_class = EventFilter
 
+    def get_validator(self):
+        return event_validator()
+
     def get_object(self):
         return get_object_or_404(models.Controller, name=self.kwargs["addr"])
 
@@ -188,35 +910,228 @@ class ControllerEventList(DataFieldFilterMixin, generics.ListAPIView):
         return addr.event_set.with_names()
 
 
-class SubjectList(generics.ListAPIView):
-    queryset = models.Subject.objects.with_counts().order_by("-last_trial_time")
+class ControllerEventStream(generics.GenericAPIView):
+    """New events from a controller, delivered as they are recorded.
+
+    With `Accept: text/event-stream`, the response is a stream of server-sent
+    events, one per record, that ends after DECIDE_HOST["STREAM_TIMEOUT"]
+    seconds (default 300); EventSource clients reconnect automatically and
+    resume from the Last-Event-ID. Otherwise, the request is a long poll: the
+    response is a list of the events recorded after the one with id `after`,
+    waiting up to `wait` seconds (default 25) for the first to arrive. The `next`
+    link in the Link header continues from the last event returned.
+
+    Without `after` (or Last-Event-ID), only events recorded after the request
+    are returned.
+
+    """
+
+    serializer_class = serializers.EventSerializer
+    renderer_classes = (
+        *api_settings.DEFAULT_RENDERER_CLASSES,
+        renderers.EventStreamRenderer,
+    )
+    max_wait = 60
+    batch_size = 1000
+
+    def get_object(self):
+        return get_object_or_404(models.Controller, name=self.kwargs["addr"])
+
+    def get(self, request, *args, **kwargs):
+        controller = self.get_object()
+        after = request.headers.get("Last-Event-ID") or request.query_params.get(
+            "after"
+        )
+        try:
+            after = int(after) if after else self.get_latest_id(controller)
+        except ValueError:
+            raise ValidationError({"after": ["must be an event id"]}) from None
+        if isinstance(request.accepted_renderer, renderers.EventStreamRenderer):
+            return StreamingHttpResponse(
+                self.stream(controller, after, request.accepted_renderer),
+                content_type=request.accepted_renderer.media_type,
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+        try:
+            wait = float(request.query_params.get("wait", 25))
+        except (TypeError, ValueError):
+            wait = math.nan
+        # a NaN timeout would make the wait below last forever
+        if not math.isfinite(wait):
+            raise ValidationError({"wait": ["must be a number"]})
+        wait = min(max(wait, 0), self.max_wait)
+        rows = self.wait_for_events(controller, after, wait)
+        if rows:
+            after = rows[-1]["id"]
+        serializer = self.get_serializer()
+        next_url = replace_query_param(request.build_absolute_uri(), "after", after)
+        return Response(
+            [serializer.flatten_values(row) for row in rows],
+            headers=pagination.link_header([(next_url, "next")]),
+        )
+
+    def get_latest_id(self, controller):
+        latest = controller.event_set.order_by("-id").values_list("id", flat=True)
+        return latest.first() or 0
+
+    def get_events(self, controller, after):
+        """Returns values() rows for up to batch_size events with ids after `after`"""
+        queryset = controller.event_set.filter(id__gt=after).order_by("id")
+        return list(self.get_serializer().get_values(queryset)[: self.batch_size])
+
+    @property
+    def poll_interval(self):
+        """How often to check the database for events recorded by other processes"""
+        return getattr(settings, "DECIDE_HOST", {}).get("STREAM_POLL_INTERVAL", 5)
+
+    def wait_for_events(self, controller, after, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            version = streams.event_hub.version(controller.pk)
+            rows = self.get_events(controller, after)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                return rows
+            streams.event_hub.wait(
+                controller.pk, version, min(remaining, self.poll_interval)
+            )
+
+    def stream(self, controller, after, renderer):
+        timeout = getattr(settings, "DECIDE_HOST", {}).get("STREAM_TIMEOUT", 300)
+        deadline = time.monotonic() + timeout
+        serializer = self.get_serializer()
+        # tell the client how long to wait (in ms) before reconnecting
+        yield b"retry: 1000\n\n"
+        while (remaining := deadline - time.monotonic()) > 0:
+            rows = self.wait_for_events(
+                controller, after, min(remaining, self.poll_interval)
+            )
+            if rows:
+                after = rows[-1]["id"]
+                yield b"".join(
+                    renderer.message(serializer.flatten_values(row), id=row["id"])
+                    for row in rows
+                )
+            else:
+                # a comment, so that disconnected clients are noticed
+                yield b": keepalive\n\n"
+
+
+class SubjectList(
+    ConditionalGetMixin, CachedResponseMixin, SerializeTimingMixin, generics.ListAPIView
+):
+    queryset = models.Subject.objects.with_stats().order_by("-last_trial_time")
     serializer_class = serializers.SubjectSerializer
 
+    def get_cache_scopes(self):
+        return ("subjects",)
+
+    def get_validator(self):
+        # n_trials_today depends on the date. merge_subjects moves trials between
+        # subjects without changing the total, so it's also weighted by id
+        return (
+            timezone.localdate(),
+            *models.Subject.objects.aggregate(
+                n=Count("id"),
+                last=Max("id"),
+                n_trials=Sum("stats__n_trials"),
+                weighted=Sum(F("id") * F("stats__n_trials")),
+                last_trial_time=Max("stats__last_trial_time"),
+            ).values(),
+        )
 
-class SubjectDetail(generics.RetrieveAPIView):
+
+class SubjectDetail(
+    ConditionalGetMixin,
+    CachedResponseMixin,
+    SerializeTimingMixin,
+    generics.RetrieveAPIView,
+):
     lookup_field = "name"
-    queryset = models.Subject.objects.with_counts()
+    queryset = models.Subject.objects.with_stats()
     serializer_class = serializers.SubjectSerializer
 
+    def get_cache_scopes(self):
+        pk = (
+            models.Subject.objects.filter(name=self.kwargs["name"])
+            .values_list("id", flat=True)
+            .first()
+        )
+        return (f"subject:{pk}",)
+
+    def get_validator(self):
+        row = (
+            models.Subject.objects.filter(name=self.kwargs["name"])
+            .values_list("id", "stats__n_trials", "stats__last_trial_time")
+            .first()
+        )
+        return None if row is None else (timezone.localdate(), *row)
+
     def retrieve(self, request, **kwargs):
         response = super().retrieve(request, **kwargs)
         # add link to trials in header
-        uri = reverse(
-            "decide:subject-trial-list", args=[kwargs["name"]], request=request
+        links = (
+            (
+                reverse(
+                    "decide:subject-trial-list", args=[kwargs["name"]], request=request
+                ),
+                "trials",
+            ),
+            (
+                reverse(
+                    "decide:subject-daily-list", args=[kwargs["name"]], request=request
+                ),
+                "daily",
+            ),
         )
-        response["Link"] = f'<{uri}>; rel="trials"'
+        response["Link"] = pagination.link_header(links)["Link"]
         return response
 
 
-class SubjectTrialList(DataFieldFilterMixin, generics.ListAPIView):
+class SubjectTrialList(
+    ConditionalGetMixin,
+    StreamingExportMixin,
+    FlatValuesMixin,
+    DataFieldFilterMixin,
+    SerializeTimingMixin,
+    generics.ListAPIView,
+):
     serializer_class = serializers.TrialSerializer
     filter_backends = (filters.DjangoFilterBackend,)
-    pagination_class = LinkHeaderPaginationByTimestamp
+    pagination_class = pagination.TimestampPagination
     filterset_class = TrialFilter
 
+    def get_validator(self):
+        return trial_validator()
+
     def get_object(self):
         return get_object_or_404(models.Subject, name=self.kwargs["subject"])
 
     def get_queryset(self):
         subj = self.get_object()
         return subj.trial_set.with_names()
+
+
+class SubjectDailyList(SerializeTimingMixin, generics.ListAPIView):
+    """Daily totals of trials for a subject.
+
+    Each record gives the number of trials for one procedure (`name`) on one
+    date, how many had a `correct` field (`n_scored`), how many of those were
+    correct (`n_correct` and `p_correct`), and how many trials had a
+    `response` that wasn't a timeout.
+
+    Filter with `name`, and with `date_after` and `date_before` (inclusive,
+    formatted `YYYY-MM-DD`).
+
+    """
+
+    serializer_class = serializers.DailyTrialStatsSerializer
+    filter_backends = (filters.DjangoFilterBackend,)
+    filterset_class = DailyTrialStatsFilter
+
+    def get_object(self):
+        return get_object_or_404(models.Subject, name=self.kwargs["subject"])
+
+    def get_queryset(self):
+        subj = self.get_object()
+        return subj.daily_stats.select_related("name")